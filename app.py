@@ -5,7 +5,7 @@ import etcd3
 from state_sync.sync_logger import logger
 from state_sync.parser_engine import ParserEngine
 from state_sync.watcher import WatchForChanges
-from state_sync.custom_exceptions import MaximumRetiresReachedException
+from state_sync.snapshot_store import SQLiteSnapshotStore
 
 
 def main():
@@ -25,26 +25,41 @@ def main():
             "/spacecrafts/": {"call_back_type": "PREFIX"},
             "/customer_config/customer1/": {"serialization": "JSON"},
             "/customer_config/customer4": None,
-            "/customer_config/": {"call_back_type": "PREFIX"},
+            # The serialization of a prefix key applies to every key under that prefix.
+            "/customer_config/": {"call_back_type": "PREFIX", "serialization": "JSON"},
         }
 
         watcher = WatchForChanges(host=host, port=port, number_of_retries=number_of_retries,
                                   retry_interval=retry_interval, ca_cert=None, cert_key=None,
                                   cert_cert=None, timeout=10, user=None, password=None,
-                                  grpc_options=None)
-
-        # Establish connection with etcd
-        watcher.etcd_connection_obj.establish_connection_with_etcd()
-
-        watcher.start_watch_keys(keys=keys_for_watch)
-        logger.debug(f"Watch id map: {watcher.watch_id_map}")
+                                  grpc_options=None,
+                                  # Each applied batch is saved locally, so a restarted process is served at once.
+                                  snapshot_store=SQLiteSnapshotStore(path='state_sync_snapshot.db'))
 
         # Create an instance of the ParserEngine class and subscribe to receive notifications for new changes.
-        parser_engine = ParserEngine(keys=keys_for_watch)
+        # Passing the watcher metrics adds the deserialization times to watcher.stats(). They are None when disabled.
+        parser_engine = ParserEngine(keys=keys_for_watch, metrics=watcher.metrics)
         # You can create your own observer and attach it to listen for all changes.
         # To do this, you need to implement the Observer class.
+        # Attach it with a key or a prefix to receive only the matching changes, such as
+        # watcher.attach(observer=my_observer, prefix="/spacecrafts/").
+        # Attach the observers before watching, so they also receive the values loaded by the initial snapshot.
         watcher.attach(observer=parser_engine)
 
+        # Serve the config saved by the previous run before etcd answers.
+        watcher.warm_start(keys=keys_for_watch)
+
+        # The startup does not wait for etcd: when it is unreachable, the failure is recorded and the supervisor
+        # makes the first connection in the background, while the warm started config is served.
+        watcher.start_watch_keys(keys=keys_for_watch)
+        logger.debug(f"Watch id map: {watcher.watch_id_map}")
+
+        # Whenever a connection fails with etcd, the supervisor reconnects in the background and continues listening
+        # for changes from the last applied revision, so the changes made in the meantime are not lost.
+        # The snapshots keep serving the last known config while reconnecting.
+        # Watches whose revision has been compacted by etcd are loaded again from a fresh snapshot.
+        watcher.start_supervisor(on_state_change=lambda state, health: logger.info(f"Connection state: {health}"))
+
         for i in range(0, 50000):
 
             # Performing business logic processing.
@@ -53,22 +68,17 @@ def main():
             # View the changes using the is_change_detected and perform the necessary operations.
             if watcher.is_change_detected:
                 # You can directly retrieve the data from the watcher instance.
-                logger.info(f"Raw key-value data : {watcher.data}")
+                # The snapshot is an immutable and consistent view of all the keys, tagged with its etcd revision.
+                snapshot = watcher.snapshot()
+                logger.info(f"Raw key-value data at revision {snapshot.revision} : {dict(snapshot)}")
                 watcher.is_change_detected = False
 
                 # Retrieve the parsed data.
-                logger.info(f"Parser engine data : {parser_engine.data}")
-
-            # Whenever a connection fails with etcd, it will attempt to reconnect and continue listening for changes
-            if watcher.etcd_connection_obj.is_connection_failed_with_etcd:
-                watcher.on_failure_connect_with_etcd_and_continue_watch_for_changes()
+                logger.info(f"Parser engine data : {dict(parser_engine.snapshot())}")
 
     except etcd3.exceptions.ConnectionFailedError as connect_ex:
         logger.error(f"A connection failure occurred while watching the key. {connect_ex}")
 
-    except MaximumRetiresReachedException as max_ex:
-        logger.error(f"MaximumRetiresReachedException {max_ex}")
-
     watcher.close_connection()
 
 
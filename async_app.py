@@ -0,0 +1,55 @@
+import asyncio
+from contextlib import aclosing
+
+from state_sync.sync_logger import logger
+from state_sync.parser_engine import ParserEngine
+from state_sync.watcher import WatchForChanges
+from state_sync.async_watcher import AsyncWatchForChanges
+from state_sync.abstract_observer import AsyncObserver
+
+
+class FeatureObserver(AsyncObserver):
+    async def update_received(self, key: str, value: str) -> None:
+        logger.info(f"Async observer received key : '{key}' - value : '{value}'")
+
+
+async def main():
+    keys_for_watch = {
+        "feature": None,
+        "/customer_config/": {"call_back_type": "PREFIX", "serialization": "JSON"},
+    }
+
+    watcher = WatchForChanges(host='localhost', port=2379, number_of_retries=3, retry_interval=10)
+
+    parser_engine = ParserEngine(keys=keys_for_watch)
+    watcher.attach(observer=parser_engine)
+
+    # The changes are handed from the etcd callback thread to this event loop as soon as they arrive.
+    async_watcher = AsyncWatchForChanges(watcher=watcher)
+    async_watcher.attach_async(observer=FeatureObserver())
+
+    # When etcd is unreachable, the supervisor connects in the background.
+    watcher.start_watch_keys(keys=keys_for_watch)
+    watcher.start_supervisor()
+
+    try:
+        try:
+            change = await async_watcher.wait_for_change(key="feature", timeout=60)
+            logger.info(f"The feature key changed : '{change.value}'")
+        except asyncio.TimeoutError:
+            logger.info("The feature key did not change within 60 seconds.")
+
+        # The iterator is closed when the loop ends, releasing its queue.
+        async with aclosing(async_watcher.changes(prefix="/customer_config/")) as changes:
+            async for change in changes:
+                logger.info(f"Customer config changed : '{change.key}' - parsed : {parser_engine.data.get(change.key)}")
+                if change.key == "/customer_config/shutdown":
+                    break
+    finally:
+        # It also runs when the program is interrupted, as asyncio.run() cancels main().
+        async_watcher.close()
+        watcher.close_connection()
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
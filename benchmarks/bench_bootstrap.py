@@ -0,0 +1,62 @@
+"""Compares warming up the config with one get per key against the batched snapshot bootstrap.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench_bootstrap --keys 10000 --round-trip-ms 0.5
+"""
+import argparse
+import logging
+import time
+
+from state_sync.sync_logger import logger
+from state_sync.watcher import WatchForChanges
+from state_sync.fake_etcd import FakeEtcdClient
+
+
+def create_watcher(etcd_client: FakeEtcdClient) -> WatchForChanges:
+    return WatchForChanges(host='localhost', port=2379, number_of_retries=1, retry_interval=1,
+                           etcd_client=etcd_client)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--round-trip-ms', type=float, default=0.5)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    etcd_client = FakeEtcdClient()
+    customer_keys = [f"/customer_config/customer{i}/" for i in range(args.keys)]
+    for key in customer_keys:
+        etcd_client.put(key, '{"limits": {"rate": 100}}')
+    etcd_client.round_trip_time = args.round_trip_ms / 1000
+
+    # Baseline: one get per key.
+    data = {}
+    etcd_client.round_trips = 0
+    started = time.perf_counter()
+    for key in customer_keys:
+        value, _ = etcd_client.get(key)
+        data[key] = value.decode('utf-8')
+    get_per_key_time = time.perf_counter() - started
+    get_per_key_round_trips = etcd_client.round_trips
+
+    # Snapshot bootstrap of the same keys through the prefix.
+    watcher = create_watcher(etcd_client)
+    keys = {"/customer_config/": {"call_back_type": "PREFIX"}}
+    # Only the snapshot is timed, so the keys are defined without adding watches.
+    watcher.watch_keys = keys
+    etcd_client.round_trips = 0
+    started = time.perf_counter()
+    revision = watcher.load_snapshot(keys=keys)
+    snapshot_time = time.perf_counter() - started
+    snapshot_round_trips = etcd_client.round_trips
+    assert len(watcher.data) == args.keys
+
+    print(f"keys: {args.keys} - round trip: {args.round_trip_ms} ms - snapshot revision: {revision}")
+    print(f"get per key : {get_per_key_time * 1000:10.1f} ms  {get_per_key_round_trips:6d} round trips")
+    print(f"snapshot    : {snapshot_time * 1000:10.1f} ms  {snapshot_round_trips:6d} round trips")
+
+
+if __name__ == '__main__':
+    main()
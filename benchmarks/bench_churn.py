@@ -0,0 +1,90 @@
+"""Measures the memory retained by the watcher and the ParserEngine under a churn of short-lived session keys
+discovered under a prefix. The watch responses are passed to the watcher callback directly, so the memory of
+a server holding the keys is not measured.
+
+- deletes   : each session key is deleted once it expires, and the DeleteEvents remove it.
+- bounded   : the session keys are never deleted, and the key store evicts the least recently written ones
+              beyond --live-keys.
+- unbounded : the session keys are never deleted nor evicted, so every churned key is retained.
+
+The retained memory is sampled as the churn goes, so a flat line means the memory does not grow with the churn.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench_churn --keys 1000000 --live-keys 10000
+"""
+import argparse
+import gc
+import logging
+import time
+import tracemalloc
+
+from state_sync.sync_logger import logger
+from state_sync.watcher import WatchForChanges
+from state_sync.parser_engine import ParserEngine
+from state_sync.fake_etcd import FakeEtcdClient, create_watch_response
+
+PREFIX = "/sessions/"
+KEYS = {PREFIX: {"call_back_type": "PREFIX", "serialization": "JSON"}}
+VALUE = '{{"session_id": {}, "user": "user{}", "ttl": 60}}'
+
+
+def session_key(index: int) -> str:
+    return f"{PREFIX}session{index}"
+
+
+def run_churn(mode: str, keys: int, live_keys: int, batch_size: int, samples: int) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    watcher = WatchForChanges(host='localhost', port=2379, number_of_retries=1, retry_interval=1,
+                              etcd_client=FakeEtcdClient(),
+                              max_discovered_keys=live_keys if mode == 'bounded' else None)
+    parser_engine = ParserEngine(keys=KEYS)
+    watcher.attach(parser_engine)
+    watcher.start_watch_keys(keys=dict(KEYS))
+
+    retained = []
+    sample_every = max(batch_size, keys // samples)
+    started = time.perf_counter()
+    for revision, start in enumerate(range(0, keys, batch_size), start=2):
+        expired = start - live_keys
+        deleted_keys = [session_key(i) for i in range(expired, expired + batch_size)] \
+            if mode == 'deletes' and expired >= 0 else ()
+        watcher.callback(create_watch_response({session_key(i): VALUE.format(i, i % 1000)
+                                                for i in range(start, min(start + batch_size, keys))},
+                                               revision=revision, deleted_keys=deleted_keys), watch_key=PREFIX)
+        if (start + batch_size) % sample_every < batch_size:
+            retained.append(tracemalloc.get_traced_memory()[0])
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return {'mode': mode, 'keys': keys, 'watcher_keys': len(watcher.snapshot()),
+            'parsed_keys': len(parser_engine.snapshot()), 'retained_bytes': memory,
+            'samples_mb': [sample / 2 ** 20 for sample in retained], 'keys_per_second': keys / elapsed}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=1000000, help='The number of churned session keys.')
+    parser.add_argument('--live-keys', type=int, default=10000, help='The number of sessions alive at a time.')
+    parser.add_argument('--unbounded-keys', type=int, default=100000,
+                        help='The number of churned keys of the unbounded mode, which retains all of them.')
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--samples', type=int, default=5)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    print(f"live keys: {args.live_keys}")
+    for mode, keys in (('deletes', args.keys), ('bounded', args.keys), ('unbounded', args.unbounded_keys)):
+        result = run_churn(mode=mode, keys=keys, live_keys=args.live_keys, batch_size=args.batch_size,
+                           samples=args.samples)
+        samples = ' '.join(f"{sample:7.1f}" for sample in result['samples_mb'])
+        print(f"{mode:9s} {result['keys']:8d} churned keys : retained {result['retained_bytes'] / 2 ** 20:8.1f} MB "
+              f"- {result['retained_bytes'] / result['keys']:7.1f} bytes per churned key - "
+              f"keys {result['watcher_keys']}/{result['parsed_keys']} - {result['keys_per_second']:8.0f} keys/s")
+        print(f"          retained MB while churning: {samples}")
+
+
+if __name__ == '__main__':
+    main()
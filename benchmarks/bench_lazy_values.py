@@ -0,0 +1,67 @@
+"""Compares eager and lazy values when loading a wide prefix of JSON values through the ParserEngine.
+Eager values are decoded and deserialized when they are received, lazy values only when they are read.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench_lazy_values --keys 100000 --read-ratio 0.01
+"""
+import argparse
+import gc
+import logging
+import time
+import tracemalloc
+
+from state_sync.sync_logger import logger
+from state_sync.watcher import WatchForChanges
+from state_sync.parser_engine import ParserEngine
+from state_sync.fake_etcd import FakeEtcdClient
+
+KEYS = {"/customer_config/": {"call_back_type": "PREFIX", "serialization": "JSON"}}
+
+
+def run(etcd_client: FakeEtcdClient, lazy_values: bool, read_keys: list) -> dict:
+    gc.collect()
+    tracemalloc.start()
+    started = time.perf_counter()
+    watcher = WatchForChanges(host='localhost', port=2379, number_of_retries=1, retry_interval=1,
+                              lazy_values=lazy_values, etcd_client=etcd_client)
+    parser_engine = ParserEngine(keys=KEYS)
+    watcher.attach(parser_engine)
+    watcher.start_watch_keys(keys=dict(KEYS))
+    load_time = time.perf_counter() - started
+    load_memory, _ = tracemalloc.get_traced_memory()
+
+    snapshot = parser_engine.snapshot()
+    started = time.perf_counter()
+    for key in read_keys:
+        assert snapshot[key]['limits']['rate'] == 100
+    read_time = time.perf_counter() - started
+    read_memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(snapshot) == len(watcher.snapshot())
+    watcher.close_connection()
+    return {'load_time': load_time, 'load_memory': load_memory, 'read_time': read_time, 'read_memory': read_memory}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--read-ratio', type=float, default=0.01)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    etcd_client = FakeEtcdClient()
+    keys = [f"/customer_config/customer{i}/" for i in range(args.keys)]
+    for i, key in enumerate(keys):
+        etcd_client.put(key, f'{{"customer_id": {i}, "limits": {{"rate": 100, "burst": 200}}, "tier": "standard"}}')
+    read_keys = keys[::max(1, int(1 / args.read_ratio))] if args.read_ratio else []
+
+    print(f"keys: {args.keys} - keys read: {len(read_keys)}")
+    for name, lazy_values in (('eager', False), ('lazy', True)):
+        result = run(etcd_client, lazy_values=lazy_values, read_keys=read_keys)
+        print(f"{name:5} : load {result['load_time'] * 1000:8.1f} ms {result['load_memory'] / 2 ** 20:7.1f} MiB"
+              f" - read {result['read_time'] * 1000:8.1f} ms {result['read_memory'] / 2 ** 20:7.1f} MiB")
+
+
+if __name__ == '__main__':
+    main()
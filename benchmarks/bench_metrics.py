@@ -0,0 +1,111 @@
+"""Measures the cost of the instrumentation on the watch callback, with the metrics disabled and enabled.
+Both are compared to a baseline watcher whose callback has no instrumentation at all, so the overhead of the
+disabled metrics is measured too.
+The logger is set to WARNING, so the lazy debug and info messages are not formatted.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench_metrics --events 100000 --events-per-response 10
+"""
+import argparse
+import gc
+import logging
+import time
+
+from etcd3.events import PutEvent, DeleteEvent
+
+from state_sync.abstract_observer import Observer, ChangeBatch, DELETED
+from state_sync.sync_logger import logger
+from state_sync.watcher import WatchForChanges
+from state_sync.fake_etcd import create_watch_response
+
+
+class CountingObserver(Observer):
+    def __init__(self):
+        self.count = 0
+
+    def update_received(self, key: str, value: str) -> None:
+        self.count += 1
+
+
+class UninstrumentedWatcher(WatchForChanges):
+    """The watcher callback without the metrics checks, the receive timestamp and the event counters."""
+
+    def callback(self, event, watch_key: str = None) -> None:
+        logger.info('The Etcd callback detected new changes.')
+        response_revision = event.events[-1].mod_revision if event.events else event.header.revision
+        changes = ChangeBatch(revision=response_revision)
+        updates = {}
+        with self._apply_lock:
+            for watch_event in event.events:
+                if isinstance(watch_event, PutEvent):
+                    key = watch_event.key.decode('utf-8')
+                    value = self._to_value(watch_event.value)
+                    if self._apply_put(key=key, value=value, mod_revision=watch_event.mod_revision,
+                                       updates=updates, changes=changes, lease=watch_event.lease):
+                        changes.pop(key, None)
+                        changes[key] = value
+                elif isinstance(watch_event, DeleteEvent):
+                    key = watch_event.key.decode('utf-8')
+                    if self._apply_delete(key=key, mod_revision=watch_event.mod_revision, updates=updates):
+                        changes.pop(key, None)
+                        changes[key] = DELETED
+            self._publish_snapshot(updates=updates, revision=response_revision)
+            self._publish_changes(changes=changes, partition_key=watch_key)
+        if watch_key is not None and response_revision > self.watch_revision_map.get(watch_key, 0):
+            self.watch_revision_map[watch_key] = response_revision
+            self._persist(updates=updates, watch_revisions={watch_key: response_revision})
+        elif updates:
+            self._persist(updates=updates)
+
+
+def create_responses(events: int, events_per_response: int) -> list:
+    return [create_watch_response({f"/customer_config/customer{i}/": '{"limits": {"rate": 100}}'
+                                   for i in range(start, min(start + events_per_response, events))},
+                                  revision=revision)
+            for revision, start in enumerate(range(0, events, events_per_response), start=2)]
+
+
+def run(responses: list, metrics_enabled: bool, watcher_class=WatchForChanges) -> float:
+    gc.collect()
+    watcher = watcher_class(host='localhost', port=2379, number_of_retries=1, retry_interval=1,
+                              metrics_enabled=metrics_enabled)
+    # The responses are passed to the callback directly, so the keys are defined without adding watches.
+    watcher.watch_keys = {"/customer_config/": {"call_back_type": "PREFIX"}}
+    observer = CountingObserver()
+    watcher.attach(observer)
+    started = time.perf_counter()
+    for response in responses:
+        watcher.callback(response, watch_key="/customer_config/")
+    elapsed = time.perf_counter() - started
+    assert observer.count == sum(len(response.events) for response in responses)
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--events-per-response', type=int, default=10)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    responses = create_responses(args.events, args.events_per_response)
+    print(f"events: {args.events} - events per response: {args.events_per_response} - best of {args.rounds}")
+    modes = (('uninstrumented', False, UninstrumentedWatcher), ('metrics disabled', False, WatchForChanges),
+             ('metrics enabled', True, WatchForChanges))
+    results = {name: float('inf') for name, _, _ in modes}
+    # The modes are interleaved, so all of them are measured under the same conditions.
+    for _ in range(args.rounds):
+        for name, metrics_enabled, watcher_class in modes:
+            results[name] = min(results[name], run(responses, metrics_enabled=metrics_enabled,
+                                                   watcher_class=watcher_class))
+    for name, _, _ in modes:
+        print(f"{name:16} : {results[name] * 1000:8.1f} ms  {args.events / results[name]:10.0f} events/s")
+    for name in ('metrics disabled', 'metrics enabled'):
+        overhead = results[name] / results['uninstrumented'] - 1
+        print(f"{name + ' overhead':25} : {overhead * 100:6.1f} %")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,83 @@
+"""Compares broadcasting every change to observers filtering the keys themselves against observers attached with a
+key, whose changes are routed through the prefix index of the Subject.
+The observers are then detached one by one, each detach followed by a notification, as when the observers come and
+go while the changes keep flowing.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench_observers --observers 1000 --batches 1000
+"""
+import argparse
+import logging
+import time
+
+from state_sync.abstract_observer import Observer, Subject
+from state_sync.sync_logger import logger
+
+
+class CountingObserver(Observer):
+    def __init__(self, key: str = None):
+        self.key = key
+        self.received_count = 0
+
+    def update_received(self, key: str, value: str) -> None:
+        self.received_count += 1
+
+    def update_batch(self, changes: dict) -> None:
+        self.received_count += len(changes)
+
+
+class BroadcastObserver(CountingObserver):
+    def update_batch(self, changes: dict) -> None:
+        # It receives every change and filters the key it cares about.
+        if self.key in changes:
+            self.received_count += 1
+
+
+class Notifier(Subject):
+    pass
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--observers', type=int, default=1000)
+    parser.add_argument('--batches', type=int, default=1000)
+    parser.add_argument('--batch-size', type=int, default=10)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    keys = [f"/customer_config/customer{i}/" for i in range(args.observers)]
+    batches = [{keys[(batch * args.batch_size + i) % args.observers]: i for i in range(args.batch_size)}
+               for batch in range(args.batches)]
+
+    results = {}
+    for mode in ('broadcast', 'indexed'):
+        notifier = Notifier()
+        observers = [BroadcastObserver(key=key) if mode == 'broadcast' else CountingObserver(key=key)
+                     for key in keys]
+        for observer in observers:
+            if mode == 'broadcast':
+                notifier.attach(observer)
+            else:
+                notifier.attach(observer, key=observer.key)
+        started = time.perf_counter()
+        for batch in batches:
+            notifier.notify_batch(batch)
+        results[mode] = (time.perf_counter() - started) / args.batches
+        assert sum(observer.received_count for observer in observers) == args.batches * args.batch_size
+
+        started = time.perf_counter()
+        for index, observer in enumerate(observers):
+            notifier.detach(observer)
+            notifier.notify_batch(batches[index % args.batches])
+        results[f"{mode} detach"] = (time.perf_counter() - started) / args.observers
+
+    print(f"observers: {args.observers} - changed keys per batch: {args.batch_size}")
+    print(f"broadcast : {results['broadcast'] * 1e6:10.1f} us per batch - "
+          f"detach + notify {results['broadcast detach'] * 1e6:8.2f} us")
+    print(f"indexed   : {results['indexed'] * 1e6:10.1f} us per batch - "
+          f"detach + notify {results['indexed detach'] * 1e6:8.2f} us")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+"""Compares publishing a new snapshot by copying a dict against the structural sharing of ConfigSnapshot.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench_snapshot --keys 100000 --batch-size 10
+"""
+import argparse
+import time
+
+from state_sync.config_snapshot import ConfigSnapshot
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=10)
+    parser.add_argument('--batches', type=int, default=200)
+    args = parser.parse_args()
+
+    data = {f"/customer_config/customer{i}/": i for i in range(args.keys)}
+    batches = [{f"/customer_config/customer{(batch * args.batch_size + i) % args.keys}/": -i
+                for i in range(args.batch_size)} for batch in range(args.batches)]
+
+    started = time.perf_counter()
+    copied = data
+    for batch in batches:
+        copied = dict(copied)
+        copied.update(batch)
+    copy_time = (time.perf_counter() - started) / args.batches
+
+    snapshot = ConfigSnapshot().evolve(updates=data, revision=1)
+    started = time.perf_counter()
+    for revision, batch in enumerate(batches, start=2):
+        snapshot = snapshot.evolve(updates=batch, revision=revision)
+    evolve_time = (time.perf_counter() - started) / args.batches
+    assert dict(snapshot.items()) == copied
+
+    print(f"keys: {args.keys} - changed keys per batch: {args.batch_size}")
+    print(f"dict copy : {copy_time * 1e6:10.1f} us per batch")
+    print(f"evolve    : {evolve_time * 1e6:10.1f} us per batch")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,78 @@
+"""Compares one watch per defined key against the minimized watch set.
+
+Run it from the repository root:
+
+    python -m benchmarks.bench_watch_plan --keys 5000
+"""
+import argparse
+import logging
+import time
+
+from state_sync.abstract_observer import Observer
+from state_sync.sync_logger import logger
+from state_sync.watcher import WatchForChanges
+from state_sync.fake_etcd import FakeEtcdClient
+
+
+class CountingObserver(Observer):
+    def __init__(self):
+        self.updates_count = 0
+
+    def update_received(self, key: str, value: str) -> None:
+        self.updates_count += 1
+
+
+def run(keys: dict, customer_keys: list, minimize: bool):
+    etcd_client = FakeEtcdClient()
+    watcher = WatchForChanges(host='localhost', port=2379, number_of_retries=1, retry_interval=1,
+                              etcd_client=etcd_client)
+    observer = CountingObserver()
+    watcher.attach(observer)
+    callback_calls = [0]
+    watcher_callback = watcher.callback
+
+    def counting_callback(event, watch_key=None):
+        callback_calls[0] += 1
+        watcher_callback(event, watch_key=watch_key)
+
+    watcher.callback = counting_callback
+
+    if minimize:
+        watcher.start_watch_keys(keys=keys, bootstrap=False)
+    else:
+        # The previous behaviour: one watch per defined key.
+        watcher.watch_keys = keys
+        for watch_key, key_object in keys.items():
+            watcher._add_watch(watch_key=watch_key, key_object=key_object)
+
+    started = time.perf_counter()
+    for key in customer_keys:
+        etcd_client.put(key, '{"limits": {"rate": 100}}')
+    elapsed = time.perf_counter() - started
+    return len(etcd_client._watches), callback_calls[0], observer.updates_count, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--keys', type=int, default=5000)
+    args = parser.parse_args()
+    logger.setLevel(logging.WARNING)
+
+    customer_keys = [f"/customer_config/customer{i}/" for i in range(args.keys)]
+    keys = {key: {"serialization": "JSON"} for key in customer_keys}
+    keys.update({
+        "/spacecrafts/orbit/": None,
+        "/spacecrafts/": {"call_back_type": "PREFIX"},
+        "/customer_config/": {"call_back_type": "PREFIX"},
+    })
+
+    print(f"defined keys: {len(keys)} - puts: {len(customer_keys)}")
+    for name, minimize in (('watch per key', False), ('minimized', True)):
+        watches_count, callback_calls, updates_count, elapsed = run(keys=keys, customer_keys=customer_keys,
+                                                                    minimize=minimize)
+        print(f"{name:14}: {watches_count:6d} watches  {callback_calls:6d} callback calls  "
+              f"{updates_count:6d} observer updates  {elapsed * 1000:8.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
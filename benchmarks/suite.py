@@ -0,0 +1,213 @@
+"""A reproducible benchmark suite running offline against the in-process FakeEtcdClient.
+It reports the callback throughput through the ParserEngine, the p50/p99 propagation latency, the memory per
+watched key and the reconnect recovery time. The results can be saved and compared with a previous run.
+
+Run it from the repository root:
+
+    python -m benchmarks.suite --output results.json
+    python -m benchmarks.suite --baseline results.json
+"""
+import argparse
+import gc
+import json
+import logging
+import statistics
+import time
+import tracemalloc
+
+from state_sync.abstract_observer import Observer
+from state_sync.sync_logger import logger
+from state_sync.watcher import WatchForChanges
+from state_sync.parser_engine import ParserEngine
+from state_sync.fake_etcd import FakeEtcdClient, create_watch_response
+
+PREFIX = "/customer_config/"
+KEYS = {PREFIX: {"call_back_type": "PREFIX", "serialization": "JSON"}}
+VALUE = '{{"customer_id": {}, "limits": {{"rate": 100, "burst": 200}}, "tier": "standard"}}'
+
+
+class ReceiveTimeObserver(Observer):
+    """It records when each key is received, to measure the propagation latency."""
+
+    def __init__(self):
+        self.received_at = {}
+
+    def update_received(self, key: str, value: str) -> None:
+        self.received_at[key] = time.perf_counter()
+
+    def update_batch(self, changes: dict) -> None:
+        received_at = time.perf_counter()
+        for key in changes:
+            self.received_at[key] = received_at
+
+
+def customer_key(index: int) -> str:
+    return f"{PREFIX}customer{index}/"
+
+
+def create_watcher(etcd_client: FakeEtcdClient, lazy_values: bool = False):
+    watcher = WatchForChanges(host='localhost', port=2379, number_of_retries=1, retry_interval=1,
+                              lazy_values=lazy_values, etcd_client=etcd_client)
+    parser_engine = ParserEngine(keys=KEYS)
+    watcher.attach(parser_engine)
+    return watcher, parser_engine
+
+
+def percentile(values: list, percent: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * percent / 100))]
+
+
+def bench_throughput(events: int, events_per_response: int) -> dict:
+    responses = [create_watch_response({customer_key(i): VALUE.format(i)
+                                        for i in range(start, min(start + events_per_response, events))},
+                                       revision=revision)
+                 for revision, start in enumerate(range(0, events, events_per_response), start=2)]
+    watcher, parser_engine = create_watcher(FakeEtcdClient())
+    # The responses are passed to the callback directly, so the keys are defined without adding watches.
+    watcher.watch_keys = dict(KEYS)
+    gc.collect()
+    started = time.perf_counter()
+    for response in responses:
+        watcher.callback(response, watch_key=PREFIX)
+    elapsed = time.perf_counter() - started
+    assert len(parser_engine.snapshot()) == events
+    return {'events': events, 'events_per_response': events_per_response, 'events_per_second': events / elapsed}
+
+
+def bench_latency(events: int, interval: float, use_dispatcher: bool) -> dict:
+    etcd_client = FakeEtcdClient()
+    watcher, parser_engine = create_watcher(etcd_client)
+    observer = ReceiveTimeObserver()
+    # The ParserEngine is notified first, so the receive time includes its work.
+    watcher.attach(observer)
+    watcher.start_watch_keys(keys=dict(KEYS))
+    if use_dispatcher:
+        watcher.start_dispatcher()
+    written_at = {}
+    for i in range(events):
+        key = customer_key(i)
+        written_at[key] = time.perf_counter()
+        etcd_client.put(key, VALUE.format(i))
+        if interval:
+            time.sleep(interval)
+    watcher.stop_dispatcher()
+    latencies = [observer.received_at[key] - started for key, started in written_at.items()]
+    return {'events': events, 'p50_ms': percentile(latencies, 50) * 1000, 'p99_ms': percentile(latencies, 99) * 1000}
+
+
+def bench_memory(keys: int, lazy_values: bool) -> dict:
+    etcd_client = FakeEtcdClient()
+    etcd_client.put_many({customer_key(i): VALUE.format(i) for i in range(keys)})
+    gc.collect()
+    tracemalloc.start()
+    watcher, parser_engine = create_watcher(etcd_client, lazy_values=lazy_values)
+    watcher.start_watch_keys(keys=dict(KEYS))
+    gc.collect()
+    memory, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    assert len(parser_engine.snapshot()) == keys
+    return {'keys': keys, 'lazy_values': lazy_values, 'bytes_per_key': memory / keys}
+
+
+def bench_reconnect(keys: int, missed_changes: int, rounds: int) -> dict:
+    etcd_client = FakeEtcdClient()
+    etcd_client.put_many({customer_key(i): VALUE.format(i) for i in range(keys)})
+    watcher, parser_engine = create_watcher(etcd_client)
+    watcher.start_watch_keys(keys=dict(KEYS))
+    recovery_times = []
+    for round_number in range(rounds):
+        etcd_client.disconnect()
+        assert watcher.etcd_connection_obj.is_connection_failed_with_etcd
+        changed_values = {customer_key(i): VALUE.format(-round_number) for i in range(missed_changes)}
+        for key, value in changed_values.items():
+            etcd_client.put(key, value)
+        etcd_client.reconnect()
+        started = time.perf_counter()
+        watcher.on_failure_connect_with_etcd_and_continue_watch_for_changes()
+        recovery_times.append(time.perf_counter() - started)
+        snapshot = parser_engine.snapshot()
+        assert all(snapshot[key]['customer_id'] == -round_number for key in changed_values)
+    return {'keys': keys, 'missed_changes': missed_changes,
+            'recovery_ms': statistics.median(recovery_times) * 1000}
+
+
+def run_suite(args) -> dict:
+    results = {'throughput': [], 'latency': [], 'memory': [], 'reconnect': []}
+    for events_per_response in (1, 100):
+        results['throughput'].append(bench_throughput(args.events, events_per_response))
+    for use_dispatcher in (False, True):
+        result = bench_latency(args.latency_events, args.latency_interval_ms / 1000, use_dispatcher)
+        result['dispatcher'] = use_dispatcher
+        results['latency'].append(result)
+    for keys in args.memory_keys:
+        for lazy_values in (False, True):
+            results['memory'].append(bench_memory(keys, lazy_values))
+    results['reconnect'].append(bench_reconnect(args.reconnect_keys, args.missed_changes, args.rounds))
+    return results
+
+
+# The fields identifying a result, so it is compared with the same measurement of the baseline.
+RESULT_FIELDS = {
+    'throughput': ('events_per_response',),
+    'latency': ('dispatcher',),
+    'memory': ('keys', 'lazy_values'),
+    'reconnect': ('missed_changes',),
+}
+
+
+def print_results(results: dict, baseline: dict = None) -> None:
+    def compare(section: str, index: int, metric: str) -> str:
+        result = results[section][index]
+        fields = RESULT_FIELDS[section]
+        previous = next((previous_result[metric] for previous_result in (baseline or {}).get(section, [])
+                         if all(previous_result.get(field) == result[field] for field in fields)), None)
+        if not previous:
+            return ''
+        return f"  ({(result[metric] / previous - 1) * 100:+6.1f} %)"
+
+    for index, result in enumerate(results['throughput']):
+        print(f"throughput  {result['events_per_response']:4d} events/response : "
+              f"{result['events_per_second']:10.0f} events/s{compare('throughput', index, 'events_per_second')}")
+    for index, result in enumerate(results['latency']):
+        mode = 'dispatcher' if result['dispatcher'] else 'callback  '
+        print(f"latency     {mode}            : p50 {result['p50_ms']:8.3f} ms{compare('latency', index, 'p50_ms')}"
+              f"  p99 {result['p99_ms']:8.3f} ms{compare('latency', index, 'p99_ms')}")
+    for index, result in enumerate(results['memory']):
+        mode = 'lazy ' if result['lazy_values'] else 'eager'
+        print(f"memory      {result['keys']:7d} keys {mode}      : "
+              f"{result['bytes_per_key']:10.0f} bytes/key{compare('memory', index, 'bytes_per_key')}")
+    for index, result in enumerate(results['reconnect']):
+        print(f"reconnect   {result['missed_changes']:5d} missed changes   : "
+              f"{result['recovery_ms']:10.3f} ms{compare('reconnect', index, 'recovery_ms')}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=100000)
+    parser.add_argument('--latency-events', type=int, default=2000)
+    parser.add_argument('--latency-interval-ms', type=float, default=0.2)
+    parser.add_argument('--memory-keys', type=lambda value: [int(keys) for keys in value.split(',')],
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--reconnect-keys', type=int, default=10000)
+    parser.add_argument('--missed-changes', type=int, default=1000)
+    parser.add_argument('--rounds', type=int, default=5)
+    parser.add_argument('--output', help='Saves the results as JSON.')
+    parser.add_argument('--baseline', help='Compares the results with the ones saved by a previous run.')
+    args = parser.parse_args()
+    # The simulated outages log errors, which are expected here.
+    logger.setLevel(logging.CRITICAL)
+
+    results = run_suite(args)
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+    print_results(results, baseline=baseline)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
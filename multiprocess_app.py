@@ -0,0 +1,60 @@
+import multiprocessing
+import os
+import time
+
+from state_sync.sync_logger import logger
+from state_sync.host_agent import HostAgent
+from state_sync.shared_snapshot import SharedSnapshotReader
+
+
+def run_agent(keys_for_watch: dict) -> None:
+    # Only this process watches etcd and deserializes the values.
+    agent = HostAgent(keys=keys_for_watch,
+                      watcher_kwargs={'host': 'localhost', 'port': 2379, 'number_of_retries': 3,
+                                      'retry_interval': 10})
+    agent.run()
+
+
+def run_worker() -> None:
+    reader = None
+    while reader is None:
+        try:
+            reader = SharedSnapshotReader()
+        except FileNotFoundError:
+            # The agent has not published its first snapshot yet.
+            time.sleep(0.1)
+
+    for i in range(0, 50000):
+
+        # Performing business logic processing.
+        time.sleep(1)
+
+        # Checking for a new snapshot only reads its sequence from the shared memory.
+        if reader.has_changed():
+            snapshot = reader.snapshot()
+            logger.info(f"Worker {os.getpid()} config at revision {snapshot.revision} : {dict(snapshot)}")
+
+    reader.close()
+
+
+def main():
+    keys_for_watch = {
+        "feature": None,
+        "/customer_config/": {"call_back_type": "PREFIX", "serialization": "JSON"},
+    }
+
+    agent_process = multiprocessing.Process(target=run_agent, args=(keys_for_watch,), name='state_sync_agent')
+    agent_process.start()
+
+    workers = [multiprocessing.Process(target=run_worker) for _ in range(4)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    agent_process.terminate()
+    agent_process.join()
+
+
+if __name__ == '__main__':
+    main()
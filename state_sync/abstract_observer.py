@@ -1,6 +1,56 @@
+import threading
 from abc import ABC, abstractmethod
+from operator import itemgetter
+from typing import Iterator
 
 from .sync_logger import logger
+from .key_index import KeyIndex
+
+
+class _Deleted:
+    """The value of a removed key in the changes passed to the observers."""
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return 'DELETED'
+
+    def __reduce__(self) -> str:
+        return 'DELETED'
+
+
+# A key deleted in etcd, expired with its lease or evicted from a bounded KeyStore.
+DELETED = _Deleted()
+
+
+class ChangeBatch(dict):
+    """A dict of the changes applied together, mapping each changed key to its latest value, or to DELETED when
+    the key has been removed.
+    The revision is the etcd revision the batch brings the config to, when it is known.
+    The received_at is the time.perf_counter() at which its oldest change was received, when metrics are enabled.
+    """
+
+    def __init__(self, *args, revision: int = None, received_at: float = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.revision = revision
+        self.received_at = received_at
+
+    def merged(self, changes: dict) -> 'ChangeBatch':
+        """It returns a new batch with the changes applied after the ones of this batch.
+
+        :param changes:
+        :return:
+        """
+        merged_batch = ChangeBatch(self, revision=self.revision, received_at=self.received_at)
+        for key, value in changes.items():
+            merged_batch.pop(key, None)
+            merged_batch[key] = value
+        revision = getattr(changes, 'revision', None)
+        if revision is not None and (merged_batch.revision is None or revision > merged_batch.revision):
+            merged_batch.revision = revision
+        received_at = getattr(changes, 'received_at', None)
+        if received_at is not None and (merged_batch.received_at is None or received_at < merged_batch.received_at):
+            merged_batch.received_at = received_at
+        return merged_batch
 
 
 class Observer(ABC):
@@ -8,16 +58,181 @@ class Observer(ABC):
     def update_received(self, key: str, value: str) -> None:
         raise NotImplementedError("Not implemented.")
 
+    def update_batch(self, changes: dict) -> None:
+        """It receives the changes applied together, in the order they were applied.
+        Override it to handle a whole batch at once, by default each change is passed to update_received.
+
+        :param changes: A dict mapping each changed key to its latest value, or to DELETED.
+        :return:
+        """
+        for key, value in changes.items():
+            if value is DELETED:
+                self.delete_received(key)
+            else:
+                self.update_received(key, value)
+
+    def delete_received(self, key: str) -> None:
+        """It receives the removal of a key deleted in etcd, expired with its lease or evicted from the bounded
+        key store. Override it to drop what was derived from the key, by default it is ignored.
+
+        :param key:
+        :return:
+        """
+
+
+class PathObserver(ABC):
+    @abstractmethod
+    def update_path(self, key: str, path: tuple, old_value, new_value) -> None:
+        """It receives the change of the value at a path of a deserialized document.
+
+        :param key: The key of the document.
+        :param path: The subscribed path, as a tuple of keys and list indexes.
+        :param old_value: The previous value at the path, or json_diff.MISSING when it did not exist.
+        :param new_value: The new value at the path, or json_diff.MISSING when it has been removed.
+        :return:
+        """
+        raise NotImplementedError("Not implemented.")
+
+
+class AsyncObserver(ABC):
+    @abstractmethod
+    async def update_received(self, key: str, value: str) -> None:
+        raise NotImplementedError("Not implemented.")
+
 
 class Subject(ABC):
+    """It notifies the attached observers of the changes.
+    An observer attached with a key or a prefix only receives the changes of the matching keys. The filters are
+    kept in a KeyIndex, so routing a change takes O(len(key)) and only the matching observers are visited.
+    The observers can be attached and detached while changes are being notified: a notification uses the observers
+    attached when it started, and an observer detached meanwhile is not called anymore.
+    """
+
     def __init__(self):
-        self._observers = []
+        self._subscriptions_lock = threading.Lock()
+        # It maps the id of each attached observer to its (observer, rule, attach order).
+        # The rule is a (rule_key, is_prefix) tuple, or None when the observer receives all the changes.
+        self._subscriptions = {}
+        self._attach_count = 0
+        # It maps each rule to a dict mapping the attach order of each of its observers to their id, in the attach
+        # order. The same dict is the payload of the rule in the index, so attaching and detaching take O(1).
+        self._subscription_index = KeyIndex()
+        self._rule_observer_ids = {}
+        # The (attach order, observer) tuples of the observers without a filter, in the attach order, with the set of
+        # the attach orders detached since. The detached ones are skipped by the notifications and compacted once
+        # they are half of the list, so attaching and detaching take O(1) whatever the number of observers.
+        # The pair is replaced on compaction, so a notification keeps using the one it started with.
+        self._unfiltered_plan = ([], set())
+        # It maps the id of each filtered observer to its (attach order, observer).
+        self._filtered_observers = {}
+
+    @property
+    def observers(self) -> tuple:
+        with self._subscriptions_lock:
+            unfiltered_observers, detached_orders = self._unfiltered_plan
+            subscriptions = [subscription for subscription in unfiltered_observers
+                             if subscription[0] not in detached_orders]
+            subscriptions.extend(self._filtered_observers.values())
+        return tuple(observer for _, observer in sorted(subscriptions, key=itemgetter(0)))
 
-    def attach(self, observer) -> None:
-        self._observers.append(observer)
+    def attach(self, observer, key: str = None, prefix: str = None) -> None:
+        """Attaching an observer again replaces its filter. The observers are notified in the attach order.
+
+        :param observer:
+        :param key: When it is set, the observer only receives the changes of this key.
+        :param prefix: When it is set, the observer only receives the changes of the keys starting with it.
+        :return:
+        """
+        if key is not None and prefix is not None:
+            raise ValueError("An observer can be attached with a key or a prefix, not both.")
+        rule = None
+        if key is not None:
+            rule = (key, False)
+        elif prefix is not None:
+            rule = (prefix, True)
+        with self._subscriptions_lock:
+            if id(observer) in self._subscriptions:
+                self._remove_subscription(observer)
+            self._attach_count += 1
+            self._subscriptions[id(observer)] = (observer, rule, self._attach_count)
+            if rule is None:
+                self._unfiltered_plan[0].append((self._attach_count, observer))
+            else:
+                self._filtered_observers[id(observer)] = (self._attach_count, observer)
+                observer_ids = self._rule_observer_ids.get(rule)
+                if observer_ids is None:
+                    observer_ids = self._rule_observer_ids[rule] = {}
+                    self._subscription_index.add(rule[0], payload=observer_ids, is_prefix=rule[1])
+                observer_ids[self._attach_count] = id(observer)
 
     def detach(self, observer) -> None:
-        self._observers.remove(observer)
+        """
+
+        :param observer:
+        :return:
+        """
+        with self._subscriptions_lock:
+            if id(observer) not in self._subscriptions:
+                raise ValueError("The observer is not attached.")
+            self._remove_subscription(observer)
+
+    def _remove_subscription(self, observer) -> None:
+        _, rule, order = self._subscriptions.pop(id(observer))
+        if rule is None:
+            unfiltered_observers, detached_orders = self._unfiltered_plan
+            detached_orders.add(order)
+            if len(detached_orders) * 2 > len(unfiltered_observers):
+                self._unfiltered_plan = ([subscription for subscription in unfiltered_observers
+                                          if subscription[0] not in detached_orders], set())
+            return
+        del self._filtered_observers[id(observer)]
+        observer_ids = self._rule_observer_ids[rule]
+        del observer_ids[order]
+        if not observer_ids:
+            del self._rule_observer_ids[rule]
+            self._subscription_index.remove(rule[0], is_prefix=rule[1])
+
+    def route_changes(self, changes: dict) -> Iterator[tuple]:
+        """It splits the changes between the observers.
+        The observers without a filter receive the changes as they are, and the filtered observers receive a batch
+        of their matching keys only, with the same revision. The observers without a matching key are left out.
+        An observer detached while the tuples are being consumed is skipped.
+
+        :param changes: A dict mapping each changed key to its latest value.
+        :return: The (observer, changes) tuples in the attach order.
+        """
+        # The observers attached after the notification started are left out.
+        last_order = self._attach_count
+        unfiltered_observers, detached_orders = self._unfiltered_plan
+        unfiltered_observers = [(order, observer) for order, observer in unfiltered_observers
+                                if order <= last_order and order not in detached_orders]
+        filtered_observers = self._filtered_observers
+        observer_changes = {}
+        if filtered_observers:
+            revision = getattr(changes, 'revision', None)
+            received_at = getattr(changes, 'received_at', None)
+            for key, value in changes.items():
+                for _, observer_ids in self._subscription_index.match(key):
+                    # The dict is copied at once, as it may be changed by another thread meanwhile.
+                    for observer_id in tuple(observer_ids.values()):
+                        batch = observer_changes.get(observer_id)
+                        if batch is None:
+                            batch = observer_changes[observer_id] = ChangeBatch(revision=revision,
+                                                                                received_at=received_at)
+                        batch[key] = value
+        routed_changes = [(order, observer, changes) for order, observer in unfiltered_observers]
+        if observer_changes:
+            for observer_id, batch in observer_changes.items():
+                subscription = filtered_observers.get(observer_id)
+                if subscription is not None and subscription[0] <= last_order:
+                    routed_changes.append((subscription[0], subscription[1], batch))
+            routed_changes.sort(key=itemgetter(0))
+        subscriptions = self._subscriptions
+        for order, observer, observer_changes in routed_changes:
+            # The liveness is checked right before the call, as the previous observers may have detached it.
+            subscription = subscriptions.get(id(observer))
+            if subscription is not None and subscription[2] == order:
+                yield observer, observer_changes
 
     def notify_state_change(self, key: str, value: str) -> None:
         """
@@ -26,6 +241,25 @@ class Subject(ABC):
         :param value:
         :return:
         """
-        logger.debug(f"Notifier called : key : '{key}' - value : '{value}'")
-        for observer in self._observers:
-            observer.update_received(key, value)
+        logger.debug("Notifier called : key : '%s' - value : '%s'", key, value)
+        for observer, _ in self.route_changes({key: value}):
+            try:
+                if value is DELETED:
+                    observer.delete_received(key)
+                else:
+                    observer.update_received(key, value)
+            except Exception as e:
+                logger.error(f"Observer exception in {type(observer).__name__} on key '{key}': {e}")
+
+    def notify_batch(self, changes: dict) -> None:
+        """An observer raising an exception does not keep the batch from the next observers.
+
+        :param changes: A dict mapping each changed key to its latest value.
+        :return:
+        """
+        logger.debug("Notifier called : %s changes.", len(changes))
+        for observer, observer_changes in self.route_changes(changes):
+            try:
+                observer.update_batch(observer_changes)
+            except Exception as e:
+                logger.error(f"Observer exception in {type(observer).__name__}: {e}")
@@ -1,9 +1,78 @@
 import logging
+import os
 
+# The keys under a prefix key are stored whatever its value. It only decides whether the keys that no defined key covers
+# are stored.
 ADD_NEW_WATCH_CHANGES_ON_PREFIX = False
-SERIALIZATION_SUPPORT = ['JSON']
+# The bounds of the keys discovered under a prefix key, rather than defined themselves.
+# The least recently written ones are evicted beyond them. None is unbounded.
+MAX_DISCOVERED_KEYS = None
+# The size of the discovered keys and of their values, in bytes.
+MAX_DISCOVERED_BYTES = None
+# The formats registered by the deserializer registry. YAML, TOML and MSGPACK need their library installed.
+SERIALIZATION_SUPPORT = ['JSON', 'YAML', 'TOML', 'MSGPACK']
+
+# When it is enabled, the values keep the raw bytes received from etcd and they are decoded and deserialized
+# only when they are read. The observers then receive LazyValue objects, read through their 'value' attribute.
+LAZY_VALUES = False
+
+# When it is enabled, the watchers collect the event, byte and latency counters returned by watcher.stats().
+METRICS_ENABLED = False
+
+# Deserialization cache details
+# Identical payloads are deserialized once, and the parsed object is shared between the keys.
+DESERIALIZER_CACHE_MAX_ENTRIES = 10000
+# The total size of the cached payloads in bytes.
+DESERIALIZER_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Bootstrap details
+# etcd rejects transactions with more operations than its --max-txn-ops flag (128 by default).
+BOOTSTRAP_MAX_TXN_OPS = 128
+# The maximum number of keys read per range request of a prefix. The prefixes are read page by page, so a large prefix
+# stays under the gRPC receive message size limit (4 MiB by default).
+BOOTSTRAP_RANGE_LIMIT = 1000
+
+# Observer dispatcher details
+DISPATCHER_NUMBER_OF_WORKERS = 4
+# The maximum number of pending changes per worker.
+DISPATCHER_QUEUE_SIZE = 10000
+# One of 'BLOCK', 'DROP-OLDEST' or 'COALESCE', see OverflowPolicyEnum.
+DISPATCHER_OVERFLOW_POLICY = 'BLOCK'
+
+# Async watcher details
+# The maximum number of pending changes per async iterator and per async observer.
+ASYNC_QUEUE_SIZE = 10000
+# One of 'DROP-OLDEST' or 'COALESCE', see OverflowPolicyEnum. 'COALESCE' keeps the latest pending change of each key.
+ASYNC_OVERFLOW_POLICY = 'COALESCE'
+
+# Coalescer details
+# The maximum time a change waits before being delivered when only a max_batch_size is given, in seconds.
+COALESCER_MAX_WAIT_SECONDS = 0.1
+
+# Snapshot store details
+# How long the snapshot writer collects the applied batches before saving them in one transaction, in seconds.
+SNAPSHOT_WRITE_INTERVAL_SECONDS = 0.05
+
+# Reconnection details
+# The retry interval doubles after each failed retry up to this number of seconds.
+RECONNECT_MAX_RETRY_INTERVAL = 60
+# How often the connection supervisor checks for a failed connection, in seconds.
+RECONNECT_CHECK_INTERVAL = 1
+
+# Cluster health check details
+# How often each endpoint of the cluster is probed, in seconds.
+HEALTH_CHECK_INTERVAL = 5
+# The weight of the last probe in the smoothed latency of an endpoint.
+HEALTH_CHECK_LATENCY_WEIGHT = 0.3
+
+# Shared snapshot details
+# The shared memory segment the host agent publishes the snapshots into, and the worker processes read from.
+SHARED_SNAPSHOT_NAME = 'state_sync_snapshot'
+# The maximum size of a published snapshot in bytes.
+SHARED_SNAPSHOT_SIZE = 64 * 1024 * 1024
 
 # Logging details
-LOGGING_LEVEL = logging.DEBUG
+# It can be overridden with the STATE_SYNC_LOGGING_LEVEL environment variable, such as 'WARNING'.
+LOGGING_LEVEL = os.environ.get('STATE_SYNC_LOGGING_LEVEL', logging.DEBUG)
 LOGGER_NAME = 'RealtimePyConfigSync'
 
@@ -0,0 +1,207 @@
+import asyncio
+from collections import OrderedDict, deque
+from typing import Any, AsyncIterator, NamedTuple, Optional
+
+from .sync_logger import logger
+from .abstract_observer import AsyncObserver, Observer, DELETED
+from .dispatcher import OverflowPolicyEnum
+from .watcher import WatchForChanges
+from .app_config import ASYNC_QUEUE_SIZE, ASYNC_OVERFLOW_POLICY
+
+
+class Change(NamedTuple):
+    """A change handed to the coroutines.
+    The value is the str received from etcd, a LazyValue when the watcher has lazy_values enabled, or DELETED when
+    the key has been removed.
+    """
+    key: str
+    value: Any
+
+
+class _ChangeQueue(asyncio.Queue):
+    """A bounded queue of changes that never blocks the event loop. When it is full, the oldest change is dropped
+    or, with COALESCE, a pending change of the same key is replaced. See OverflowPolicyEnum.
+    """
+
+    def __init__(self, maxsize: int, overflow_policy: OverflowPolicyEnum):
+        self.overflow_policy = overflow_policy
+        super().__init__(maxsize=maxsize)
+
+    def _init(self, maxsize: int) -> None:
+        self._queue = OrderedDict() if self.overflow_policy == OverflowPolicyEnum.COALESCE else deque()
+
+    def _put(self, change: Change) -> None:
+        if isinstance(self._queue, OrderedDict):
+            # Keep the keys in the order of their latest change.
+            self._queue.pop(change.key, None)
+            self._queue[change.key] = change
+        else:
+            self._queue.append(change)
+
+    def _get(self) -> Change:
+        if isinstance(self._queue, OrderedDict):
+            return self._queue.popitem(last=False)[1]
+        return self._queue.popleft()
+
+    def offer(self, change: Change) -> Optional[Change]:
+        """
+
+        :param change:
+        :return: The change dropped to make room for this one, or None.
+        """
+        dropped_change = None
+        if self.full() and not (isinstance(self._queue, OrderedDict) and change.key in self._queue):
+            dropped_change = self.get_nowait()
+        self.put_nowait(change)
+        return dropped_change
+
+
+class AsyncWatchForChanges(Observer):
+    """An asyncio front end to WatchForChanges.
+    It attaches itself as an observer and hands every change from the etcd callback thread to the event loop
+    with call_soon_threadsafe, so the changes reach the coroutines without any polling.
+    Each iterator and async observer has a bounded queue, so a slow consumer, or an iterator abandoned without
+    aclose(), never grows the memory without limit. A full queue applies the overflow policy.
+    """
+
+    def __init__(self, watcher: WatchForChanges, loop: Optional[asyncio.AbstractEventLoop] = None,
+                 queue_size: int = ASYNC_QUEUE_SIZE, overflow_policy: str = ASYNC_OVERFLOW_POLICY):
+        """
+
+        :param watcher:
+        :param loop: The event loop receiving the changes. Defaults to the running loop.
+        :param queue_size: The maximum number of pending changes per iterator and per async observer.
+        :param overflow_policy: What to do when a queue is full: 'DROP-OLDEST' or 'COALESCE'.
+        """
+        self.watcher = watcher
+        self._loop = loop if loop is not None else asyncio.get_running_loop()
+        self.queue_size = queue_size
+        self.overflow_policy = OverflowPolicyEnum(overflow_policy)
+        if self.overflow_policy == OverflowPolicyEnum.BLOCK:
+            raise ValueError("The async queues cannot block the etcd callback thread. Use 'DROP-OLDEST' or "
+                             "'COALESCE'.")
+        self.dropped_count = 0
+        self._subscriptions = []
+        self._waiters = {}
+        self._observer_queues = {}
+        self._observer_tasks = {}
+        self.watcher.attach(observer=self)
+
+    def update_received(self, key: str, value: str) -> None:
+        """It runs on the etcd callback thread and only schedules the change on the event loop.
+
+        :param key:
+        :param value:
+        :return:
+        """
+        try:
+            self._loop.call_soon_threadsafe(self._dispatch, Change(key=key, value=value))
+        except RuntimeError as e:
+            logger.error(f"The change on key '{key}' could not be handed to the event loop. {e}")
+
+    def delete_received(self, key: str) -> None:
+        """The removed keys are handed to the coroutines as changes whose value is DELETED.
+
+        :param key:
+        :return:
+        """
+        self.update_received(key=key, value=DELETED)
+
+    def _dispatch(self, change: Change) -> None:
+        """It runs on the event loop and delivers the change to the iterators, waiters and async observers.
+
+        :param change:
+        :return:
+        """
+        for prefix, queue in self._subscriptions:
+            if prefix is None or change.key.startswith(prefix):
+                self._offer(queue=queue, change=change)
+
+        for future in self._waiters.pop(change.key, []):
+            if not future.done():
+                future.set_result(change)
+
+        for queue in self._observer_queues.values():
+            self._offer(queue=queue, change=change)
+
+    def _offer(self, queue: _ChangeQueue, change: Change) -> None:
+        dropped_change = queue.offer(change)
+        if dropped_change is not None:
+            self.dropped_count += 1
+            logger.warning(f"An async queue is full. The change of the key '{dropped_change.key}' has been dropped.")
+
+    def _create_queue(self) -> _ChangeQueue:
+        return _ChangeQueue(maxsize=self.queue_size, overflow_policy=self.overflow_policy)
+
+    async def changes(self, prefix: str = None) -> AsyncIterator[Change]:
+        """It yields every change from now on, optionally only the ones on keys starting with the prefix.
+        Close it with aclose(), such as with contextlib.aclosing(), when it is not consumed until the end.
+
+        :param prefix:
+        :return:
+        """
+        subscription = (prefix, self._create_queue())
+        self._subscriptions.append(subscription)
+        try:
+            while True:
+                yield await subscription[1].get()
+        finally:
+            self._subscriptions.remove(subscription)
+
+    async def wait_for_change(self, key: str, timeout: float = None) -> Change:
+        """It waits for the next change on the key.
+
+        :param key:
+        :param timeout: The maximum number of seconds to wait. None waits forever.
+        :return:
+        :raises asyncio.TimeoutError: When no change happens on the key within the timeout.
+        """
+        future = self._loop.create_future()
+        self._waiters.setdefault(key, []).append(future)
+        try:
+            return await asyncio.wait_for(future, timeout=timeout)
+        finally:
+            waiters = self._waiters.get(key)
+            if waiters and future in waiters:
+                waiters.remove(future)
+                if not waiters:
+                    self._waiters.pop(key)
+
+    def attach_async(self, observer: AsyncObserver) -> None:
+        """It attaches an async observer. The observer receives the changes one at a time and in order.
+
+        :param observer:
+        :return:
+        """
+        queue = self._create_queue()
+        self._observer_queues[observer] = queue
+        self._observer_tasks[observer] = self._loop.create_task(self._run_observer(observer=observer, queue=queue))
+
+    def detach_async(self, observer: AsyncObserver) -> None:
+        """
+
+        :param observer:
+        :return:
+        """
+        self._observer_queues.pop(observer, None)
+        task = self._observer_tasks.pop(observer, None)
+        if task:
+            task.cancel()
+
+    @staticmethod
+    async def _run_observer(observer: AsyncObserver, queue: asyncio.Queue) -> None:
+        while True:
+            change = await queue.get()
+            try:
+                await observer.update_received(change.key, change.value)
+            except Exception as e:
+                logger.error(f"Async observer exception on key '{change.key}': {e}")
+
+    def close(self) -> None:
+        """It detaches from the watcher and stops the async observers.
+
+        :return:
+        """
+        self.watcher.detach(observer=self)
+        for observer in list(self._observer_tasks):
+            self.detach_async(observer=observer)
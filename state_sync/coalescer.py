@@ -0,0 +1,141 @@
+import threading
+import time
+from typing import Callable, Optional
+
+from .sync_logger import logger
+from .abstract_observer import ChangeBatch
+from .app_config import COALESCER_MAX_WAIT_SECONDS
+
+
+class ChangeCoalescer:
+    """It collects the changes over a time window and/or up to a number of keys, keeping only the latest value
+    of each key, and then delivers them as one batch per partition.
+    A batch added with add() is never split across two deliveries. A change never waits longer than the window, which
+    is COALESCER_MAX_WAIT_SECONDS when only max_batch_size is given.
+    """
+
+    def __init__(self, deliver: Callable[[dict, object], None], window_seconds: Optional[float] = None,
+                 max_batch_size: Optional[int] = None):
+        """
+
+        :param deliver: It is called with (changes, partition_key) for each delivered batch.
+        :param window_seconds: The maximum time a change waits before being delivered. It defaults to
+                               COALESCER_MAX_WAIT_SECONDS when max_batch_size is given.
+        :param max_batch_size: The number of pending keys that triggers an immediate delivery.
+        """
+        if window_seconds is None and max_batch_size is None:
+            raise ValueError("Either window_seconds or max_batch_size must be given.")
+        self._deliver = deliver
+        # The changes are never held until enough keys have changed, such as the single key of a quiet config.
+        self.window_seconds = COALESCER_MAX_WAIT_SECONDS if window_seconds is None else window_seconds
+        self.max_batch_size = max_batch_size
+        self._pending = {}
+        self._pending_count = 0
+        self._deadline = None
+        self._condition = threading.Condition()
+        self._timer_thread = None
+        self._is_stopped = False
+        self.received_count = 0
+        self.delivered_count = 0
+        self.batches_count = 0
+
+    def start(self) -> None:
+        """
+
+        :return:
+        """
+        self._timer_thread = threading.Thread(name='state_sync_coalescer', target=self._run, daemon=True)
+        self._timer_thread.start()
+
+    def stop(self) -> None:
+        """It delivers the pending changes and stops the timer thread.
+
+        :return:
+        """
+        with self._condition:
+            self._is_stopped = True
+            self._condition.notify_all()
+        if self._timer_thread:
+            self._timer_thread.join()
+            self._timer_thread = None
+        self.flush()
+
+    def add(self, partition_key, changes: dict) -> None:
+        """
+
+        :param partition_key:
+        :param changes: A dict mapping each changed key to its latest value.
+        :return:
+        """
+        with self._condition:
+            pending = self._pending.get(partition_key)
+            if pending is None:
+                pending = self._pending[partition_key] = ChangeBatch()
+            revision = getattr(changes, 'revision', None)
+            if revision is not None and (pending.revision is None or revision > pending.revision):
+                pending.revision = revision
+            received_at = getattr(changes, 'received_at', None)
+            if received_at is not None and (pending.received_at is None or received_at < pending.received_at):
+                pending.received_at = received_at
+            for key, value in changes.items():
+                if key not in pending:
+                    self._pending_count += 1
+                else:
+                    # Keep the keys in the order of their latest change.
+                    del pending[key]
+                pending[key] = value
+            self.received_count += len(changes)
+
+            if self.max_batch_size is not None and self._pending_count >= self.max_batch_size:
+                self._flush_no_lock()
+            elif self._deadline is None:
+                self._deadline = time.monotonic() + self.window_seconds
+                self._condition.notify_all()
+
+    def flush(self) -> None:
+        """It delivers the pending changes right away.
+
+        :return:
+        """
+        with self._condition:
+            self._flush_no_lock()
+
+    def _flush_no_lock(self) -> None:
+        # The delivery happens under the lock, so the batches are delivered in the order they were collected.
+        pending = self._pending
+        self._pending = {}
+        self._pending_count = 0
+        self._deadline = None
+        for partition_key, changes in pending.items():
+            self.delivered_count += len(changes)
+            self.batches_count += 1
+            try:
+                self._deliver(changes, partition_key)
+            except Exception as e:
+                logger.error(f"Exception while delivering a coalesced batch: {e}")
+
+    def _run(self) -> None:
+        with self._condition:
+            while not self._is_stopped:
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(timeout=remaining)
+                    continue
+                self._flush_no_lock()
+
+    def stats(self) -> dict:
+        """
+
+        :return:
+        """
+        with self._condition:
+            return {
+                'received': self.received_count,
+                'delivered': self.delivered_count,
+                'coalesced': self.received_count - self.delivered_count - self._pending_count,
+                'batches': self.batches_count,
+                'pending': self._pending_count,
+            }
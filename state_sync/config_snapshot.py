@@ -0,0 +1,213 @@
+from collections.abc import Mapping
+from typing import Any, Iterable, Iterator, Optional
+
+from .lazy_value import resolve
+
+_BITS = 5
+_MASK = (1 << _BITS) - 1
+_HASH_MASK = (1 << 64) - 1
+# Keys whose 64-bit hashes are still equal below this shift are kept together in a collision dict.
+_MAX_SHIFT = 60
+_MISSING = object()
+
+
+class _Node:
+    __slots__ = ('entries',)
+
+    def __init__(self, entries: dict):
+        # index -> (key, value) leaf, child _Node or collision dict
+        self.entries = entries
+
+
+def _hash(key) -> int:
+    return hash(key) & _HASH_MASK
+
+
+def _owned_node(node: _Node, owned: set) -> _Node:
+    if id(node) in owned:
+        return node
+    node = _Node(dict(node.entries))
+    owned.add(id(node))
+    return node
+
+
+def _set(node: _Node, key, key_hash: int, value, shift: int, owned: set):
+    node = _owned_node(node, owned)
+    index = (key_hash >> shift) & _MASK
+    item = node.entries.get(index)
+    if item is None:
+        node.entries[index] = (key, value)
+        return node, True
+    if isinstance(item, _Node):
+        child, is_added = _set(item, key, key_hash, value, shift + _BITS, owned)
+        node.entries[index] = child
+        return node, is_added
+    if isinstance(item, dict):
+        is_added = key not in item
+        collision = item if id(item) in owned else dict(item)
+        owned.add(id(collision))
+        collision[key] = value
+        node.entries[index] = collision
+        return node, is_added
+    if item[0] == key:
+        node.entries[index] = (key, value)
+        return node, False
+    if shift + _BITS > _MAX_SHIFT:
+        collision = {item[0]: item[1], key: value}
+        owned.add(id(collision))
+        node.entries[index] = collision
+        return node, True
+    child = _Node({})
+    owned.add(id(child))
+    child, _ = _set(child, item[0], _hash(item[0]), item[1], shift + _BITS, owned)
+    child, _ = _set(child, key, key_hash, value, shift + _BITS, owned)
+    node.entries[index] = child
+    return node, True
+
+
+def _remove(node: _Node, key, key_hash: int, shift: int, owned: set):
+    """
+
+    :return: (node or None when it is empty, whether the key was removed)
+    """
+    index = (key_hash >> shift) & _MASK
+    item = node.entries.get(index)
+    if item is None:
+        return node, False
+
+    if isinstance(item, _Node):
+        child, is_removed = _remove(item, key, key_hash, shift + _BITS, owned)
+        if not is_removed:
+            return node, False
+        node = _owned_node(node, owned)
+        if child is None:
+            del node.entries[index]
+        elif len(child.entries) == 1 and isinstance(next(iter(child.entries.values())), tuple):
+            # A child holding a single leaf is folded into its parent.
+            node.entries[index] = next(iter(child.entries.values()))
+        else:
+            node.entries[index] = child
+    elif isinstance(item, dict):
+        if key not in item:
+            return node, False
+        node = _owned_node(node, owned)
+        collision = {collision_key: value for collision_key, value in item.items() if collision_key != key}
+        node.entries[index] = next(iter(collision.items())) if len(collision) == 1 else collision
+    elif item[0] == key:
+        node = _owned_node(node, owned)
+        del node.entries[index]
+    else:
+        return node, False
+    return (node if node.entries else None), True
+
+
+def _iterate(node: _Node) -> Iterator[tuple]:
+    for item in node.entries.values():
+        if isinstance(item, _Node):
+            yield from _iterate(item)
+        elif isinstance(item, dict):
+            yield from item.items()
+        else:
+            yield item
+
+
+class ConfigSnapshot(Mapping):
+    """An immutable mapping of the config tagged with the etcd revision it reflects.
+    It is stored as a hash array mapped trie, so evolve() copies only the paths to the changed keys and shares
+    everything else with the previous snapshot. The cost of a new snapshot is proportional to the number of
+    changed keys, not to the total number of keys.
+    A LazyValue is decoded when it is read, so the snapshot always returns the decoded values. Checking whether a key
+    is in the snapshot does not decode its value.
+    """
+
+    __slots__ = ('_root', '_length', 'revision')
+
+    def __init__(self, root: Optional[_Node] = None, length: int = 0, revision: Optional[int] = None):
+        self._root = root if root is not None else _Node({})
+        self._length = length
+        self.revision = revision
+
+    def _lookup(self, key) -> Any:
+        """
+
+        :param key:
+        :return: The stored value, without decoding a lazy one, or _MISSING.
+        """
+        node = self._root
+        key_hash = _hash(key)
+        shift = 0
+        while True:
+            item = node.entries.get((key_hash >> shift) & _MASK)
+            if item is None:
+                return _MISSING
+            if isinstance(item, _Node):
+                node = item
+                shift += _BITS
+                continue
+            if isinstance(item, dict):
+                return item.get(key, _MISSING)
+            if item[0] == key:
+                return item[1]
+            return _MISSING
+
+    def __getitem__(self, key) -> Any:
+        value = self._lookup(key)
+        if value is _MISSING:
+            raise KeyError(key)
+        return resolve(value)
+
+    def __contains__(self, key) -> bool:
+        # The value is not decoded, unlike with the __contains__ of Mapping.
+        return self._lookup(key) is not _MISSING
+
+    def __iter__(self) -> Iterator:
+        for key, _ in _iterate(self._root):
+            yield key
+
+    def __len__(self) -> int:
+        return self._length
+
+    def items(self):
+        return ((key, resolve(value)) for key, value in _iterate(self._root))
+
+    def raw_items(self) -> Iterator[tuple]:
+        """It iterates over the stored values without decoding the lazy ones.
+
+        :return:
+        """
+        return _iterate(self._root)
+
+    def raw_get(self, key, default=None) -> Any:
+        """It returns the stored value without decoding a lazy one.
+
+        :param key:
+        :param default: It is returned when the key is missing.
+        :return:
+        """
+        value = self._lookup(key)
+        return default if value is _MISSING else value
+
+    def __repr__(self) -> str:
+        return f"ConfigSnapshot(revision={self.revision}, {dict(self.items())})"
+
+    def evolve(self, updates: Optional[dict] = None, deletes: Iterable = (),
+               revision: Optional[int] = None) -> 'ConfigSnapshot':
+        """It returns a new snapshot with the updates and deletes applied. This snapshot is left unchanged.
+
+        :param updates: A dict mapping the keys to their new values.
+        :param deletes: The keys to remove.
+        :param revision: The revision of the new snapshot. Defaults to the revision of this snapshot.
+        :return:
+        """
+        owned = set()
+        root = self._root
+        length = self._length
+        for key, value in (updates or {}).items():
+            root, is_added = _set(root, key, _hash(key), value, 0, owned)
+            length += is_added
+        for key in deletes:
+            root, is_removed = _remove(root, key, _hash(key), 0, owned)
+            if root is None:
+                root = _Node({})
+            length -= is_removed
+        return ConfigSnapshot(root=root, length=length, revision=self.revision if revision is None else revision)
@@ -0,0 +1,153 @@
+import threading
+import time
+from enum import Enum
+from typing import Callable, Optional
+
+from .sync_logger import logger
+from .app_config import RECONNECT_CHECK_INTERVAL
+
+
+class ConnectionStateEnum(Enum):
+    CONNECTED = 'CONNECTED'
+    RECONNECTING = 'RECONNECTING'
+    STOPPED = 'STOPPED'
+
+
+class ConnectionSupervisor:
+    """It owns the reconnection of a watcher on a background thread, so the caller is never blocked.
+    When the connection fails, it retries with a capped exponential backoff and jitter, and then resumes the
+    watches from their last applied revisions. The snapshots keep serving the last known config meanwhile.
+    It also loads again the watches whose revision has been compacted.
+    """
+
+    def __init__(self, watcher, check_interval: float = RECONNECT_CHECK_INTERVAL,
+                 on_state_change: Optional[Callable] = None):
+        """
+
+        :param watcher: The WatchForChanges to supervise.
+        :param check_interval: How often the connection state is checked, in seconds.
+        :param on_state_change: It is called with (state, health) on the supervisor thread when the state changes.
+        """
+        self._watcher = watcher
+        self.check_interval = check_interval
+        self._state_listeners = []
+        if on_state_change is not None:
+            self._state_listeners.append(on_state_change)
+        self._wake_up_event = threading.Event()
+        self._stop_event = threading.Event()
+        self._thread = None
+        # A watcher started while etcd was unreachable is reconnecting from the start.
+        self.state = ConnectionStateEnum.RECONNECTING if watcher.etcd_connection_obj.is_connection_failed_with_etcd \
+            else ConnectionStateEnum.CONNECTED
+        self.state_changed_at = time.time()
+        self.reconnect_attempts = 0
+        self.reconnects_count = 0
+
+    def add_state_listener(self, listener: Callable) -> None:
+        """
+
+        :param listener: It is called with (state, health) when the state changes.
+        :return:
+        """
+        self._state_listeners.append(listener)
+
+    def remove_state_listener(self, listener: Callable) -> None:
+        self._state_listeners.remove(listener)
+
+    @property
+    def is_healthy(self) -> bool:
+        return self.state == ConnectionStateEnum.CONNECTED
+
+    def health(self) -> dict:
+        """
+
+        :return: The connection state, since when it holds, the reconnection counters and the endpoints health.
+        """
+        return {
+            'state': self.state.value,
+            'is_healthy': self.is_healthy,
+            'state_changed_at': self.state_changed_at,
+            'reconnect_attempts': self.reconnect_attempts,
+            'reconnects': self.reconnects_count,
+            'revision': self._watcher.snapshot().revision,
+            **self._watcher.etcd_connection_obj.health(),
+        }
+
+    def start(self) -> None:
+        """
+
+        :return:
+        """
+        self._stop_event.clear()
+        self._thread = threading.Thread(name='state_sync_connection_supervisor', target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout: float = None) -> None:
+        """It stops the supervisor, interrupting the backoff delay if a reconnection is in progress.
+
+        :param timeout: The maximum number of seconds to wait for the supervisor thread.
+        :return:
+        """
+        self._stop_event.set()
+        self._wake_up_event.set()
+        if self._thread:
+            self._thread.join(timeout=timeout)
+            self._thread = None
+        self._set_state(ConnectionStateEnum.STOPPED)
+
+    def notify_failure(self) -> None:
+        """It wakes the supervisor up right away. It is called by the watcher when a watch fails.
+
+        :return:
+        """
+        self._wake_up_event.set()
+
+    def _run(self) -> None:
+        while not self._stop_event.is_set():
+            self._wake_up_event.wait(timeout=self.check_interval)
+            self._wake_up_event.clear()
+            if self._stop_event.is_set():
+                return
+            try:
+                if self._watcher.etcd_connection_obj.is_connection_failed_with_etcd:
+                    self._reconnect()
+                if self._watcher.compacted_watch_keys:
+                    self._watcher.resync_compacted_watch_keys()
+            except Exception as e:
+                logger.error(f"Exception in the connection supervisor: {e}")
+
+    def _reconnect(self) -> None:
+        """It retries until the connection is established and the watches are resumed, or the supervisor stops.
+        The loop is bounded by the stop event only, the watcher is never left without a reconnection.
+
+        :return:
+        """
+        self._set_state(ConnectionStateEnum.RECONNECTING)
+        etcd_connection = self._watcher.etcd_connection_obj
+        started = time.perf_counter()
+        retry_count = 0
+        while not self._stop_event.is_set():
+            self.reconnect_attempts += 1
+            if etcd_connection.try_connection_with_etcd() and self._watcher.resume_after_reconnect():
+                self.reconnects_count += 1
+                if self._watcher.metrics is not None:
+                    self._watcher.metrics.record_reconnect(time.perf_counter() - started)
+                self._set_state(ConnectionStateEnum.CONNECTED)
+                return
+            retry_count += 1
+            delay = etcd_connection.retry_delay(retry_count)
+            logger.info(f"Reconnecting to etcd in {delay:.2f} seconds. Retry count: {retry_count}.")
+            self._stop_event.wait(timeout=delay)
+
+    def _set_state(self, state: ConnectionStateEnum) -> None:
+        if state == self.state:
+            return
+        self.state = state
+        self.state_changed_at = time.time()
+        logger.info(f"Connection state: {state.value}.")
+        health = self.health()
+        for listener in tuple(self._state_listeners):
+            try:
+                listener(state, health)
+            except Exception as e:
+                logger.error(f"Exception in a connection state listener: {e}")
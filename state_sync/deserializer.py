@@ -1,8 +1,35 @@
+import hashlib
 import json
+import re
+import threading
+import time
 from abc import ABC, abstractmethod
-from typing import Union, Tuple, Any
+from collections import OrderedDict
+from typing import Union, Tuple, Any, Optional
 
 from .sync_logger import logger
+from .app_config import DESERIALIZER_CACHE_MAX_ENTRIES, DESERIALIZER_CACHE_MAX_BYTES, SERIALIZATION_SUPPORT
+
+# The YAML, TOML and MessagePack formats are optional, they are registered only when their library is installed.
+# The deserializers log their failures at debug level, the callers knowing whether the format was defined or sniffed
+# report them.
+try:
+    import yaml
+except ImportError:
+    yaml = None
+
+try:
+    import tomllib
+except ImportError:
+    try:
+        import tomli as tomllib
+    except ImportError:
+        tomllib = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class DeserializerHandler(ABC):
@@ -64,6 +91,249 @@ class JSONDeserializer(AbstractDataDeserializer, DeserializerHandler):
             deserialized_data = json.loads(data)
             logger.debug('Data successfully deserialized.')
             return True, deserialized_data
-        except json.JSONDecodeError as e:
-            logger.error(f'JSONDecodeError: {e}')
+        except (json.JSONDecodeError, UnicodeDecodeError) as e:
+            logger.debug(f'JSONDecodeError: {e}')
+            return False, None
+
+
+class YAMLDeserializer(AbstractDataDeserializer):
+
+    @staticmethod
+    def deserialize(data) -> Tuple[bool, Any]:
+        """
+
+        :param data:
+        :return:
+        """
+        try:
+            return True, yaml.safe_load(data)
+        except yaml.YAMLError as e:
+            logger.debug(f'YAMLError: {e}')
+            return False, None
+
+
+class TOMLDeserializer(AbstractDataDeserializer):
+
+    @staticmethod
+    def deserialize(data) -> Tuple[bool, Any]:
+        """
+
+        :param data:
+        :return:
+        """
+        try:
+            return True, tomllib.loads(data.decode('utf-8') if isinstance(data, bytes) else data)
+        except (tomllib.TOMLDecodeError, UnicodeDecodeError) as e:
+            logger.debug(f'TOMLDecodeError: {e}')
+            return False, None
+
+
+class MsgPackDeserializer(AbstractDataDeserializer):
+
+    @staticmethod
+    def deserialize(data) -> Tuple[bool, Any]:
+        """
+
+        :param data:
+        :return:
+        """
+        try:
+            return True, msgpack.unpackb(data.encode('utf-8') if isinstance(data, str) else data, raw=False)
+        except (msgpack.ExtraData, msgpack.FormatError, msgpack.StackError, ValueError) as e:
+            logger.debug(f'MsgPackDecodeError: {e}')
             return False, None
+
+
+AVAILABLE_DESERIALIZERS = {'JSON': JSONDeserializer}
+if yaml is not None:
+    AVAILABLE_DESERIALIZERS['YAML'] = YAMLDeserializer
+if tomllib is not None:
+    AVAILABLE_DESERIALIZERS['TOML'] = TOMLDeserializer
+if msgpack is not None:
+    AVAILABLE_DESERIALIZERS['MSGPACK'] = MsgPackDeserializer
+
+# MessagePack maps and arrays: fixmap, fixarray, array 16/32 and map 16/32.
+_MSGPACK_CONTAINER_MARKERS = frozenset(list(range(0x80, 0xa0)) + [0xdc, 0xdd, 0xde, 0xdf])
+_TOML_KEY_VALUE_PATTERN = re.compile(r'^[A-Za-z0-9_"\'.-]+\s*=')
+# A [table] or [[array of tables]] header, such as [server] or [servers."alpha"].
+_TOML_TABLE_PATTERN = re.compile(r'^\[\[?\s*[A-Za-z0-9_"\'. -]+\s*\]\]?\s*(#.*)?$')
+# The number of leading and trailing characters looked at by sniff().
+_SNIFF_LENGTH = 256
+
+
+class DeserializerRegistry(DeserializerHandler):
+    """It dispatches each request to the deserializer registered for its format with a single dict lookup.
+    Any AbstractDataDeserializer can be registered under a new format name.
+    """
+
+    def __init__(self, successor=None, serializations=None, metrics=None):
+        """
+
+        :param successor: The handler receiving the requests for the formats that are not registered.
+        :param serializations: The formats to register from the available deserializers.
+                               Defaults to SERIALIZATION_SUPPORT.
+        :param metrics: The SyncMetrics receiving the deserialization time of each format, if any.
+        """
+        super().__init__(successor=successor)
+        self.metrics = metrics
+        self._deserializers = {}
+        for serialization in (SERIALIZATION_SUPPORT if serializations is None else serializations):
+            if serialization in AVAILABLE_DESERIALIZERS:
+                self.register(serialization=serialization, deserializer=AVAILABLE_DESERIALIZERS[serialization])
+            else:
+                logger.debug(f"The '{serialization}' deserializer is not available. Install its library to use it.")
+
+    @property
+    def serializations(self) -> list:
+        return list(self._deserializers)
+
+    def register(self, serialization: str, deserializer: AbstractDataDeserializer) -> None:
+        """
+
+        :param serialization: The format name used in the key settings.
+        :param deserializer: An AbstractDataDeserializer class or instance.
+        :return:
+        """
+        self._deserializers[serialization] = deserializer
+
+    def unregister(self, serialization: str) -> None:
+        """
+
+        :param serialization:
+        :return:
+        """
+        self._deserializers.pop(serialization, None)
+
+    def handle_request(self, serialization: str, data) -> Union[Union[bool, dict, None, Tuple[bool, None]], Any]:
+        """
+
+        :param serialization:
+        :param data:
+        :return:
+        """
+        deserializer = self._deserializers.get(serialization)
+        if deserializer is not None:
+            if self.metrics is None:
+                return deserializer.deserialize(data)
+            started = time.perf_counter()
+            result = deserializer.deserialize(data)
+            self.metrics.record_deserialize(serialization=serialization, seconds=time.perf_counter() - started)
+            return result
+        elif self._successor:
+            return self._successor.handle_request(serialization=serialization, data=data)
+        else:
+            return False, None
+
+    def sniff(self, data) -> Optional[str]:
+        """It guesses the format from the leading bytes of the data, so only one deserializer is tried.
+
+        :param data:
+        :return: The registered format name, or None when the data does not look like any of them.
+        """
+        if not data:
+            return None
+        if isinstance(data, bytes) and data[0] in _MSGPACK_CONTAINER_MARKERS:
+            serialization = 'MSGPACK'
+        else:
+            head = data[:_SNIFF_LENGTH].strip()
+            last_character = data[-_SNIFF_LENGTH:].rstrip()[-1:]
+            if isinstance(head, bytes):
+                head = head.decode('utf-8', errors='ignore')
+                last_character = last_character.decode('utf-8', errors='ignore')
+            first_line = head.partition('\n')[0].rstrip()
+            # A TOML document may start with a [table] header, which a JSON array never looks like on its own line.
+            if '\n' in head and _TOML_TABLE_PATTERN.match(first_line):
+                serialization = 'TOML'
+            elif (head[:1], last_character) in (('{', '}'), ('[', ']')):
+                serialization = 'JSON'
+            elif head.startswith('---') or head.startswith('%YAML'):
+                serialization = 'YAML'
+            # A single 'name=value' line, such as 'mode=fast', is more likely a plain value than a TOML document.
+            elif '\n' in head and _TOML_KEY_VALUE_PATTERN.match(head):
+                serialization = 'TOML'
+            else:
+                return None
+        return serialization if serialization in self._deserializers else None
+
+
+class CachingDeserializerHandler(DeserializerHandler):
+    """It keeps the recently deserialized payloads in a bounded LRU cache in front of its successor.
+    The cache key is the serialization format and a digest of the payload, so duplicate deliveries, re-watches
+    and unchanged rewrites are deserialized once. The cached objects are shared, so they must not be modified.
+    """
+
+    def __init__(self, successor=None, max_entries: int = DESERIALIZER_CACHE_MAX_ENTRIES,
+                 max_bytes: int = DESERIALIZER_CACHE_MAX_BYTES):
+        """
+
+        :param successor: The handler deserializing the payloads missing from the cache.
+        :param max_entries: The maximum number of cached payloads.
+        :param max_bytes: The maximum total size of the cached payloads.
+        """
+        super().__init__(successor=successor)
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        # (serialization, digest) -> (deserialized data, payload size)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.cached_bytes = 0
+        self.hits_count = 0
+        self.misses_count = 0
+        self.evictions_count = 0
+
+    def handle_request(self, serialization: str, data) -> Union[Union[bool, dict, None, Tuple[bool, None]], Any]:
+        """
+
+        :param serialization:
+        :param data:
+        :return:
+        """
+        payload = data.encode('utf-8') if isinstance(data, str) else data
+        cache_key = (serialization, hashlib.blake2b(payload, digest_size=16).digest())
+        with self._lock:
+            cached = self._cache.get(cache_key)
+            if cached is not None:
+                self._cache.move_to_end(cache_key)
+                self.hits_count += 1
+                return True, cached[0]
+            self.misses_count += 1
+
+        if not self._successor:
+            return False, None
+        is_deserialized, deserialized_data = self._successor.handle_request(serialization=serialization, data=data)
+        if is_deserialized and len(payload) <= self.max_bytes:
+            with self._lock:
+                if cache_key not in self._cache:
+                    self._cache[cache_key] = (deserialized_data, len(payload))
+                    self.cached_bytes += len(payload)
+                    self._evict_no_lock()
+        return is_deserialized, deserialized_data
+
+    def _evict_no_lock(self) -> None:
+        while len(self._cache) > self.max_entries or self.cached_bytes > self.max_bytes:
+            _, (_, size) = self._cache.popitem(last=False)
+            self.cached_bytes -= size
+            self.evictions_count += 1
+
+    def clear(self) -> None:
+        """
+
+        :return:
+        """
+        with self._lock:
+            self._cache.clear()
+            self.cached_bytes = 0
+
+    def stats(self) -> dict:
+        """
+
+        :return: The hit, miss and eviction counters with the current size of the cache.
+        """
+        with self._lock:
+            return {
+                'hits': self.hits_count,
+                'misses': self.misses_count,
+                'evictions': self.evictions_count,
+                'entries': len(self._cache),
+                'bytes': self.cached_bytes,
+            }
@@ -0,0 +1,222 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from enum import Enum
+
+from .sync_logger import logger
+
+
+class OverflowPolicyEnum(Enum):
+    """What to do when a bounded queue of changes is full.
+
+    With DROP_OLDEST, the changes of a dropped batch are never delivered, so the observers keep the previous values of
+    its keys and diverge from the watcher snapshot until those keys change again.
+    """
+    # The watch thread waits until the worker frees a slot.
+    BLOCK = 'BLOCK'
+    # The oldest pending batch is dropped to make room for the new one.
+    DROP_OLDEST = 'DROP-OLDEST'
+    # A pending batch of the same partition is merged with the new one. Other batches wait for a free slot.
+    COALESCE = 'COALESCE'
+
+
+class _DispatchQueue:
+    """A bounded queue of (partition_key, changes) batches applying the overflow policy when it is full."""
+
+    def __init__(self, maxsize: int, overflow_policy: OverflowPolicyEnum):
+        self.maxsize = maxsize
+        self.overflow_policy = overflow_policy
+        self._items = OrderedDict() if overflow_policy == OverflowPolicyEnum.COALESCE else deque()
+        self._condition = threading.Condition()
+        self.is_closed = False
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, partition_key, changes: dict) -> tuple:
+        """
+
+        :param partition_key:
+        :param changes:
+        :return: The result, 'queued', 'coalesced' or 'dropped' when the oldest batch has been dropped, and the
+                 dropped (partition_key, changes) batch or None.
+        """
+        with self._condition:
+            if self.overflow_policy == OverflowPolicyEnum.COALESCE and partition_key in self._items:
+                self._items[partition_key] = self._items[partition_key].merged(changes)
+                return 'coalesced', None
+
+            result = 'queued'
+            dropped_item = None
+            if len(self._items) >= self.maxsize:
+                if self.overflow_policy == OverflowPolicyEnum.DROP_OLDEST:
+                    dropped_item = self._items.popleft()
+                    result = 'dropped'
+                else:
+                    while len(self._items) >= self.maxsize and not self.is_closed:
+                        self._condition.wait()
+
+            if isinstance(self._items, OrderedDict):
+                self._items[partition_key] = changes
+            else:
+                self._items.append((partition_key, changes))
+            self._condition.notify_all()
+            return result, dropped_item
+
+    def get(self):
+        """It waits for the next batch. It returns None once the queue is closed and empty.
+
+        :return:
+        """
+        with self._condition:
+            while not self._items:
+                if self.is_closed:
+                    return None
+                self._condition.wait()
+            if isinstance(self._items, OrderedDict):
+                item = self._items.popitem(last=False)
+            else:
+                item = self._items.popleft()
+            self._condition.notify_all()
+            return item
+
+    def close(self) -> None:
+        with self._condition:
+            self.is_closed = True
+            self._condition.notify_all()
+
+
+class ObserverDispatcher:
+    """It moves the observer notifications off the etcd callback thread.
+    Each batch is queued to one of the worker threads chosen by its partition key. The watcher uses the watch key,
+    and every key is covered by a single watch, so the changes on a key are always delivered in order while slow
+    observers only delay the batches queued to the same worker.
+    """
+
+    def __init__(self, subject, number_of_workers: int, queue_size: int,
+                 overflow_policy: OverflowPolicyEnum = OverflowPolicyEnum.BLOCK, metrics=None):
+        """
+
+        :param subject: The subject whose observers are notified.
+        :param number_of_workers:
+        :param queue_size: The maximum number of pending batches per worker.
+        :param overflow_policy:
+        :param metrics: The SyncMetrics receiving the observer and end-to-end latencies, if any.
+        """
+        self._subject = subject
+        self._metrics = metrics
+        self.number_of_workers = number_of_workers
+        self.overflow_policy = overflow_policy
+        self._queues = [_DispatchQueue(maxsize=queue_size, overflow_policy=overflow_policy)
+                        for _ in range(number_of_workers)]
+        self._workers = []
+        self._stats_lock = threading.Lock()
+        self.submitted_count = 0
+        self.delivered_count = 0
+        self.coalesced_count = 0
+        self.dropped_count = 0
+        self.max_queue_depth = 0
+        # Observer name -> [calls, total seconds, max seconds]
+        self._observer_latency = {}
+
+    def start(self) -> None:
+        """
+
+        :return:
+        """
+        for index, queue in enumerate(self._queues):
+            worker = threading.Thread(name=f'state_sync_dispatcher_{index}', target=self._run, args=(queue,),
+                                      daemon=True)
+            worker.start()
+            self._workers.append(worker)
+        logger.debug(f"Observer dispatcher started with {self.number_of_workers} workers.")
+
+    def stop(self, timeout: float = None) -> None:
+        """It delivers the pending batches and stops the workers.
+
+        :param timeout: The maximum number of seconds to wait for each worker.
+        :return:
+        """
+        for queue in self._queues:
+            queue.close()
+        for worker in self._workers:
+            worker.join(timeout=timeout)
+        self._workers = []
+        logger.debug("Observer dispatcher stopped.")
+
+    def submit(self, partition_key, changes: dict) -> None:
+        """It queues the batch for the observers. It is called on the etcd callback thread.
+
+        :param partition_key: The batches with the same partition key are delivered in order.
+        :param changes: A dict mapping each changed key to its latest value.
+        :return:
+        """
+        queue = self._queues[hash(partition_key) % self.number_of_workers]
+        result, dropped_item = queue.put(partition_key, changes)
+        with self._stats_lock:
+            self.submitted_count += 1
+            if result == 'coalesced':
+                self.coalesced_count += 1
+            elif result == 'dropped':
+                self.dropped_count += 1
+            queue_depth = len(queue)
+            if queue_depth > self.max_queue_depth:
+                self.max_queue_depth = queue_depth
+        if dropped_item is not None:
+            dropped_partition_key, dropped_changes = dropped_item
+            logger.warning(f"The dispatch queue is full. A batch of {len(dropped_changes)} changes of "
+                           f"'{dropped_partition_key}' has been dropped, so the observers keep stale values for its keys.")
+
+    def _run(self, queue: _DispatchQueue) -> None:
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            partition_key, changes = item
+            for observer, observer_changes in self._subject.route_changes(changes):
+                started = time.perf_counter()
+                try:
+                    observer.update_batch(observer_changes)
+                except Exception as e:
+                    logger.error(f"Observer exception on a batch of '{partition_key}': {e}")
+                self._record_latency(observer=observer, elapsed=time.perf_counter() - started)
+            with self._stats_lock:
+                self.delivered_count += 1
+            received_at = getattr(changes, 'received_at', None)
+            if self._metrics is not None and received_at is not None:
+                self._metrics.record_end_to_end(time.perf_counter() - received_at)
+
+    def _record_latency(self, observer, elapsed: float) -> None:
+        name = type(observer).__name__
+        with self._stats_lock:
+            latency = self._observer_latency.get(name)
+            if latency is None:
+                latency = self._observer_latency[name] = [0, 0.0, 0.0]
+            latency[0] += 1
+            latency[1] += elapsed
+            if elapsed > latency[2]:
+                latency[2] = elapsed
+        if self._metrics is not None:
+            self._metrics.record_observer(observer_name=name, seconds=elapsed)
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(queue) for queue in self._queues)
+
+    def stats(self) -> dict:
+        """
+
+        :return: The queue depth and the per-observer latency counters.
+        """
+        with self._stats_lock:
+            return {
+                'queue_depth': self.queue_depth,
+                'max_queue_depth': self.max_queue_depth,
+                'submitted': self.submitted_count,
+                'delivered': self.delivered_count,
+                'coalesced': self.coalesced_count,
+                'dropped': self.dropped_count,
+                'observers': {name: {'calls': calls, 'total_seconds': total, 'max_seconds': maximum,
+                                     'avg_seconds': total / calls if calls else 0.0}
+                              for name, (calls, total, maximum) in self._observer_latency.items()},
+            }
@@ -1,16 +1,178 @@
+import random
+import threading
 import time
 from typing import NoReturn
 
 import etcd3
+import grpc
+from etcd3 import etcdrpc
 
 from .sync_logger import logger
 from .custom_exceptions import MaximumRetiresReachedException, FutureFeatureException
+from .app_config import RECONNECT_MAX_RETRY_INTERVAL, HEALTH_CHECK_INTERVAL, HEALTH_CHECK_LATENCY_WEIGHT
+
+
+class EndpointHealth:
+    """The health and the smoothed probe latency of a member of the etcd cluster."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        # An endpoint is assumed healthy until a probe fails, so it is tried in its configured order.
+        self.is_healthy = True
+        self.latency = None
+        self.failures_count = 0
+        self.last_checked_at = None
+        self.last_error = None
+
+    @property
+    def name(self) -> str:
+        return f"{self.host}:{self.port}"
+
+    def record_success(self, latency: float) -> None:
+        self.is_healthy = True
+        self.latency = latency if self.latency is None else \
+            HEALTH_CHECK_LATENCY_WEIGHT * latency + (1 - HEALTH_CHECK_LATENCY_WEIGHT) * self.latency
+        self.last_checked_at = time.time()
+        self.last_error = None
+
+    def record_failure(self, error: Exception) -> None:
+        self.is_healthy = False
+        self.failures_count += 1
+        self.last_checked_at = time.time()
+        self.last_error = str(error)
+
+    def to_dict(self) -> dict:
+        return {
+            'endpoint': self.name,
+            'is_healthy': self.is_healthy,
+            'latency_ms': None if self.latency is None else self.latency * 1000,
+            'failures': self.failures_count,
+            'last_checked_at': self.last_checked_at,
+            'last_error': self.last_error,
+        }
+
+
+def parse_endpoint(endpoint) -> tuple:
+    """
+
+    :param endpoint: A 'host:port' string or a (host, port) tuple.
+    :return: The (host, port) tuple.
+    """
+    if isinstance(endpoint, str):
+        host, _, port = endpoint.rpartition(':')
+        return host, int(port)
+    host, port = endpoint
+    return host, int(port)
+
+
+class EtcdClientPool:
+    """It shares the etcd3 clients, and so their gRPC channels and watch streams, between the connections of the
+    process using the same endpoint with the same settings. A discarded client is closed and no longer handed out,
+    so the next connection to its endpoint gets a new channel, and the connections still holding it reconnect.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+
+    @staticmethod
+    def _pool_key(host: str, port: int, settings: dict) -> tuple:
+        grpc_options = tuple(settings.get('grpc_options') or ())
+        return (host, port, grpc_options) + tuple(sorted((name, value) for name, value in settings.items()
+                                                         if name != 'grpc_options'))
+
+    def acquire(self, host: str, port: int, **settings):
+        """
+
+        :param settings: The other arguments of etcd3.client, such as ca_cert, timeout, user or grpc_options.
+        :return: The pooled client of the endpoint, created on first use.
+        """
+        pool_key = self._pool_key(host, port, settings)
+        with self._lock:
+            client = self._clients.get(pool_key)
+            if client is None:
+                logger.debug(f"Initializing the etcd3 client of '{host}:{port}'.")
+                client = etcd3.client(host=host, port=port, **settings)
+                self._clients[pool_key] = client
+            return client
+
+    def discard(self, client) -> None:
+        """It removes the client from the pool and closes it, releasing its gRPC channel and its watch thread.
+
+        :param client: A client whose channel has failed.
+        :return:
+        """
+        is_pooled = False
+        with self._lock:
+            for pool_key, pooled_client in list(self._clients.items()):
+                if pooled_client is client:
+                    del self._clients[pool_key]
+                    is_pooled = True
+        # It is closed outside the lock, as closing waits for its watch thread.
+        if is_pooled:
+            try:
+                client.close()
+            except Exception as e:
+                logger.debug("The discarded etcd client could not be closed: %s", e)
+
+    def clear(self) -> None:
+        """It closes all the pooled clients.
+
+        :return:
+        """
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            client.close()
+
+    def __len__(self) -> int:
+        return len(self._clients)
+
+
+# The clients are shared by all the watchers of the process.
+etcd_client_pool = EtcdClientPool()
+
+CONNECTION_ERRORS = (etcd3.exceptions.ConnectionFailedError, etcd3.exceptions.ConnectionTimeoutError, grpc.RpcError)
+
+
+def get_range_page(etcd_client, key, range_end, limit: int, revision: int = 0):
+    """It reads up to limit keys of a range, sorted by key. The get_range() of etcd3 ignores its limit and revision
+    arguments, so the RangeRequest is sent on the KV stub of the client.
+
+    :param etcd_client:
+    :param key: The first key of the page.
+    :param range_end:
+    :param limit: The maximum number of keys of the page.
+    :param revision: The revision to read at. 0 reads the latest revision.
+    :return: The RangeResponse. Its 'more' field is set when keys are left after the page.
+    """
+    range_request = etcdrpc.RangeRequest(key=etcd3.utils.to_bytes(key), range_end=etcd3.utils.to_bytes(range_end),
+                                         limit=limit, revision=revision, sort_order=etcdrpc.RangeRequest.ASCEND,
+                                         sort_target=etcdrpc.RangeRequest.KEY)
+    return etcd_client.kvstub.Range(range_request, etcd_client.timeout, credentials=etcd_client.call_credentials,
+                                    metadata=etcd_client.metadata)
 
 
 class EtcdConnection:
     def __init__(self, host: str, port: int, number_of_retries: int, retry_interval: int,
                  ca_cert=None, cert_key=None, cert_cert=None, timeout=None,
-                 user=None, password=None, grpc_options=None):
+                 user=None, password=None, grpc_options=None, etcd_client=None,
+                 max_retry_interval: float = RECONNECT_MAX_RETRY_INTERVAL, endpoints: list = None,
+                 client_pool: EtcdClientPool = None):
+        """
+
+        :param retry_interval: The delay before the first retry. It doubles after each failed retry.
+        :param etcd_client: An already created client, such as a FakeEtcdClient. It is used instead of creating
+                            an etcd3 client from the connection details.
+        :param max_retry_interval: The maximum delay between two retries.
+        :param endpoints: The members of the etcd cluster, as 'host:port' strings or (host, port) tuples. The
+                          healthy member with the lowest latency is used, and each connection attempt fails over
+                          to the other members before waiting for a retry. It defaults to host and port.
+        :param client_pool: The pool sharing the clients between the connections. It defaults to the pool of the
+                            process.
+        """
 
         self.host = host
         self.port = port
@@ -25,48 +187,190 @@ class EtcdConnection:
 
         self.number_of_retries = number_of_retries
         self.retry_interval = retry_interval
+        self.max_retry_interval = max_retry_interval
         self.retried_count = 1
         self.is_connection_failed_with_etcd = False
-        self.etcd_client = None
-        self._initialize_etcd_client()
+        self.endpoints = [EndpointHealth(*parse_endpoint(endpoint)) for endpoint in endpoints or [(host, port)]]
+        # The endpoint of the client in use.
+        self.endpoint = None
+        self.client_pool = client_pool if client_pool is not None else etcd_client_pool
+        # It is called when a health check finds the endpoint in use unhealthy, such as ConnectionSupervisor's
+        # notify_failure, so the connection fails over without waiting for a watch to break.
+        self.on_failure = None
+        self._health_check_thread = None
+        self._health_check_stop_event = threading.Event()
+        self._is_injected_client = etcd_client is not None
+        self.etcd_client = etcd_client
+        if self.etcd_client is None:
+            self._initialize_etcd_client(self.select_endpoints()[0])
+        else:
+            self.endpoint = self.endpoints[0]
+
+    def _client_settings(self) -> dict:
+        return {'ca_cert': self.ca_cert, 'cert_key': self.cert_key, 'cert_cert': self.cert_cert,
+                'timeout': self.timeout, 'user': self.user, 'password': self.password,
+                'grpc_options': self.grpc_options}
+
+    def _get_client(self, endpoint: EndpointHealth):
+        if self._is_injected_client:
+            return self.etcd_client
+        return self.client_pool.acquire(endpoint.host, endpoint.port, **self._client_settings())
+
+    def _initialize_etcd_client(self, endpoint: EndpointHealth) -> None:
+        self.etcd_client = self._get_client(endpoint)
+        self.endpoint = endpoint
+        self.host = endpoint.host
+        self.port = endpoint.port
 
-    def _initialize_etcd_client(self):
-        logger.debug('Initializing the etcd3 client. ')
-        self.etcd_client = etcd3.client(host=self.host, port=self.port,
-                                        ca_cert=self.ca_cert, cert_key=self.cert_key, cert_cert=self.cert_cert,
-                                        timeout=self.timeout,
-                                        user=self.user, password=self.password, grpc_options=self.grpc_options)
+    def select_endpoints(self) -> list:
+        """
+
+        :return: The endpoints in the order they are tried: the healthy ones by increasing latency, and then the
+                 unhealthy ones, the least recently checked first.
+        """
+        healthy = [endpoint for endpoint in self.endpoints if endpoint.is_healthy]
+        unhealthy = [endpoint for endpoint in self.endpoints if not endpoint.is_healthy]
+        healthy.sort(key=lambda endpoint: float('inf') if endpoint.latency is None else endpoint.latency)
+        unhealthy.sort(key=lambda endpoint: endpoint.last_checked_at or 0)
+        return healthy + unhealthy
 
     def establish_connection_with_etcd(self) -> None:
-        try:
-            if self.retried_count <= self.number_of_retries:
-                logger.debug('Establishing a connection with etcd.')
-                # self._initialize_etcd_client()
-                self._initiate_etcd_connection()
-                logger.info("Connection successfully established to etcd.")
-                self.is_connection_failed_with_etcd = False
-                self.retried_count = 1
-            else:
+        """It blocks until the connection is established, retrying with a capped exponential backoff.
+        Use the ConnectionSupervisor to reconnect in the background instead.
+
+        :return:
+        """
+        while True:
+            if self.retried_count > self.number_of_retries:
                 self.is_connection_failed_with_etcd = True
                 logger.error('The maximum number of retries has been reached.')
                 raise MaximumRetiresReachedException(f"Maximum retires reached.")
-        except etcd3.exceptions.ConnectionFailedError as e:
-            logger.error(f"The connection to etcd has failed. Exception: {e}")
+            if self.try_connection_with_etcd():
+                return
             self._retry_countdown()
-            self.establish_connection_with_etcd()
 
-    def _initiate_etcd_connection(self) -> None:
-        self.etcd_client.get('some_key')
+    def try_connection_with_etcd(self) -> bool:
+        """It makes a single connection attempt, trying each endpoint in the order of select_endpoints().
+
+        :return: True when the connection has been established.
+        """
+        logger.debug('Establishing a connection with etcd.')
+        # An endpoint that has never been probed has no last_checked_at, while a dead one keeps a None latency.
+        is_probed = len(self.endpoints) > 1 and any(endpoint.last_checked_at is None for endpoint in self.endpoints)
+        if is_probed:
+            # The latencies are measured once before choosing among the endpoints.
+            self._probe_endpoints()
+        for endpoint in self.select_endpoints():
+            if is_probed and not endpoint.is_healthy:
+                # It has just failed its probe, so it is not probed twice in the same attempt.
+                continue
+            try:
+                client = self._get_client(endpoint)
+                if not is_probed:
+                    self._probe(endpoint, client)
+            except CONNECTION_ERRORS as e:
+                logger.error(f"The connection to etcd at '{endpoint.name}' has failed. Exception: {e}")
+                continue
+            if endpoint is not self.endpoint:
+                logger.info(f"Failing over from '{self.endpoint.name}' to '{endpoint.name}'.")
+            self._initialize_etcd_client(endpoint)
+            logger.info(f"Connection successfully established to etcd at '{endpoint.name}'.")
+            self.is_connection_failed_with_etcd = False
+            self.retried_count = 1
+            return True
+        self.is_connection_failed_with_etcd = True
+        return False
+
+    def _probe(self, endpoint: EndpointHealth, client) -> None:
+        """It reads the 'health' key, like etcdctl endpoint health, and records the latency of the endpoint.
+        A failed client is discarded from the pool, so the next attempt opens a new channel.
+
+        :return:
+        """
+        started = time.perf_counter()
+        try:
+            client.get('health')
+        except CONNECTION_ERRORS as e:
+            endpoint.record_failure(e)
+            if not self._is_injected_client:
+                self.client_pool.discard(client)
+            raise
+        endpoint.record_success(time.perf_counter() - started)
+
+    def check_health(self) -> None:
+        """It probes every endpoint. When the endpoint in use is unhealthy, the connection is marked as failed and
+        on_failure is called, so it fails over to a healthy endpoint right away.
+
+        :return:
+        """
+        self._probe_endpoints()
+        if self.endpoint is not None and not self.endpoint.is_healthy and not self.is_connection_failed_with_etcd:
+            self.is_connection_failed_with_etcd = True
+            if self.on_failure is not None:
+                self.on_failure()
+
+    def _probe_endpoints(self) -> None:
+        for endpoint in self.endpoints:
+            try:
+                self._probe(endpoint, self._get_client(endpoint))
+            except CONNECTION_ERRORS as e:
+                logger.warning(f"The health check of etcd at '{endpoint.name}' has failed. Exception: {e}")
+
+    def start_health_checks(self, interval: float = HEALTH_CHECK_INTERVAL) -> None:
+        """It probes the endpoints on a background thread, keeping their health and latency up to date.
+
+        :param interval: The delay between two rounds of probes, in seconds.
+        :return:
+        """
+        self.stop_health_checks()
+        self._health_check_stop_event.clear()
+        self._health_check_thread = threading.Thread(name='state_sync_health_checks', target=self._run_health_checks,
+                                                     args=(interval,), daemon=True)
+        self._health_check_thread.start()
+
+    def stop_health_checks(self) -> None:
+        """
+
+        :return:
+        """
+        self._health_check_stop_event.set()
+        if self._health_check_thread:
+            self._health_check_thread.join()
+            self._health_check_thread = None
+
+    def _run_health_checks(self, interval: float) -> None:
+        while not self._health_check_stop_event.wait(timeout=interval):
+            try:
+                self.check_health()
+            except Exception as e:
+                logger.error(f"Exception in the etcd health checks: {e}")
+
+    def health(self) -> dict:
+        """
+
+        :return: The endpoint in use and the health of each endpoint.
+        """
+        return {
+            'endpoint': None if self.endpoint is None else self.endpoint.name,
+            'endpoints': [endpoint.to_dict() for endpoint in self.endpoints],
+        }
+
+    def retry_delay(self, retry_count: int) -> float:
+        """It doubles the retry interval after each failed retry up to max_retry_interval, and then picks a random
+        delay between half and all of it, so the clients disconnected together do not retry in lockstep.
+
+        :param retry_count: The number of the retry, starting from 1.
+        :return: The delay in seconds.
+        """
+        delay = min(self.max_retry_interval, self.retry_interval * 2 ** min(retry_count - 1, 32))
+        return delay / 2 + random.uniform(0, delay / 2)
 
     def _retry_countdown(self) -> None:
         logger.info(f"Retry count: '{self.retried_count}'.")
+        delay = self.retry_delay(self.retried_count)
         self.retried_count += 1
-        logger.info(f"Retrying after a {self.retry_interval}-seconds delay.")
-        sleep_time = self.retry_interval
-        for _ in range(0, self.retry_interval):
-            time.sleep(1)
-            sleep_time -= 1
-            logger.debug(f"Retrying after a {sleep_time}-seconds delay.")
+        logger.info(f"Retrying after a {delay:.2f}-seconds delay.")
+        time.sleep(delay)
 
     def close_connection(self) -> NoReturn:
         raise FutureFeatureException("This feature is not yet implemented but will be available in future releases.")
@@ -0,0 +1,232 @@
+import bisect
+import time
+
+from etcd3 import etcdrpc
+from etcd3.etcdrpc import kv_pb2
+from etcd3.client import KVMetadata, Transactions
+from etcd3.events import new_event
+from etcd3.exceptions import ConnectionFailedError, RevisionCompactedError
+from etcd3.utils import increment_last_byte, to_bytes
+from etcd3.watch import WatchResponse
+
+
+def create_watch_response(items: dict, revision: int, deleted_keys=()) -> WatchResponse:
+    """It builds a WatchResponse of PutEvents and DeleteEvents written at the given revision, to be passed to a watch
+    callback.
+
+    :param items: A dict mapping the keys to their values.
+    :param revision:
+    :param deleted_keys: The keys deleted at the revision.
+    :return:
+    """
+    events = [new_event(kv_pb2.Event(type=kv_pb2.Event.PUT,
+                                     kv=kv_pb2.KeyValue(key=to_bytes(key), value=to_bytes(value),
+                                                        mod_revision=revision, create_revision=revision, version=1)))
+              for key, value in items.items()]
+    events.extend(new_event(kv_pb2.Event(type=kv_pb2.Event.DELETE,
+                                         kv=kv_pb2.KeyValue(key=to_bytes(key), mod_revision=revision)))
+                  for key in deleted_keys)
+    return WatchResponse(etcdrpc.ResponseHeader(revision=revision), events)
+
+
+class FakeWatchError(Exception):
+    """The error passed to the watch callbacks when the fake server goes down, like the grpc error of etcd3."""
+
+    def debug_error_string(self) -> str:
+        return 'grpc_status:14 - The fake etcd server is unavailable.'
+
+
+class FakeKVStub:
+    """The KV stub of a FakeEtcdClient, serving the paginated range requests of get_range_page()."""
+
+    def __init__(self, etcd_client):
+        self._etcd_client = etcd_client
+
+    def Range(self, range_request, timeout=None, credentials=None, metadata=None):
+        etcd_client = self._etcd_client
+        etcd_client._round_trip()
+        if range_request.revision and range_request.revision < etcd_client.compacted_revision:
+            raise RevisionCompactedError(etcd_client.compacted_revision)
+        # The fake keeps no past values, so a range at a past revision is served from the current values.
+        kvs = etcd_client._range(range_request.key, range_request.range_end or None)
+        page = kvs[:range_request.limit] if range_request.limit else kvs
+        return etcdrpc.RangeResponse(header=etcd_client._header(), kvs=page, count=len(kvs),
+                                     more=len(page) < len(kvs))
+
+
+class FakeEtcdClient:
+    """An in-memory stand-in for the etcd3 client, injected with WatchForChanges(..., etcd_client=...).
+    It implements the reads, transactions and watches used by the watcher. Writes are delivered synchronously to
+    the matching watches as WatchResponse objects on the writing thread.
+    Every request pays the given round trip time, so batched and unbatched reads can be compared offline.
+    """
+
+    def __init__(self, round_trip_time: float = 0.0):
+        self.round_trip_time = round_trip_time
+        self.round_trips = 0
+        self.revision = 1
+        self.compacted_revision = 0
+        self._history = []
+        self.transactions = Transactions()
+        self._kvs = {}
+        self._sorted_keys = []
+        self._watches = {}
+        self._next_watch_id = 0
+        self.is_available = True
+        # The attributes of an etcd3 client used to send requests on its stubs.
+        self.kvstub = FakeKVStub(self)
+        self.timeout = None
+        self.call_credentials = None
+        self.metadata = None
+
+    def _round_trip(self) -> None:
+        if not self.is_available:
+            raise ConnectionFailedError()
+        self.round_trips += 1
+        if self.round_trip_time:
+            time.sleep(self.round_trip_time)
+
+    def _header(self):
+        return etcdrpc.ResponseHeader(revision=self.revision)
+
+    def _range(self, key, range_end=None):
+        key = to_bytes(key)
+        if range_end is None:
+            return [self._kvs[key]] if key in self._kvs else []
+        start = bisect.bisect_left(self._sorted_keys, key)
+        end = bisect.bisect_left(self._sorted_keys, to_bytes(range_end))
+        return [self._kvs[k] for k in self._sorted_keys[start:end]]
+
+    def put(self, key, value) -> None:
+        self.put_many({key: value})
+
+    def put_many(self, items: dict) -> None:
+        """It writes all the items at one revision, like an etcd transaction, so each watch receives them
+        in one WatchResponse.
+
+        :param items: A dict mapping the keys to their values.
+        :return:
+        """
+        self.revision += 1
+        events = []
+        for key, value in items.items():
+            key = to_bytes(key)
+            previous = self._kvs.get(key)
+            if previous is None:
+                bisect.insort(self._sorted_keys, key)
+            kv = kv_pb2.KeyValue(key=key, value=to_bytes(value), mod_revision=self.revision,
+                                 create_revision=previous.create_revision if previous else self.revision,
+                                 version=previous.version + 1 if previous else 1)
+            self._kvs[key] = kv
+            events.append(kv_pb2.Event(type=kv_pb2.Event.PUT, kv=kv))
+        self._history.extend(events)
+        self._deliver(events)
+
+    def delete(self, key) -> None:
+        self.delete_many([key])
+
+    def delete_many(self, keys) -> None:
+        """It deletes all the existing keys at one revision, like an etcd transaction, delivering DeleteEvents.
+
+        :param keys:
+        :return:
+        """
+        keys = [to_bytes(key) for key in keys if to_bytes(key) in self._kvs]
+        if not keys:
+            return
+        self.revision += 1
+        events = []
+        for key in keys:
+            del self._kvs[key]
+            del self._sorted_keys[bisect.bisect_left(self._sorted_keys, key)]
+            events.append(kv_pb2.Event(type=kv_pb2.Event.DELETE, kv=kv_pb2.KeyValue(key=key,
+                                                                                   mod_revision=self.revision)))
+        self._history.extend(events)
+        self._deliver(events)
+
+    def disconnect(self) -> None:
+        """It simulates an outage: the watches fail with a grpc unavailable error and the requests fail with
+        ConnectionFailedError until reconnect() is called. Writes are still accepted, as if made by other clients.
+
+        :return:
+        """
+        self.is_available = False
+        self.fail_watches(FakeWatchError())
+
+    def reconnect(self) -> None:
+        """
+
+        :return:
+        """
+        self.is_available = True
+
+    def compact(self, revision) -> None:
+        self.compacted_revision = revision
+        self._history = [event for event in self._history if event.kv.mod_revision > revision]
+
+    def fail_watches(self, error) -> None:
+        """Cancels every watch and passes the error to its callback, as a broken watch stream does."""
+        watches = self._watches
+        self._watches = {}
+        for _, _, callback in watches.values():
+            callback(error)
+
+    @staticmethod
+    def _in_watch_range(event, key, range_end) -> bool:
+        return event.kv.key == key or (range_end is not None and key <= event.kv.key < range_end)
+
+    def _deliver(self, events: list) -> None:
+        for key, range_end, callback in list(self._watches.values()):
+            watch_events = [new_event(event) for event in events if self._in_watch_range(event, key, range_end)]
+            if watch_events:
+                callback(WatchResponse(self._header(), watch_events))
+
+    def get_response(self, key, **kwargs):
+        self._round_trip()
+        kvs = self._range(key)
+        return etcdrpc.RangeResponse(header=self._header(), kvs=kvs, count=len(kvs))
+
+    def get(self, key, **kwargs):
+        range_response = self.get_response(key)
+        if range_response.count < 1:
+            return None, None
+        kv = range_response.kvs[0]
+        return kv.value, KVMetadata(kv, range_response.header)
+
+    def get_prefix(self, key_prefix, **kwargs):
+        self._round_trip()
+        header = self._header()
+        return ((kv.value, KVMetadata(kv, header))
+                for kv in self._range(key_prefix, increment_last_byte(to_bytes(key_prefix))))
+
+    def transaction(self, compare, success=None, failure=None):
+        self._round_trip()
+        header = self._header()
+        responses = []
+        for operation in success or []:
+            responses.append([(kv.value, KVMetadata(kv, header))
+                              for kv in self._range(operation.key, operation.range_end)])
+        return True, responses
+
+    def add_watch_callback(self, key, callback, range_end=None, start_revision=None, **kwargs):
+        self._round_trip()
+        if start_revision and start_revision <= self.compacted_revision:
+            raise RevisionCompactedError(self.compacted_revision)
+        key = to_bytes(key)
+        range_end = to_bytes(range_end) if range_end else None
+        if start_revision:
+            replayed_events = [new_event(event) for event in self._history
+                               if event.kv.mod_revision >= start_revision
+                               and self._in_watch_range(event, key, range_end)]
+            if replayed_events:
+                callback(WatchResponse(self._header(), replayed_events))
+        self._next_watch_id += 1
+        self._watches[self._next_watch_id] = (key, range_end, callback)
+        return self._next_watch_id
+
+    def add_watch_prefix_callback(self, key_prefix, callback, **kwargs):
+        kwargs['range_end'] = increment_last_byte(to_bytes(key_prefix))
+        return self.add_watch_callback(key_prefix, callback, **kwargs)
+
+    def cancel_watch(self, watch_id) -> None:
+        self._watches.pop(watch_id, None)
@@ -0,0 +1,82 @@
+import threading
+
+from .sync_logger import logger
+from .parser_engine import ParserEngine
+from .watcher import WatchForChanges
+from .shared_snapshot import SharedSnapshotPublisher
+from .app_config import SHARED_SNAPSHOT_NAME, SHARED_SNAPSHOT_SIZE
+
+
+class HostAgent:
+    """The single process of a host owning the etcd watches and the ParserEngine.
+    It publishes the parsed snapshots into shared memory, and the worker processes of the host read them with a
+    SharedSnapshotReader. The etcd load and the deserialization work then scale per host instead of per process.
+    """
+
+    def __init__(self, keys: dict, watcher_kwargs: dict, name: str = SHARED_SNAPSHOT_NAME,
+                 size: int = SHARED_SNAPSHOT_SIZE, coalescing_window_seconds: float = 0.05):
+        """
+
+        :param keys: The keys to watch, as passed to WatchForChanges.start_watch_keys.
+        :param watcher_kwargs: The arguments of WatchForChanges, such as host, port, number_of_retries and
+                               retry_interval.
+        :param name: The name of the shared memory segment.
+        :param size: The maximum size of a published snapshot in bytes.
+        :param coalescing_window_seconds: The bursts of changes within this window are published once.
+        """
+        self.keys = keys
+        self.watcher_kwargs = watcher_kwargs
+        self.name = name
+        self.size = size
+        self.coalescing_window_seconds = coalescing_window_seconds
+        self.watcher = None
+        self.parser_engine = None
+        self.publisher = None
+        self._stop_event = threading.Event()
+
+    def start(self) -> None:
+        """It publishes the warm started snapshot, then loads the current one from etcd and keeps it up to date in
+        the background. It does not wait for etcd: when it is unreachable, the supervisor makes the first connection
+        and the workers keep reading the published snapshot meanwhile.
+
+        :return:
+        """
+        self.watcher = WatchForChanges(**self.watcher_kwargs)
+        self.parser_engine = ParserEngine(keys=self.keys, metrics=self.watcher.metrics)
+        self.publisher = SharedSnapshotPublisher(source=self.parser_engine, name=self.name, size=self.size)
+        # The publisher is notified after the ParserEngine has applied the batch.
+        self.watcher.attach(observer=self.parser_engine)
+        self.watcher.attach(observer=self.publisher)
+        if self.coalescing_window_seconds:
+            self.watcher.start_coalescing(window_seconds=self.coalescing_window_seconds)
+        self.watcher.warm_start(keys=self.keys)
+        self.publisher.publish()
+        self.watcher.start_watch_keys(keys=self.keys)
+        self.watcher.start_supervisor()
+        logger.info(f"The host agent publishes the snapshots into the shared memory segment '{self.name}'.")
+
+    def run(self) -> None:
+        """It starts the agent and blocks until stop() is called. It is the target of the agent process.
+
+        :return:
+        """
+        self.start()
+        try:
+            self._stop_event.wait()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def stop(self) -> None:
+        self._stop_event.set()
+
+    def close(self) -> None:
+        """
+
+        :return:
+        """
+        if self.watcher:
+            self.watcher.close_connection()
+        if self.publisher:
+            self.publisher.close()
@@ -0,0 +1,103 @@
+from typing import Any, List, NamedTuple, Union
+
+
+class _Missing:
+    """The value at a path that does not exist in a document."""
+    __slots__ = ()
+
+    def __repr__(self) -> str:
+        return 'MISSING'
+
+    def __bool__(self) -> bool:
+        return False
+
+
+MISSING = _Missing()
+
+
+class ValueChange(NamedTuple):
+    """A change at a path of a document. The old or the new value is MISSING when the path was added or removed."""
+    path: tuple
+    old_value: Any
+    new_value: Any
+
+
+def parse_path(path: Union[str, tuple, list]) -> tuple:
+    """
+
+    :param path: A dotted path, such as 'limits.rate' or 'regions.0.name', where the integers index the lists,
+                 or a tuple of keys and indexes. An empty path is the whole document.
+    :return: The path as a tuple.
+    """
+    if isinstance(path, (tuple, list)):
+        return tuple(path)
+    if not path:
+        return ()
+    return tuple(int(part) if part.isdigit() else part for part in path.split('.'))
+
+
+def get_path(document: Any, path: tuple) -> Any:
+    """
+
+    :param document: A deserialized document.
+    :param path: A tuple of keys and list indexes.
+    :return: The value at the path, or MISSING when it does not exist.
+    """
+    value = document
+    for part in path:
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list) and isinstance(part, int) and 0 <= part < len(value):
+            value = value[part]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def is_equal(old_value: Any, new_value: Any) -> bool:
+    """Unlike ==, 1, 1.0 and True are different values, as they are in the serialized document.
+
+    :return:
+    """
+    return old_value is new_value or (not diff(old_value, new_value))
+
+
+def diff(old_document: Any, new_document: Any) -> List[ValueChange]:
+    """It compares two deserialized documents structurally. The dicts are compared key by key and the lists index
+    by index, so only the values that changed are returned, at their deepest path.
+    The shared sub-documents are skipped without being walked, such as the ones shared by the deserializer cache.
+
+    :param old_document: The previous document, or MISSING when it did not exist.
+    :param new_document: The new document, or MISSING when it has been removed.
+    :return: The changes, the removed and the added values.
+    """
+    changes = []
+    _diff(old_document, new_document, (), changes)
+    return changes
+
+
+def _diff(old_value: Any, new_value: Any, path: tuple, changes: list) -> None:
+    if old_value is new_value:
+        return
+    if isinstance(old_value, dict) and isinstance(new_value, dict):
+        for key, old_item in old_value.items():
+            if key in new_value:
+                _diff(old_item, new_value[key], path + (key,), changes)
+            else:
+                changes.append(ValueChange(path + (key,), old_item, MISSING))
+        for key, new_item in new_value.items():
+            if key not in old_value:
+                changes.append(ValueChange(path + (key,), MISSING, new_item))
+        return
+    if isinstance(old_value, list) and isinstance(new_value, list):
+        for index in range(min(len(old_value), len(new_value))):
+            _diff(old_value[index], new_value[index], path + (index,), changes)
+        for index in range(len(new_value), len(old_value)):
+            changes.append(ValueChange(path + (index,), old_value[index], MISSING))
+        for index in range(len(old_value), len(new_value)):
+            changes.append(ValueChange(path + (index,), MISSING, new_value[index]))
+        return
+    if type(old_value) is not type(new_value) or old_value != new_value:
+        changes.append(ValueChange(path, old_value, new_value))
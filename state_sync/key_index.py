@@ -0,0 +1,126 @@
+from typing import Any, Iterator, List, Optional, Tuple
+
+
+class _KeyIndexNode:
+    __slots__ = ('children', 'exact_rule', 'prefix_rule')
+
+    def __init__(self):
+        self.children = {}
+        # Each rule is a (rule_key, payload) tuple.
+        self.exact_rule = None
+        self.prefix_rule = None
+
+
+class KeyIndex:
+    """A prefix trie over the defined keys.
+    A key matches an exact rule with the same name and every prefix rule it starts with.
+    All lookups walk the key once, so they take O(len(key)) whatever the number of rules.
+    """
+
+    def __init__(self):
+        self._root = _KeyIndexNode()
+        self._rules_count = 0
+
+    def __len__(self) -> int:
+        return self._rules_count
+
+    def add(self, rule_key: str, payload: Any = None, is_prefix: bool = False) -> None:
+        """
+
+        :param rule_key:
+        :param payload: The value returned with the rule on a match.
+        :param is_prefix: Whether the rule matches all the keys starting with rule_key.
+        :return:
+        """
+        node = self._root
+        for character in rule_key:
+            child = node.children.get(character)
+            if child is None:
+                child = node.children[character] = _KeyIndexNode()
+            node = child
+        if is_prefix:
+            if node.prefix_rule is None:
+                self._rules_count += 1
+            node.prefix_rule = (rule_key, payload)
+        else:
+            if node.exact_rule is None:
+                self._rules_count += 1
+            node.exact_rule = (rule_key, payload)
+
+    def remove(self, rule_key: str, is_prefix: bool = False) -> None:
+        """
+
+        :param rule_key:
+        :param is_prefix:
+        :return:
+        """
+        path = [self._root]
+        for character in rule_key:
+            child = path[-1].children.get(character)
+            if child is None:
+                return
+            path.append(child)
+        node = path[-1]
+        if is_prefix and node.prefix_rule is not None:
+            node.prefix_rule = None
+            self._rules_count -= 1
+        elif not is_prefix and node.exact_rule is not None:
+            node.exact_rule = None
+            self._rules_count -= 1
+        # Prune the branches that do not lead to any rule anymore.
+        for index in range(len(rule_key), 0, -1):
+            node = path[index]
+            if node.children or node.exact_rule is not None or node.prefix_rule is not None:
+                break
+            del path[index - 1].children[rule_key[index - 1]]
+
+    def _walk(self, key: str) -> Iterator[_KeyIndexNode]:
+        node = self._root
+        yield node
+        for character in key:
+            node = node.children.get(character)
+            if node is None:
+                return
+            yield node
+
+    def match(self, key: str) -> List[Tuple[str, Any]]:
+        """It returns every rule matching the key, from the shortest prefix rule to the exact rule.
+
+        :param key:
+        :return:
+        """
+        rules = []
+        key_length = len(key)
+        for depth, node in enumerate(self._walk(key)):
+            if node.prefix_rule is not None:
+                rules.append(node.prefix_rule)
+            if depth == key_length and node.exact_rule is not None:
+                rules.append(node.exact_rule)
+        return rules
+
+    def longest_match(self, key: str) -> Optional[Tuple[str, Any]]:
+        """It returns the most specific rule matching the key.
+        An exact rule wins over a prefix rule, and a longer prefix rule wins over a shorter one.
+
+        :param key:
+        :return: The (rule_key, payload) tuple or None when no rule matches.
+        """
+        best_rule = None
+        key_length = len(key)
+        for depth, node in enumerate(self._walk(key)):
+            if depth == key_length and node.exact_rule is not None:
+                return node.exact_rule
+            if node.prefix_rule is not None:
+                best_rule = node.prefix_rule
+        return best_rule
+
+    def shortest_prefix_match(self, key: str) -> Optional[Tuple[str, Any]]:
+        """It returns the shortest prefix rule covering the key, including a prefix rule equal to the key.
+
+        :param key:
+        :return: The (rule_key, payload) tuple or None when no prefix rule covers the key.
+        """
+        for node in self._walk(key):
+            if node.prefix_rule is not None:
+                return node.prefix_rule
+        return None
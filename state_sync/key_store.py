@@ -0,0 +1,138 @@
+from collections import OrderedDict
+from typing import Iterator, List, Optional
+
+from .lazy_value import LazyValue
+
+
+class Entry:
+    """The value of a watched key with the mod_revision and the lease it was written with."""
+    __slots__ = ('value', 'revision', 'lease')
+
+    def __init__(self, value, revision: int, lease: int = 0):
+        self.value = value
+        self.revision = revision
+        self.lease = lease
+
+    def __repr__(self) -> str:
+        return f"Entry(value={self.value!r}, revision={self.revision}, lease={self.lease})"
+
+
+def value_size(key: str, value) -> int:
+    """
+
+    :return: The approximate number of bytes of the key and the value as received from etcd.
+    """
+    if isinstance(value, LazyValue):
+        return len(key) + len(value.raw)
+    if isinstance(value, (str, bytes)):
+        return len(key) + len(value)
+    return len(key)
+
+
+class KeyStore:
+    """It keeps an Entry per watched key, used to skip the stale changes and to remove the deleted keys.
+    The keys discovered under a prefix, which are not defined keys, can be bounded by a number of keys and a byte
+    budget. When a bound is exceeded, the least recently written discovered keys are evicted.
+    """
+
+    def __init__(self, max_discovered_keys: Optional[int] = None, max_discovered_bytes: Optional[int] = None):
+        """
+
+        :param max_discovered_keys: The maximum number of keys discovered under a prefix. None is unbounded.
+        :param max_discovered_bytes: The maximum size of the keys discovered under a prefix and of their values,
+                                     in bytes. None is unbounded.
+        """
+        if max_discovered_keys is not None and max_discovered_keys < 1:
+            raise ValueError("max_discovered_keys must be at least 1.")
+        self.max_discovered_keys = max_discovered_keys
+        self.max_discovered_bytes = max_discovered_bytes
+        self._entries = {}
+        # It maps the discovered keys to their size, from the least to the most recently written.
+        # It is only kept when a bound is set.
+        self._discovered_sizes = OrderedDict()
+        self.discovered_bytes = 0
+        self.evictions_count = 0
+
+    @property
+    def is_bounded(self) -> bool:
+        return self.max_discovered_keys is not None or self.max_discovered_bytes is not None
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self._entries
+
+    def get(self, key: str) -> Optional[Entry]:
+        return self._entries.get(key)
+
+    def revision(self, key: str) -> int:
+        """
+
+        :return: The mod_revision of the last change applied on the key, or 0 when it is not stored.
+        """
+        entry = self._entries.get(key)
+        return 0 if entry is None else entry.revision
+
+    def put(self, key: str, value, revision: int, lease: int = 0, is_discovered: bool = False) -> List[str]:
+        """
+
+        :param key:
+        :param value:
+        :param revision: The mod_revision of the change.
+        :param lease: The id of the lease attached to the key, 0 when it has none.
+        :param is_discovered: Whether the key has been discovered under a prefix key rather than defined itself.
+        :return: The keys evicted to stay within the bounds.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self._entries[key] = Entry(value, revision, lease)
+        else:
+            entry.value = value
+            entry.revision = revision
+            entry.lease = lease
+        if not is_discovered or not self.is_bounded:
+            return []
+        discovered_sizes = self._discovered_sizes
+        previous_size = discovered_sizes.pop(key, 0)
+        size = value_size(key, value)
+        discovered_sizes[key] = size
+        self.discovered_bytes += size - previous_size
+        evicted_keys = []
+        while len(discovered_sizes) > 1 and (
+                (self.max_discovered_keys is not None and len(discovered_sizes) > self.max_discovered_keys) or
+                (self.max_discovered_bytes is not None and self.discovered_bytes > self.max_discovered_bytes)):
+            evicted_key, evicted_size = discovered_sizes.popitem(last=False)
+            self.discovered_bytes -= evicted_size
+            del self._entries[evicted_key]
+            evicted_keys.append(evicted_key)
+        self.evictions_count += len(evicted_keys)
+        return evicted_keys
+
+    def delete(self, key: str) -> bool:
+        """
+
+        :param key:
+        :return: False when the key is not stored.
+        """
+        if self._entries.pop(key, None) is None:
+            return False
+        size = self._discovered_sizes.pop(key, None)
+        if size is not None:
+            self.discovered_bytes -= size
+        return True
+
+    def keys(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def stats(self) -> dict:
+        """
+
+        :return:
+        """
+        return {
+            'keys': len(self._entries),
+            'discovered_keys': len(self._discovered_sizes),
+            'discovered_bytes': self.discovered_bytes,
+            'evictions': self.evictions_count,
+        }
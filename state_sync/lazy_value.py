@@ -0,0 +1,58 @@
+from typing import Any, Callable, Optional
+
+_UNSET = object()
+
+
+def decode_utf8(raw: bytes) -> str:
+    return raw.decode('utf-8')
+
+
+class LazyValue:
+    """It holds the raw bytes of an etcd value and decodes them only on first access, memoizing the result.
+    Two threads reading it at the same time may both decode it, but they always get equal values.
+    """
+
+    __slots__ = ('raw', '_decoder', '_value')
+
+    def __init__(self, raw: bytes, decoder: Optional[Callable[[bytes], Any]] = None):
+        """
+
+        :param raw: The value bytes as received from etcd.
+        :param decoder: It converts the raw bytes into the value. Defaults to utf-8 decoding.
+        """
+        self.raw = raw
+        self._decoder = decoder or decode_utf8
+        self._value = _UNSET
+
+    @property
+    def value(self) -> Any:
+        value = self._value
+        if value is _UNSET:
+            value = self._value = self._decoder(self.raw)
+        return value
+
+    @property
+    def is_decoded(self) -> bool:
+        return self._value is not _UNSET
+
+    def with_decoder(self, decoder: Callable[[bytes], Any]) -> 'LazyValue':
+        """It returns a new lazy value sharing the same raw bytes, decoded by the given decoder.
+
+        :param decoder:
+        :return:
+        """
+        return LazyValue(raw=self.raw, decoder=decoder)
+
+    def __repr__(self) -> str:
+        if self.is_decoded:
+            return f"LazyValue({self._value!r})"
+        return f"LazyValue(<{len(self.raw)} raw bytes>)"
+
+
+def resolve(value) -> Any:
+    """
+
+    :param value:
+    :return: The decoded value of a LazyValue, or the value itself.
+    """
+    return value.value if type(value) is LazyValue else value
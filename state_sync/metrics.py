@@ -0,0 +1,212 @@
+import bisect
+import threading
+from typing import Optional, Sequence
+
+# The upper bounds in seconds of the latency buckets, from deserializing a small value to a slow reconnect.
+DEFAULT_LATENCY_BUCKETS = (0.00001, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 30.0)
+
+
+class Histogram:
+    """Cumulative latency buckets with the count, sum and maximum of the observed values.
+    It is not thread safe, SyncMetrics updates it under its lock.
+    """
+
+    __slots__ = ('buckets', 'bucket_counts', 'count', 'sum', 'max')
+
+    def __init__(self, buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        # The last slot counts the values above the largest bucket.
+        self.bucket_counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float) -> None:
+        self.bucket_counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, quantile: float) -> float:
+        """It estimates the quantile as the upper bound of the bucket holding it.
+
+        :param quantile: Between 0 and 1.
+        :return:
+        """
+        if not self.count:
+            return 0.0
+        rank = quantile * self.count
+        cumulative = 0
+        for upper_bound, bucket_count in zip(self.buckets, self.bucket_counts):
+            cumulative += bucket_count
+            if cumulative >= rank:
+                return min(upper_bound, self.max)
+        return self.max
+
+    def stats(self) -> dict:
+        return {
+            'count': self.count,
+            'total_seconds': self.sum,
+            'avg_seconds': self.sum / self.count if self.count else 0.0,
+            'max_seconds': self.max,
+            'p50_seconds': self.quantile(0.5),
+            'p99_seconds': self.quantile(0.99),
+        }
+
+
+def _escape_label_value(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class SyncMetrics:
+    """The counters of a watcher. They are updated on the hot path, so each record_ method takes the lock once
+    and does no formatting. A watcher created with metrics disabled has no SyncMetrics at all, and the hot path
+    then only pays for a None check.
+    """
+
+    def __init__(self, latency_buckets: Sequence[float] = DEFAULT_LATENCY_BUCKETS):
+        self.latency_buckets = tuple(latency_buckets)
+        self._lock = threading.Lock()
+        # Watch key -> number of events
+        self.events_received = {}
+        # Watch key -> number of key and value bytes
+        self.bytes_received = {}
+        self.end_to_end_latency = Histogram(self.latency_buckets)
+        # Serialization format -> Histogram
+        self.deserialize_latency = {}
+        # Observer name -> Histogram
+        self.observer_latency = {}
+        self.reconnects_count = 0
+        self.reconnect_latency = Histogram(self.latency_buckets)
+
+    def record_events(self, watch_key, events_count: int, bytes_count: int) -> None:
+        """
+
+        :param watch_key: The key of the watch that delivered the events.
+        :param events_count:
+        :param bytes_count: The size of the received keys and values.
+        :return:
+        """
+        with self._lock:
+            self.events_received[watch_key] = self.events_received.get(watch_key, 0) + events_count
+            self.bytes_received[watch_key] = self.bytes_received.get(watch_key, 0) + bytes_count
+
+    def record_end_to_end(self, seconds: float) -> None:
+        """
+
+        :param seconds: The time from receiving a batch from etcd until all the observers have processed it.
+        :return:
+        """
+        with self._lock:
+            self.end_to_end_latency.observe(seconds)
+
+    def record_deserialize(self, serialization: str, seconds: float) -> None:
+        """
+
+        :param serialization:
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            histogram = self.deserialize_latency.get(serialization)
+            if histogram is None:
+                histogram = self.deserialize_latency[serialization] = Histogram(self.latency_buckets)
+            histogram.observe(seconds)
+
+    def record_observer(self, observer_name: str, seconds: float) -> None:
+        """
+
+        :param observer_name:
+        :param seconds:
+        :return:
+        """
+        with self._lock:
+            histogram = self.observer_latency.get(observer_name)
+            if histogram is None:
+                histogram = self.observer_latency[observer_name] = Histogram(self.latency_buckets)
+            histogram.observe(seconds)
+
+    def record_reconnect(self, seconds: float) -> None:
+        """
+
+        :param seconds: The time taken to connect again and resume the watches.
+        :return:
+        """
+        with self._lock:
+            self.reconnects_count += 1
+            self.reconnect_latency.observe(seconds)
+
+    def stats(self) -> dict:
+        """
+
+        :return: A copy of all the counters.
+        """
+        with self._lock:
+            return {
+                'events_received': dict(self.events_received),
+                'bytes_received': dict(self.bytes_received),
+                'end_to_end_latency': self.end_to_end_latency.stats(),
+                'deserialize_latency': {serialization: histogram.stats()
+                                        for serialization, histogram in self.deserialize_latency.items()},
+                'observer_latency': {name: histogram.stats() for name, histogram in self.observer_latency.items()},
+                'reconnects': self.reconnects_count,
+                'reconnect_latency': self.reconnect_latency.stats(),
+            }
+
+    def to_prometheus(self, namespace: str = 'state_sync') -> str:
+        """It renders the counters in the Prometheus text exposition format.
+
+        :param namespace: The prefix of the metric names.
+        :return:
+        """
+        lines = []
+        with self._lock:
+            self._counter_lines(lines, f'{namespace}_events_received_total', 'Watch events received.',
+                                'watch', self.events_received)
+            self._counter_lines(lines, f'{namespace}_bytes_received_total', 'Key and value bytes received.',
+                                'watch', self.bytes_received)
+            self._histogram_lines(lines, f'{namespace}_end_to_end_latency_seconds',
+                                  'Time from receiving a batch until the observers have processed it.',
+                                  None, {None: self.end_to_end_latency})
+            self._histogram_lines(lines, f'{namespace}_deserialize_latency_seconds',
+                                  'Time spent deserializing values.', 'format', self.deserialize_latency)
+            self._histogram_lines(lines, f'{namespace}_observer_latency_seconds',
+                                  'Time spent in the observers.', 'observer', self.observer_latency)
+            self._counter_lines(lines, f'{namespace}_reconnects_total', 'Reconnections to etcd.',
+                                None, {None: self.reconnects_count})
+            self._histogram_lines(lines, f'{namespace}_reconnect_latency_seconds',
+                                  'Time taken to reconnect and resume the watches.',
+                                  None, {None: self.reconnect_latency})
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(label_name: Optional[str], label_value, extra: str = '') -> str:
+        labels = []
+        if label_name is not None:
+            labels.append(f'{label_name}="{_escape_label_value(label_value)}"')
+        if extra:
+            labels.append(extra)
+        return '{' + ','.join(labels) + '}' if labels else ''
+
+    def _counter_lines(self, lines: list, name: str, help_text: str, label_name: Optional[str],
+                       values: dict) -> None:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} counter')
+        for label_value, value in values.items():
+            lines.append(f'{name}{self._labels(label_name, label_value)} {value}')
+
+    def _histogram_lines(self, lines: list, name: str, help_text: str, label_name: Optional[str],
+                         histograms: dict) -> None:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} histogram')
+        for label_value, histogram in histograms.items():
+            cumulative = 0
+            for upper_bound, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                cumulative += bucket_count
+                bucket_labels = self._labels(label_name, label_value, 'le="%s"' % upper_bound)
+                lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+            bucket_labels = self._labels(label_name, label_value, 'le="+Inf"')
+            lines.append(f'{name}_bucket{bucket_labels} {histogram.count}')
+            lines.append(f'{name}_sum{self._labels(label_name, label_value)} {histogram.sum}')
+            lines.append(f'{name}_count{self._labels(label_name, label_value)} {histogram.count}')
@@ -1,87 +1,314 @@
+import threading
+from functools import partial
+
 from .sync_logger import logger
-from .abstract_observer import Observer
-from .deserializer import JSONDeserializer
-from .app_config import ADD_NEW_WATCH_CHANGES_ON_PREFIX, SERIALIZATION_SUPPORT
+from .abstract_observer import Observer, DELETED
+from .deserializer import DeserializerRegistry, CachingDeserializerHandler
+from .key_index import KeyIndex
+from .lazy_value import LazyValue, resolve
+from .config_snapshot import ConfigSnapshot
+from .json_diff import MISSING, diff, get_path, is_equal, parse_path
+from .watcher import CallBackTypeEnum, split_deletes
+from .app_config import ADD_NEW_WATCH_CHANGES_ON_PREFIX
 
 
 class ParserEngine(Observer):
     """It serializes and deserializes the data in different formats.
     """
 
-    def __init__(self, keys: dict):
+    def __init__(self, keys: dict, metrics=None):
+        """
+
+        :param keys:
+        :param metrics: The SyncMetrics receiving the deserialization times, such as watcher.metrics.
+        """
         self.keys = keys
-        self.data = {}
-        self.deserializer_handler_instance = JSONDeserializer()
+        # Each applied batch publishes a new immutable snapshot of the parsed data.
+        self._snapshot = ConfigSnapshot()
+        self._write_lock = threading.Lock()
+        # New formats are added with deserializer_registry.register(name, AbstractDataDeserializer).
+        self.deserializer_registry = DeserializerRegistry(metrics=metrics)
+        self.deserializer_handler_instance = CachingDeserializerHandler(successor=self.deserializer_registry)
+        self.key_index = None
+        self.build_key_index()
+        # It maps each key to a dict mapping the subscribed paths of its document to their observers.
+        # The dicts are replaced on each subscription change, so they are read without locking.
+        self._path_subscriptions = {}
+        self._path_subscriptions_lock = threading.Lock()
+
+    def build_key_index(self) -> None:
+        """It compiles the defined keys into a prefix trie, so each key resolves to its most specific rule
+        in O(len(key)), whatever the number of defined keys.
+
+        :return:
+        """
+        key_index = KeyIndex()
+        for key, keys_details in self.keys.items():
+            is_prefix = isinstance(keys_details, dict) and \
+                keys_details.get('call_back_type') == CallBackTypeEnum.PREFIX_TYPE.value
+            key_index.add(key, keys_details, is_prefix=is_prefix)
+        self.key_index = key_index
+
+    @property
+    def data(self) -> ConfigSnapshot:
+        return self._snapshot
+
+    def snapshot(self) -> ConfigSnapshot:
+        """It returns the latest immutable snapshot of the parsed data.
+        The snapshot is a consistent view tagged with its etcd revision, and reading it needs no locking.
+
+        :return:
+        """
+        return self._snapshot
+
+    def update_batch(self, changes: dict) -> None:
+        """It parses all the changes of the batch and publishes them as a single snapshot.
+
+        :param changes:
+        :return:
+        """
+        logger.debug("A batch of %s changes has been received in the ParserEngine.", len(changes))
+        updates = {}
+        for key, value in changes.items():
+            if value is DELETED:
+                updates[key] = DELETED
+            else:
+                self.template_method(key=key, value=value, updates=updates)
+        self._publish_snapshot(updates=updates, revision=getattr(changes, 'revision', None))
+
+    def _publish_snapshot(self, updates: dict, revision: int = None) -> None:
+        """
+
+        :param updates: A dict mapping the changed keys to their parsed value, or to DELETED.
+        :param revision:
+        :return:
+        """
+        path_subscriptions = self._path_subscriptions
+        document_changes = []
+        with self._write_lock:
+            snapshot = self._snapshot
+            if revision is not None and snapshot.revision is not None and revision < snapshot.revision:
+                revision = snapshot.revision
+            if updates or revision is not None:
+                updated_values, deletes = split_deletes(updates)
+                self._snapshot = snapshot.evolve(updates=updated_values, deletes=deletes, revision=revision)
+            if path_subscriptions:
+                # The previous documents are taken under the lock, so each change is diffed against the one it
+                # replaces.
+                document_changes = [(key, snapshot.get(key, MISSING), MISSING if value is DELETED else resolve(value))
+                                    for key, value in updates.items() if key in path_subscriptions]
+        for key, old_document, new_document in document_changes:
+            self._notify_path_observers(key=key, old_document=old_document, new_document=new_document)
+
+    def attach_path(self, observer, key: str, path) -> None:
+        """It subscribes a PathObserver to a path of the deserialized document of a key, such as
+        attach_path(observer, key='/customer_config/customer1/', path='limits.rate').
+        The observer is notified with the old and the new value only when the value at that path changes.
+
+        :param observer: A PathObserver.
+        :param key: The key of the document.
+        :param path: A dotted path, where the integers index the lists, or a tuple of keys and list indexes.
+                     An empty path subscribes to the whole document.
+        :return:
+        """
+        path = parse_path(path)
+        with self._path_subscriptions_lock:
+            key_subscriptions = dict(self._path_subscriptions.get(key, {}))
+            key_subscriptions[path] = key_subscriptions.get(path, ()) + (observer,)
+            self._path_subscriptions = {**self._path_subscriptions, key: key_subscriptions}
+
+    def detach_path(self, observer, key: str, path) -> None:
+        """
+
+        :param observer:
+        :param key:
+        :param path:
+        :return:
+        """
+        path = parse_path(path)
+        with self._path_subscriptions_lock:
+            path_subscriptions = dict(self._path_subscriptions)
+            key_subscriptions = dict(path_subscriptions.get(key, {}))
+            observers = key_subscriptions.get(path, ())
+            if observer not in observers:
+                raise ValueError("The observer is not attached to this path.")
+            observers = tuple(path_observer for path_observer in observers if path_observer is not observer)
+            if observers:
+                key_subscriptions[path] = observers
+            else:
+                del key_subscriptions[path]
+            if key_subscriptions:
+                path_subscriptions[key] = key_subscriptions
+            else:
+                del path_subscriptions[key]
+            self._path_subscriptions = path_subscriptions
+
+    def _notify_path_observers(self, key: str, old_document, new_document) -> None:
+        """It diffs the documents once, and notifies the observers of the paths at, above or below a change,
+        whose value differs.
+
+        :param key:
+        :param old_document:
+        :param new_document:
+        :return:
+        """
+        key_subscriptions = self._path_subscriptions.get(key)
+        if not key_subscriptions:
+            return
+        changes = diff(old_document, new_document)
+        if not changes:
+            return
+        changed_paths = {change.path for change in changes}
+        # A subscribed path is affected by the changes below it, and by the changes replacing one of its parents.
+        changed_parents = {change.path[:depth] for change in changes for depth in range(len(change.path))}
+        for path, observers in key_subscriptions.items():
+            if path not in changed_parents and not any(path[:depth] in changed_paths
+                                                       for depth in range(len(path) + 1)):
+                continue
+            old_value = get_path(old_document, path)
+            new_value = get_path(new_document, path)
+            if is_equal(old_value, new_value):
+                continue
+            logger.debug("The path '%s' of the key '%s' has changed.", path, key)
+            for observer in observers:
+                try:
+                    observer.update_path(key, path, old_value, new_value)
+                except Exception as e:
+                    logger.error(f"Path observer exception on the path {path} of the key '{key}': {e}")
+
+    def delete_received(self, key: str) -> None:
+        logger.debug("A deletion has been received in the ParserEngine.. key : '%s'", key)
+        self._publish_snapshot(updates={key: DELETED})
 
     def update_received(self, key: str, value: str) -> None:
-        logger.debug(f"An update has been received in the ParserEngine.. key : '{key}' -  value : '{value}'")
+        logger.debug("An update has been received in the ParserEngine.. key : '%s' -  value : '%s'", key, value)
         self.template_method(key=key, value=value)
 
-    def update_the_new_changes(self, key: str, value):
+    def update_the_new_changes(self, key: str, value, updates: dict = None):
         """
 
         :param key:
         :param value:
+        :param updates: When it is given, the change is collected there and published with its batch.
         :return:
         """
-        self.data[key] = value
+        if updates is None:
+            self._publish_snapshot(updates={key: value})
+        else:
+            updates[key] = value
 
-    def template_method(self, key: str, value: str) -> None:
+    def template_method(self, key: str, value: str, updates: dict = None) -> None:
         """
 
         :param key:
         :param value:
+        :param updates: When it is given, the changes are collected there and published with their batch.
         :return:
         """
 
-        if key in self.keys:
-            keys_details = self.keys.get(key)
-            if isinstance(keys_details, dict) and 'serialization' in keys_details:
-                serialization = keys_details.get('serialization')
-                logger.info(f"The serialization key exists in the defined keys, and deserialization is being applied."
-                            f" {serialization}.")
-                is_deserialized, data = self.deserializer_handler_instance.handle_request(serialization=serialization,
-                                                                                          data=value)
-                if is_deserialized:
-                    self.update_the_new_changes(key=key, value=data)
-                else:
-                    logger.info(f"The data was not successfully deserialized.")
+        # The defined keys are edited in place when a watch is stopped.
+        if len(self.key_index) != len(self.keys):
+            self.build_key_index()
+
+        rule = self.key_index.longest_match(key)
+        if rule is None:
+            logger.info("Changes have been detected on a key that does not exist in our defined keys.")
+            self.parse_undefined_keys_base_on_prefix(key=key, value=value, updates=updates)
+            return
+
+        # A key under a prefix key is defined by it and uses its settings.
+        rule_key, keys_details = rule
+        if isinstance(keys_details, dict) and 'serialization' in keys_details:
+            serialization = keys_details.get('serialization')
+            if isinstance(value, LazyValue):
+                # The value is deserialized from the shared raw bytes when it is first read.
+                self.update_the_new_changes(key=key, value=value.with_decoder(partial(self._deserialize_raw,
+                                                                                      serialization)),
+                                            updates=updates)
+                return
+            logger.info("The serialization key exists in the defined key '%s', and deserialization is "
+                        "being applied. %s.", rule_key, serialization)
+            is_deserialized, data = self.deserializer_handler_instance.handle_request(serialization=serialization,
+                                                                                      data=value)
+            if is_deserialized:
+                self.update_the_new_changes(key=key, value=data, updates=updates)
             else:
-                logger.info("Key-value pairs have been successfully stored..")
-                self.update_the_new_changes(key=key, value=value)
+                logger.error(f"The data of the key '{key}' was not successfully deserialized using the "
+                             f"'{serialization}' method.")
+        elif rule_key == key:
+            logger.info("Key-value pairs have been successfully stored..")
+            self.update_the_new_changes(key=key, value=value, updates=updates)
         else:
-            logger.info("Changes have been detected on a key that does not exist in our defined keys.")
-            self.parse_undefined_keys_base_on_prefix(key=key, value=value)
+            logger.info("Changes have been detected on a key under the prefix '%s', which does not define "
+                        "a serialization.", rule_key)
+            self.sniff_and_store(key=key, value=value, updates=updates)
 
-    def parse_undefined_keys_base_on_prefix(self, key: str, value: str) -> None:
+    def parse_undefined_keys_base_on_prefix(self, key: str, value: str, updates: dict = None) -> None:
         """
 
         :param key:
         :param value:
+        :param updates: When it is given, the changes are collected there and published with their batch.
         :return:
         """
         if ADD_NEW_WATCH_CHANGES_ON_PREFIX:
             logger.info("ADD_NEW_WATCH_CHANGES_ON_PREFIX is enabled.")
-            # There might be a key that requires different types of deserialization,
-            # so applying a brute force technique to handle it.
-            is_deserialized = False
-            logger.debug("Applying different deserialization techniques to the key and value.")
-            data = None
-            for serialization in SERIALIZATION_SUPPORT:
-                logger.debug(f"Trying to deserialized data with : '{serialization}' method.")
-                is_deserialized_data, data = self.deserializer_handler_instance.handle_request(serialization=
-                                                                                               serialization,
-                                                                                               data=value)
-                if is_deserialized_data:
-                    is_deserialized = True
-                    logger.info(f"The data has been successfully deserialized using '{serialization}' method.")
-                    self.update_the_new_changes(key=key, value=data)
-                    break
-                logger.info(f"The data was not successfully deserialized using the '{serialization}' method.")
-            if not is_deserialized:
-                self.update_the_new_changes(key=key, value=value)
-                logger.info(f"All available deserialization methods '{SERIALIZATION_SUPPORT}' were applied to the data,"
-                            f" but it was not successfully deserialized. Therefore, the data will be stored as it is.")
+            self.sniff_and_store(key=key, value=value, updates=updates)
         else:
             logger.info("If you want to detect these changes as well, you can enable the configuration "
                         "option 'ADD_NEW_WATCH_CHANGES_ON_PREFIX' and set it to True.")
+
+    def sniff_and_store(self, key: str, value: str, updates: dict = None) -> None:
+        """It stores a value whose format is not defined, deserialized when it matches a registered format.
+
+        :param key:
+        :param value:
+        :param updates: When it is given, the changes are collected there and published with their batch.
+        :return:
+        """
+        if isinstance(value, LazyValue):
+            self.update_the_new_changes(key=key, value=value.with_decoder(self._sniff_and_deserialize_raw),
+                                        updates=updates)
+            return
+        # The format is sniffed from the leading bytes of the value, so a single deserializer is applied.
+        serialization = self.deserializer_registry.sniff(value)
+        if serialization is not None:
+            logger.debug("The data looks like '%s'.", serialization)
+            is_deserialized, data = self.deserializer_handler_instance.handle_request(serialization=serialization,
+                                                                                      data=value)
+            if is_deserialized:
+                logger.info("The data has been successfully deserialized using '%s' method.", serialization)
+                self.update_the_new_changes(key=key, value=data, updates=updates)
+                return
+            logger.debug("The data looked like '%s', but it was not successfully deserialized.", serialization)
+        self.update_the_new_changes(key=key, value=value, updates=updates)
+        logger.info("The data does not match any of the registered formats '%s', so it will be stored as it is.",
+                    self.deserializer_registry.serializations)
+
+    def _deserialize_raw(self, serialization, raw: bytes, is_sniffed: bool = False):
+        """It is the decoder of the lazy values. Unlike the eager path, a value that cannot be deserialized is not
+        dropped, because it is only read after being stored, so it resolves to its text instead.
+
+        :param serialization: The format of the value, or None when it is unknown.
+        :param raw:
+        :param is_sniffed: Whether the format has been sniffed rather than defined, so a failure is expected.
+        :return:
+        """
+        if serialization is not None:
+            is_deserialized, data = self.deserializer_handler_instance.handle_request(serialization=serialization,
+                                                                                      data=raw)
+            if is_deserialized:
+                return data
+            if is_sniffed:
+                logger.debug("The data looked like '%s', but it was not successfully deserialized.", serialization)
+            else:
+                logger.error(f"The data was not successfully deserialized using the '{serialization}' method.")
+        return raw.decode('utf-8')
+
+    def _sniff_and_deserialize_raw(self, raw: bytes):
+        """
+
+        :param raw:
+        :return:
+        """
+        return self._deserialize_raw(serialization=self.deserializer_registry.sniff(raw), raw=raw, is_sniffed=True)
@@ -0,0 +1,249 @@
+import mmap
+import os
+import pickle
+import struct
+import threading
+import time
+from multiprocessing import shared_memory
+from typing import Optional
+
+from .sync_logger import logger
+from .abstract_observer import Observer
+from .config_snapshot import ConfigSnapshot
+from .lazy_value import LazyValue, resolve
+from .app_config import SHARED_SNAPSHOT_NAME, SHARED_SNAPSHOT_SIZE
+
+_MAGIC = b'SSYN'
+# The payload is the pickled dict mapping each key to the pickled bytes of its value.
+_FORMAT_VERSION = 2
+# Where Linux exposes the POSIX shared memory segments as files.
+_SHM_DIRECTORY = '/dev/shm'
+_MISSING = object()
+# magic, format version, sequence, revision (-1 when unknown), payload size, publish time
+_HEADER = struct.Struct('<4sIQqQd')
+_SEQUENCE = struct.Struct('<Q')
+_SEQUENCE_OFFSET = 8
+_PAYLOAD_OFFSET = 64
+
+
+class SharedSnapshotPublisher(Observer):
+    """It publishes the snapshot of its source into a shared memory segment after each batch, so the worker
+    processes of the host read the config without watching etcd themselves.
+    The segment is guarded by a sequence lock: the sequence is odd while a snapshot is being written, and the
+    readers retry when it changed during their copy. Attach it after the source observer, such as the ParserEngine,
+    so the source has applied the batch when it is published.
+    Each publish writes the whole snapshot, so copying it costs O(total keys). Only the values of the changed keys of
+    the batch are decoded and pickled again, the others are reused from the previous publish, and an unchanged
+    snapshot is not published again. Coalescing the changes bounds the publish rate.
+    """
+
+    def __init__(self, source, name: str = SHARED_SNAPSHOT_NAME, size: int = SHARED_SNAPSHOT_SIZE):
+        """
+
+        :param source: An object with a snapshot() method, such as the ParserEngine or the watcher.
+        :param name: The name of the shared memory segment.
+        :param size: The maximum size of a published snapshot in bytes. The memory is only used as it is written.
+        """
+        self._source = source
+        self.name = name
+        self._lock = threading.Lock()
+        try:
+            self._shared_memory = shared_memory.SharedMemory(name=name, create=True, size=_PAYLOAD_OFFSET + size)
+            self._sequence = 0
+        except FileExistsError:
+            # The segment of a previous agent is reused, so the workers still attached to it keep reading.
+            self._shared_memory = shared_memory.SharedMemory(name=name)
+            self._sequence = (_SEQUENCE.unpack_from(self._shared_memory.buf, _SEQUENCE_OFFSET)[0] + 1) & ~1
+        self.capacity = self._shared_memory.size - _PAYLOAD_OFFSET
+        # They map each published key to its stored value and to its pickled value, so a value is only decoded and
+        # pickled when it is published for the first time.
+        self._published_values = {}
+        self._pickled_values = {}
+        self._published_snapshot = None
+        self.published_count = 0
+        self.published_bytes = 0
+
+    def update_received(self, key: str, value: str) -> None:
+        self.publish(changed_keys=(key,))
+
+    def update_batch(self, changes: dict) -> None:
+        self.publish(changed_keys=changes)
+
+    def publish(self, changed_keys=None) -> bool:
+        """It writes the current snapshot of the source into the segment, unless it has already been published.
+
+        :param changed_keys: The keys changed since the previous publish. When it is None, every key is checked.
+        :return: False when the snapshot does not fit into the segment.
+        """
+        with self._lock:
+            snapshot = self._source.snapshot()
+            if snapshot is self._published_snapshot:
+                return True
+            if changed_keys is None or self._published_snapshot is None:
+                published_values = {}
+                pickled_values = {}
+                for key, stored_value in snapshot.raw_items():
+                    published_values[key] = stored_value
+                    pickled_values[key] = self._pickle_value(key, stored_value)
+                self._published_values = published_values
+                self._pickled_values = pickled_values
+            else:
+                for key in changed_keys:
+                    stored_value = snapshot.raw_get(key, _MISSING)
+                    if stored_value is _MISSING:
+                        self._published_values.pop(key, None)
+                        self._pickled_values.pop(key, None)
+                    else:
+                        self._pickled_values[key] = self._pickle_value(key, stored_value)
+                        self._published_values[key] = stored_value
+            payload = pickle.dumps(self._pickled_values, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(payload) > self.capacity:
+                logger.error(f"The snapshot of {len(payload)} bytes does not fit into the shared memory segment "
+                             f"'{self.name}' of {self.capacity} bytes. Increase SHARED_SNAPSHOT_SIZE.")
+                return False
+            buffer = self._shared_memory.buf
+            revision = -1 if snapshot.revision is None else snapshot.revision
+            self._sequence += 1
+            _SEQUENCE.pack_into(buffer, _SEQUENCE_OFFSET, self._sequence)
+            buffer[_PAYLOAD_OFFSET:_PAYLOAD_OFFSET + len(payload)] = payload
+            _HEADER.pack_into(buffer, 0, _MAGIC, _FORMAT_VERSION, self._sequence, revision, len(payload), time.time())
+            # The even sequence is written last, once the snapshot is complete.
+            self._sequence += 1
+            _SEQUENCE.pack_into(buffer, _SEQUENCE_OFFSET, self._sequence)
+            self._published_snapshot = snapshot
+            self.published_count += 1
+            self.published_bytes = len(payload)
+            logger.debug("Published the snapshot at revision %s into '%s'. Size: %s bytes.", revision, self.name,
+                         len(payload))
+            return True
+
+    def _pickle_value(self, key: str, stored_value) -> bytes:
+        if self._published_values.get(key, _MISSING) is stored_value:
+            return self._pickled_values[key]
+        return pickle.dumps(resolve(stored_value), protocol=pickle.HIGHEST_PROTOCOL)
+
+    def close(self, unlink: bool = True) -> None:
+        """
+
+        :param unlink: When it is enabled, the segment is removed. The attached readers keep their mapping.
+        :return:
+        """
+        self._shared_memory.close()
+        if unlink:
+            self._shared_memory.unlink()
+
+
+class _ReadOnlySegment:
+    """A read-only mapping of a shared memory segment through its file in /dev/shm. Unlike SharedMemory before
+    Python 3.13, it is not registered to the resource tracker, so the segment is not unlinked when the worker exits.
+    """
+
+    def __init__(self, name: str):
+        """
+
+        :param name: The name of the shared memory segment.
+        :raises FileNotFoundError: When the segment does not exist.
+        """
+        fd = os.open(os.path.join(_SHM_DIRECTORY, name), os.O_RDONLY)
+        try:
+            self.size = os.fstat(fd).st_size
+            self._mmap = mmap.mmap(fd, self.size, prot=mmap.PROT_READ)
+        finally:
+            os.close(fd)
+        self.buf = memoryview(self._mmap)
+
+    def close(self) -> None:
+        """
+
+        :return:
+        """
+        self.buf.release()
+        self._mmap.close()
+
+
+class SharedSnapshotReader:
+    """It reads the snapshots published by a SharedSnapshotPublisher of the same host.
+    A read only compares the sequence in the segment header with the last one read, so it needs no IPC round trip.
+    The snapshot is copied once per published change, and each value is unpickled when it is first read.
+    The reader never writes into the segment.
+    """
+
+    def __init__(self, name: str = SHARED_SNAPSHOT_NAME, max_attempts: int = 1000):
+        """
+
+        :param name: The name of the shared memory segment.
+        :param max_attempts: The number of copies tried while the publisher keeps writing.
+        :raises FileNotFoundError: When the segment has not been created by the publisher yet.
+        :raises RuntimeError: Before Python 3.13, on a POSIX system without /dev/shm, such as macOS.
+        """
+        self.name = name
+        self.max_attempts = max_attempts
+        self._shared_memory = self._attach(name)
+        self._sequence = 0
+        self._snapshot = ConfigSnapshot()
+
+    @staticmethod
+    def _attach(name: str):
+        try:
+            return shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            pass
+        # Before Python 3.13, the attached segments are registered to the resource tracker, which unlinks them
+        # when the worker exits. Unregistering them afterwards would also drop the registration of the publisher
+        # when the tracker is inherited from it, so the segment is mapped without SharedMemory instead.
+        if os.name == 'nt':
+            # The Windows segments are not tracked.
+            return shared_memory.SharedMemory(name=name)
+        if not os.path.isdir(_SHM_DIRECTORY):
+            raise RuntimeError(f"The shared memory segment '{name}' cannot be attached without being unlinked when "
+                               f"the worker exits. It requires Python 3.13 or later on a system without "
+                               f"{_SHM_DIRECTORY}.")
+        return _ReadOnlySegment(name)
+
+    @property
+    def sequence(self) -> int:
+        return _SEQUENCE.unpack_from(self._shared_memory.buf, _SEQUENCE_OFFSET)[0]
+
+    def has_changed(self) -> bool:
+        """
+
+        :return: True when a snapshot has been published since the last read.
+        """
+        return self.sequence != self._sequence
+
+    def snapshot(self) -> ConfigSnapshot:
+        """It returns the latest published snapshot, tagged with its etcd revision.
+
+        :return:
+        """
+        buffer = self._shared_memory.buf
+        for _ in range(self.max_attempts):
+            sequence = _SEQUENCE.unpack_from(buffer, _SEQUENCE_OFFSET)[0]
+            if sequence == self._sequence:
+                return self._snapshot
+            if sequence & 1:
+                time.sleep(0)
+                continue
+            magic, format_version, _, revision, payload_size, _ = _HEADER.unpack_from(buffer, 0)
+            payload = bytes(buffer[_PAYLOAD_OFFSET:_PAYLOAD_OFFSET + payload_size])
+            if _SEQUENCE.unpack_from(buffer, _SEQUENCE_OFFSET)[0] != sequence or magic != _MAGIC or \
+                    format_version != _FORMAT_VERSION:
+                continue
+            self._snapshot = ConfigSnapshot().evolve(updates={key: LazyValue(raw, decoder=pickle.loads)
+                                                              for key, raw in pickle.loads(payload).items()},
+                                                     revision=None if revision < 0 else revision)
+            self._sequence = sequence
+            return self._snapshot
+        logger.error(f"The snapshot of '{self.name}' kept changing while being read. Serving the previous one.")
+        return self._snapshot
+
+    @property
+    def revision(self) -> Optional[int]:
+        return self.snapshot().revision
+
+    def close(self) -> None:
+        """
+
+        :return:
+        """
+        self._shared_memory.close()
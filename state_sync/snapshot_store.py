@@ -0,0 +1,241 @@
+import sqlite3
+import threading
+import time
+from typing import Iterable, Tuple
+
+from .sync_logger import logger
+from .app_config import SNAPSHOT_WRITE_INTERVAL_SECONDS
+
+_SCHEMA_VERSION = 1
+
+
+class SQLiteSnapshotStore:
+    """It persists the raw values of the watched keys with their mod_revision, and the revision applied by each
+    watch, in a local SQLite file. A restarted watcher loads them in milliseconds and resumes each watch from its
+    stored revision instead of reading all the keys from etcd again.
+    The raw values are stored rather than the deserialized ones, so any value type can be stored, and the
+    observers rebuild their parsed data from them on load.
+    """
+
+    def __init__(self, path: str):
+        """
+
+        :param path: The SQLite file. It is created when it does not exist.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        # The SnapshotWriter writes on its own thread, so the connection is shared between threads under the lock.
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        # The write-ahead log with synchronous=NORMAL does not sync to disk on every commit. A crash may lose the
+        # last batches, which are then replayed by the watches from the stored revisions.
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        self._create_schema()
+
+    def _create_schema(self) -> None:
+        with self._lock:
+            schema_version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+            if schema_version not in (0, _SCHEMA_VERSION):
+                self._connection.executescript('DROP TABLE IF EXISTS kv; DROP TABLE IF EXISTS watch_revisions;')
+            self._connection.executescript(f"""
+                CREATE TABLE IF NOT EXISTS kv (
+                    key TEXT PRIMARY KEY,
+                    value BLOB NOT NULL,
+                    mod_revision INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS watch_revisions (
+                    watch_key TEXT PRIMARY KEY,
+                    revision INTEGER NOT NULL
+                ) WITHOUT ROWID;
+                PRAGMA user_version = {_SCHEMA_VERSION};
+            """)
+
+    def save(self, items: Iterable[Tuple[str, bytes, int]], watch_revisions: dict,
+             deletes: Iterable[str] = ()) -> None:
+        """It stores an applied batch in a single transaction.
+
+        :param items: The (key, raw value, mod_revision) of the changed keys.
+        :param watch_revisions: A dict mapping the watch keys to their last applied revision.
+        :param deletes: The removed keys.
+        :return:
+        """
+        with self._lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._connection.executemany('INSERT OR REPLACE INTO kv (key, value, mod_revision) VALUES (?, ?, ?)',
+                                             items)
+                self._connection.executemany('DELETE FROM kv WHERE key = ?', ((key,) for key in deletes))
+                self._connection.executemany('INSERT OR REPLACE INTO watch_revisions (watch_key, revision) '
+                                             'VALUES (?, ?)', watch_revisions.items())
+                self._connection.execute('COMMIT')
+            except Exception:
+                self._connection.execute('ROLLBACK')
+                raise
+
+    def load(self) -> Tuple[list, dict]:
+        """
+
+        :return: The stored (key, raw value, mod_revision) items and the revision of each watch key.
+        """
+        with self._lock:
+            items = self._connection.execute('SELECT key, value, mod_revision FROM kv').fetchall()
+            watch_revisions = dict(self._connection.execute('SELECT watch_key, revision FROM watch_revisions'))
+        return items, watch_revisions
+
+    def clear(self) -> None:
+        """
+
+        :return:
+        """
+        with self._lock:
+            self._connection.executescript('DELETE FROM kv; DELETE FROM watch_revisions;')
+
+    def close(self) -> None:
+        """
+
+        :return:
+        """
+        with self._lock:
+            self._connection.close()
+
+
+class SnapshotWriter:
+    """It saves the applied batches into a SQLiteSnapshotStore on its own thread, so the watch callback does not wait
+    for SQLite. The batches submitted during SNAPSHOT_WRITE_INTERVAL_SECONDS are merged, keeping only the latest
+    value of each key and the latest revision of each watch, and saved in one transaction.
+    A watch revision is saved in the same transaction as the items submitted with or before it, so the stored
+    revision never gets ahead of the stored items. A failed save is merged back and retried with the next one.
+    """
+
+    def __init__(self, store: SQLiteSnapshotStore, interval_seconds: float = SNAPSHOT_WRITE_INTERVAL_SECONDS):
+        """
+
+        :param store:
+        :param interval_seconds: How long the batches are collected before being saved.
+        """
+        self.store = store
+        self.interval_seconds = interval_seconds
+        # It maps each changed key to its (raw value, mod_revision), or to None when it is removed.
+        self._pending_items = {}
+        self._pending_watch_revisions = {}
+        self._deadline = None
+        self._condition = threading.Condition()
+        # The saves are serialized, so the merged batches are saved in the order they were submitted.
+        self._write_lock = threading.Lock()
+        self._writer_thread = None
+        self._is_stopped = False
+        self.submitted_count = 0
+        self.saves_count = 0
+
+    def start(self) -> None:
+        """
+
+        :return:
+        """
+        with self._condition:
+            self._is_stopped = False
+        self._writer_thread = threading.Thread(name='state_sync_snapshot_writer', target=self._run, daemon=True)
+        self._writer_thread.start()
+
+    def stop(self) -> None:
+        """It saves the pending batches and stops the writer thread. The batches submitted afterwards are saved
+        right away.
+
+        :return:
+        """
+        with self._condition:
+            self._is_stopped = True
+            self._condition.notify_all()
+        if self._writer_thread:
+            self._writer_thread.join()
+            self._writer_thread = None
+        self.flush()
+
+    def submit(self, items: Iterable[Tuple[str, bytes, int]], watch_revisions: dict,
+               deletes: Iterable[str] = ()) -> None:
+        """It queues an applied batch to be saved.
+
+        :param items: The (key, raw value, mod_revision) of the changed keys.
+        :param watch_revisions: A dict mapping the watch keys to their last applied revision.
+        :param deletes: The removed keys.
+        :return:
+        """
+        with self._condition:
+            for key, raw, mod_revision in items:
+                self._pending_items[key] = (raw, mod_revision)
+            for key in deletes:
+                self._pending_items[key] = None
+            for watch_key, revision in watch_revisions.items():
+                if revision > self._pending_watch_revisions.get(watch_key, 0):
+                    self._pending_watch_revisions[watch_key] = revision
+            self.submitted_count += 1
+            is_stopped = self._is_stopped
+            if not is_stopped and self._deadline is None:
+                self._deadline = time.monotonic() + self.interval_seconds
+                self._condition.notify_all()
+        if is_stopped:
+            self.flush()
+
+    def flush(self) -> None:
+        """It saves the pending batches right away.
+
+        :return:
+        """
+        with self._write_lock:
+            with self._condition:
+                pending_items = self._pending_items
+                pending_watch_revisions = self._pending_watch_revisions
+                self._pending_items = {}
+                self._pending_watch_revisions = {}
+                self._deadline = None
+            if not pending_items and not pending_watch_revisions:
+                return
+            try:
+                self.store.save(items=[(key, item[0], item[1]) for key, item in pending_items.items()
+                                       if item is not None],
+                                watch_revisions=pending_watch_revisions,
+                                deletes=[key for key, item in pending_items.items() if item is None])
+                self.saves_count += 1
+            except Exception as e:
+                logger.error(f"Exception while saving the snapshot store: {e}. The batches are retried.")
+                self._restore(pending_items=pending_items, pending_watch_revisions=pending_watch_revisions)
+
+    def _restore(self, pending_items: dict, pending_watch_revisions: dict) -> None:
+        # The batches submitted since the failed save are newer, so they take precedence.
+        with self._condition:
+            pending_items.update(self._pending_items)
+            self._pending_items = pending_items
+            for watch_key, revision in self._pending_watch_revisions.items():
+                if revision > pending_watch_revisions.get(watch_key, 0):
+                    pending_watch_revisions[watch_key] = revision
+            self._pending_watch_revisions = pending_watch_revisions
+            if not self._is_stopped and self._deadline is None:
+                self._deadline = time.monotonic() + self.interval_seconds
+                self._condition.notify_all()
+
+    def _run(self) -> None:
+        while True:
+            with self._condition:
+                if self._is_stopped:
+                    return
+                if self._deadline is None:
+                    self._condition.wait()
+                    continue
+                remaining = self._deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(timeout=remaining)
+                    continue
+            # SQLite is written outside the condition, so the watch callback keeps submitting meanwhile.
+            self.flush()
+
+    def stats(self) -> dict:
+        """
+
+        :return:
+        """
+        with self._condition:
+            return {
+                'submitted': self.submitted_count,
+                'saves': self.saves_count,
+                'pending': len(self._pending_items),
+            }
@@ -1,12 +1,28 @@
+import threading
+import time
 from enum import Enum
+from functools import partial
 
-from etcd3.events import PutEvent
+import etcd3
+from etcd3.client import KVMetadata
+from etcd3.events import PutEvent, DeleteEvent
 from etcd3.watch import WatchResponse
 
 from .sync_logger import logger
-from .etcd_connection import EtcdConnection
-from .abstract_observer import Subject
-from .app_config import ADD_NEW_WATCH_CHANGES_ON_PREFIX
+from .etcd_connection import EtcdConnection, get_range_page
+from .abstract_observer import Subject, ChangeBatch, DELETED
+from .config_snapshot import ConfigSnapshot
+from .key_index import KeyIndex
+from .key_store import KeyStore
+from .dispatcher import ObserverDispatcher, OverflowPolicyEnum
+from .coalescer import ChangeCoalescer
+from .lazy_value import LazyValue
+from .metrics import SyncMetrics
+from .snapshot_store import SnapshotWriter
+from .connection_supervisor import ConnectionSupervisor
+from .app_config import ADD_NEW_WATCH_CHANGES_ON_PREFIX, BOOTSTRAP_MAX_TXN_OPS, BOOTSTRAP_RANGE_LIMIT, \
+    DISPATCHER_NUMBER_OF_WORKERS, DISPATCHER_QUEUE_SIZE, DISPATCHER_OVERFLOW_POLICY, LAZY_VALUES, METRICS_ENABLED, \
+    RECONNECT_CHECK_INTERVAL, MAX_DISCOVERED_KEYS, MAX_DISCOVERED_BYTES
 
 
 class CallBackTypeEnum(Enum):
@@ -14,53 +30,148 @@ class CallBackTypeEnum(Enum):
     NON_PREFIX_TYPE = "NON-PREFIX"
 
 
+def split_deletes(updates: dict) -> tuple:
+    """
+
+    :param updates: A dict mapping the changed keys to their value, or to DELETED.
+    :return: The dict of the updated keys and the list of the deleted keys.
+    """
+    deletes = [key for key, value in updates.items() if value is DELETED]
+    if not deletes:
+        return updates, deletes
+    return {key: value for key, value in updates.items() if value is not DELETED}, deletes
+
+
 class WatchForChanges(Subject):
 
     def __init__(self, host: str, port: int, number_of_retries: int, retry_interval: int, ca_cert=None, cert_key=None,
-                 cert_cert=None, timeout=None, user=None, password=None, grpc_options=None):
+                 cert_cert=None, timeout=None, user=None, password=None, grpc_options=None,
+                 lazy_values: bool = LAZY_VALUES, metrics_enabled: bool = METRICS_ENABLED, etcd_client=None,
+                 snapshot_store=None, endpoints: list = None, max_discovered_keys: int = MAX_DISCOVERED_KEYS,
+                 max_discovered_bytes: int = MAX_DISCOVERED_BYTES):
         """
 
         :param host:
         :param port:
         :param number_of_retries:
         :param retry_interval:
+        :param lazy_values: When it is enabled, the values are kept as LazyValue objects holding the raw bytes,
+                            and they are decoded only when they are read.
+        :param metrics_enabled: When it is enabled, the event, byte and latency counters are collected.
+                                They are returned by stats() and prometheus_metrics().
+        :param etcd_client: An already created client to use instead of connecting to host and port,
+                            such as a FakeEtcdClient.
+        :param snapshot_store: A SQLiteSnapshotStore persisting each applied batch. The batches are saved by a
+                               SnapshotWriter thread rather than by the watch callback. On start, the stored keys
+                               are served right away and their watches resume from the stored revisions.
+        :param endpoints: The members of the etcd cluster, as 'host:port' strings or (host, port) tuples. The
+                          connection fails over between them. The clients are shared by the watchers of the process.
+        :param max_discovered_keys: The maximum number of keys discovered under a prefix key, rather than defined
+                                    themselves. The least recently written ones are evicted and passed to the
+                                    observers as deleted. None is unbounded.
+        :param max_discovered_bytes: The maximum size of the keys discovered under a prefix key and of their values,
+                                     in bytes. None is unbounded.
         """
         super().__init__()
-        # It will store the raw data.
-        self.data = {}
+        # It stores the raw data. Each applied batch publishes a new immutable snapshot.
+        self._snapshot = ConfigSnapshot()
         self.watch_id_map = {}
         # Whenever new changes are detected, the value is set to True.
         # After loading your changes, flip this value to False for future changes.
         self.is_change_detected = False
         self.watch_keys = None
+        # The prefix trie over the watch keys, resolving each changed key to the defined key covering it.
+        self.key_index = None
+        self._indexed_watch_keys = None
+        # It maps each watch key to the defined keys covered by that watch.
+        self.watch_plan = {}
+        # It stores the value, the mod_revision and the lease of the last change applied on each key.
+        self.key_store = KeyStore(max_discovered_keys=max_discovered_keys, max_discovered_bytes=max_discovered_bytes)
+        # The etcd revision of the last loaded snapshot.
+        self.snapshot_revision = None
+        # It stores the last revision applied by each watch, so the watch can resume from it after a reconnect.
+        self.watch_revision_map = {}
+        # Watches whose resume revision has been compacted by etcd. They are loaded again from a fresh snapshot.
+        self.compacted_watch_keys = set()
+        self._apply_lock = threading.RLock()
+        # When it is set, the observers are notified on the dispatcher threads instead of the etcd callback thread.
+        self.dispatcher = None
+        # When it is set, the changes are collected over a window and delivered as one batch.
+        self.coalescer = None
+        # When it is set, the connection failures are handled on its background thread.
+        self.supervisor = None
+        self.lazy_values = lazy_values
+        self.snapshot_store = snapshot_store
+        self.snapshot_writer = None
+        if snapshot_store is not None:
+            self.snapshot_writer = SnapshotWriter(store=snapshot_store)
+            self.snapshot_writer.start()
+        self._is_warm_started = False
+        # Whether the watches load the current values before watching.
+        self._bootstrap = True
+        # It is None when the metrics are disabled, so the hot path only checks for None.
+        self.metrics = SyncMetrics() if metrics_enabled else None
 
         self.etcd_connection_obj = EtcdConnection(host=host, port=port, number_of_retries=number_of_retries,
                                                   retry_interval=retry_interval, ca_cert=ca_cert, cert_key=cert_key,
                                                   cert_cert=cert_cert, timeout=timeout, user=user, password=password,
-                                                  grpc_options=grpc_options)
+                                                  grpc_options=grpc_options, etcd_client=etcd_client,
+                                                  endpoints=endpoints)
+        # The client the watches have been added on. It differs from the client in use after a failover.
+        self._watch_client = None
 
-    def callback(self, event) -> None:
+    def callback(self, event, watch_key: str = None) -> None:
         """
 
         :param event:
+        :param watch_key: The key of the watch that delivered the event.
         :return:
         """
         try:
             if isinstance(event, WatchResponse):
                 logger.info('The Etcd callback detected new changes.')
-                for event in event.events:
-                    if isinstance(event, PutEvent):
-                        key = event.key.decode('utf-8')
-                        value = event.value.decode('utf-8')
-                        if key in self.watch_keys:
-                            self.data[key] = value
-                        else:
-                            if ADD_NEW_WATCH_CHANGES_ON_PREFIX:
-                                self.data[key] = value
-                            else:
-                                logger.info("Changes were detected on a key that does not exist in our defined keys.")
-                        self.is_change_detected = True
-                        self.notify_state_change(key=key, value=value)
+                metrics = self.metrics
+                received_at = None if metrics is None else time.perf_counter()
+                # Progress notifications do not carry events, so their header revision is used instead.
+                response_revision = event.events[-1].mod_revision if event.events else event.header.revision
+                # All the changes of a response, such as the keys written by one etcd transaction,
+                # are delivered to the observers as one batch.
+                changes = ChangeBatch(revision=response_revision, received_at=received_at)
+                updates = {}
+                with self._apply_lock:
+                    for watch_event in event.events:
+                        if isinstance(watch_event, PutEvent):
+                            key = watch_event.key.decode('utf-8')
+                            value = self._to_value(watch_event.value)
+                            if self._apply_put(key=key, value=value, mod_revision=watch_event.mod_revision,
+                                               updates=updates, changes=changes, lease=watch_event.lease):
+                                changes.pop(key, None)
+                                changes[key] = value
+                        elif isinstance(watch_event, DeleteEvent):
+                            # The deleted and the lease-expired keys are removed.
+                            key = watch_event.key.decode('utf-8')
+                            if self._apply_delete(key=key, mod_revision=watch_event.mod_revision, updates=updates):
+                                changes.pop(key, None)
+                                changes[key] = DELETED
+                    self._publish_snapshot(updates=updates, revision=response_revision)
+                    if metrics is not None:
+                        # The sizes are only counted when the metrics are enabled. A delete carries an empty value.
+                        metrics.record_events(watch_key=watch_key, events_count=len(event.events),
+                                              bytes_count=sum(len(watch_event.key) + len(watch_event.value)
+                                                              for watch_event in event.events))
+                    # The batches are only queued to the snapshot writer, so they are queued under the lock, in the
+                    # order they have been applied. They are queued before the observers are notified, so a failing
+                    # observer never keeps a batch out of the store while the later ones advance its revision.
+                    if watch_key is not None and response_revision > self.watch_revision_map.get(watch_key, 0):
+                        self.watch_revision_map[watch_key] = response_revision
+                        self._persist(updates=updates, watch_revisions={watch_key: response_revision})
+                    elif updates:
+                        self._persist(updates=updates)
+                    self._publish_changes(changes=changes, partition_key=watch_key)
+            elif isinstance(event, etcd3.exceptions.RevisionCompactedError):
+                logger.error(f"The revision of the watch on key '{watch_key}' has been compacted. "
+                             f"Compacted revision: {event.compacted_revision}.")
+                self.compacted_watch_keys.add(watch_key)
             else:
                 debug_error_string = event.debug_error_string()
 
@@ -68,84 +179,765 @@ class WatchForChanges(Subject):
                     logger.error(f"Server is currently unavailable or unreachable. Exception {debug_error_string}")
                 else:
                     logger.error(f"Exception in callback {event}")
-                self.etcd_connection_obj.is_connection_failed_with_etcd = True
+                self._on_connection_failure()
         except Exception as e:
             logger.error(f'Callback exception:  {e}')
 
+    def _on_connection_failure(self) -> None:
+        """It marks the connection as failed, so the supervisor reconnects and resumes the watches.
+
+        :return:
+        """
+        self.etcd_connection_obj.is_connection_failed_with_etcd = True
+        if self.supervisor:
+            self.supervisor.notify_failure()
+
+    def _to_value(self, raw: bytes):
+        """
+
+        :param raw: The value bytes as received from etcd.
+        :return: A LazyValue in lazy mode, otherwise the decoded string.
+        """
+        return LazyValue(raw) if self.lazy_values else raw.decode('utf-8')
+
+    @staticmethod
+    def _to_raw(value) -> bytes:
+        return value.raw if isinstance(value, LazyValue) else value.encode('utf-8')
+
+    def _persist(self, updates: dict, watch_revisions: dict = None) -> None:
+        """It queues an applied batch to be saved into the snapshot store, if any.
+
+        :param updates: A dict mapping the changed keys to their value, or to DELETED.
+        :param watch_revisions: A dict mapping the watch keys to their last applied revision.
+        :return:
+        """
+        if self.snapshot_writer is None:
+            return
+        try:
+            # The mod_revisions are read now, as the keys may change again before the batch is saved.
+            self.snapshot_writer.submit(items=[(key, self._to_raw(value), self.key_store.revision(key))
+                                               for key, value in updates.items() if value is not DELETED],
+                                        watch_revisions=watch_revisions or {},
+                                        deletes=[key for key, value in updates.items() if value is DELETED])
+        except Exception as e:
+            logger.error(f"Exception while saving the snapshot store: {e}")
+
+    @property
+    def data(self) -> ConfigSnapshot:
+        return self._snapshot
+
+    def snapshot(self) -> ConfigSnapshot:
+        """It returns the latest immutable snapshot of the raw data.
+        The snapshot is a consistent view tagged with its etcd revision, and reading it needs no locking.
+
+        :return:
+        """
+        return self._snapshot
+
+    def _publish_snapshot(self, updates: dict, revision: int) -> None:
+        """It publishes a new snapshot with the updates applied by a single reference swap.
+
+        :param updates: A dict mapping the changed keys to their value, or to DELETED.
+        :param revision:
+        :return:
+        """
+        snapshot = self._snapshot
+        if snapshot.revision is not None and revision < snapshot.revision:
+            revision = snapshot.revision
+        if updates or revision != snapshot.revision:
+            updates, deletes = split_deletes(updates)
+            self._snapshot = snapshot.evolve(updates=updates, deletes=deletes, revision=revision)
+
+    def build_key_index(self) -> None:
+        """
+
+        :return:
+        """
+        key_index = KeyIndex()
+        for watch_key, key_object in (self.watch_keys or {}).items():
+            key_index.add(watch_key, is_prefix=self._get_call_back_type(watch_key, key_object) ==
+                          CallBackTypeEnum.PREFIX_TYPE.value)
+        self.key_index = key_index
+        self._indexed_watch_keys = self.watch_keys
+
+    def _match_defined_key(self, key: str):
+        """
+
+        :param key:
+        :return: The defined key covering the key, which is the key itself or a prefix key, or None.
+        """
+        watch_keys = self.watch_keys
+        if not watch_keys:
+            return None
+        if key in watch_keys:
+            return key
+        # The defined keys are edited in place when a watch is stopped.
+        if self._indexed_watch_keys is not watch_keys or len(self.key_index) != len(watch_keys):
+            self.build_key_index()
+        rule = self.key_index.longest_match(key)
+        return None if rule is None else rule[0]
+
+    def _apply_put(self, key: str, value: str, mod_revision: int, updates: dict, changes: dict = None,
+                   lease: int = 0) -> bool:
+        """It records the new value of a key into updates, to be published with the rest of its batch.
+        A change older than the one already stored for the key is skipped, so the same change
+        delivered by both the snapshot and the watch stream is applied only once.
+        The keys under a prefix key are defined by it. ADD_NEW_WATCH_CHANGES_ON_PREFIX only decides whether the keys
+        that no defined key covers are stored.
+
+        :param key:
+        :param value:
+        :param mod_revision:
+        :param updates:
+        :param changes: The changes passed to the observers, receiving the keys evicted by the bounded key store.
+        :param lease: The id of the lease attached to the key.
+        :return: False when the change is stale and must not be passed to the observers.
+        """
+        with self._apply_lock:
+            defined_key = self._match_defined_key(key)
+            if defined_key is not None or ADD_NEW_WATCH_CHANGES_ON_PREFIX:
+                if mod_revision <= self.key_store.revision(key):
+                    logger.debug("Skipping the stale change on key '%s' - mod_revision: %s.", key, mod_revision)
+                    return False
+                evicted_keys = self.key_store.put(key, value, mod_revision, lease=lease,
+                                                  is_discovered=defined_key != key)
+                for evicted_key in evicted_keys:
+                    logger.debug("The discovered key '%s' has been evicted from the key store.", evicted_key)
+                    updates[evicted_key] = DELETED
+                    if changes is not None:
+                        changes.pop(evicted_key, None)
+                        changes[evicted_key] = DELETED
+                updates[key] = value
+            else:
+                logger.info("Changes were detected on a key that does not exist in our defined keys.")
+            return True
+
+    def _apply_delete(self, key: str, mod_revision: int, updates: dict) -> bool:
+        """It records the removal of a key into updates, to be published with the rest of its batch.
+
+        :param key:
+        :param mod_revision: The revision of the deletion.
+        :param updates:
+        :return: False when the key is not stored or the deletion is stale, so it is not passed to the observers.
+        """
+        with self._apply_lock:
+            entry = self.key_store.get(key)
+            if entry is None:
+                return False
+            if mod_revision <= entry.revision:
+                logger.debug("Skipping the stale deletion of key '%s' - mod_revision: %s.", key, mod_revision)
+                return False
+            self.key_store.delete(key)
+            updates[key] = DELETED
+            return True
+
+    def _publish_changes(self, changes: dict, partition_key=None) -> None:
+        """It passes the changes applied together to the coalescer, the dispatcher or directly to the observers.
+
+        :param changes: A dict mapping each changed key to its latest value.
+        :param partition_key: The key of the watch the changes come from.
+        :return:
+        """
+        if not changes:
+            return
+        self.is_change_detected = True
+        if self.coalescer:
+            self.coalescer.add(partition_key=partition_key, changes=changes)
+        else:
+            self._deliver_changes(changes=changes, partition_key=partition_key)
+
+    def _deliver_changes(self, changes: dict, partition_key=None) -> None:
+        """
+
+        :param changes:
+        :param partition_key:
+        :return:
+        """
+        if self.dispatcher:
+            self.dispatcher.submit(partition_key=partition_key, changes=changes)
+        else:
+            self.notify_batch(changes=changes)
+
+    def notify_batch(self, changes: dict) -> None:
+        """It notifies the observers on the calling thread, timing each of them when the metrics are enabled.
+
+        :param changes:
+        :return:
+        """
+        metrics = self.metrics
+        if metrics is None:
+            super().notify_batch(changes=changes)
+            return
+        logger.debug("Notifier called : %s changes.", len(changes))
+        for observer, observer_changes in self.route_changes(changes):
+            started = time.perf_counter()
+            try:
+                observer.update_batch(observer_changes)
+            except Exception as e:
+                logger.error(f"Observer exception in {type(observer).__name__}: {e}")
+            metrics.record_observer(observer_name=type(observer).__name__, seconds=time.perf_counter() - started)
+        received_at = getattr(changes, 'received_at', None)
+        if received_at is not None:
+            metrics.record_end_to_end(time.perf_counter() - received_at)
+
+    def stats(self) -> dict:
+        """
+
+        :return: The metrics, when they are enabled, with the dispatcher, coalescer and snapshot writer counters.
+        """
+        stats = {
+            'revision': self._snapshot.revision,
+            'keys': len(self._snapshot),
+            'watches': len(self.watch_id_map),
+            'key_store': self.key_store.stats(),
+        }
+        if self.metrics is not None:
+            stats.update(self.metrics.stats())
+        if self.dispatcher:
+            stats['dispatcher'] = self.dispatcher.stats()
+        if self.coalescer:
+            stats['coalescer'] = self.coalescer.stats()
+        if self.snapshot_writer:
+            stats['snapshot_writer'] = self.snapshot_writer.stats()
+        if self.supervisor:
+            stats['connection'] = self.supervisor.health()
+        return stats
+
+    def prometheus_metrics(self, namespace: str = 'state_sync') -> str:
+        """
+
+        :param namespace: The prefix of the metric names.
+        :return: The metrics in the Prometheus text exposition format. It is empty when they are disabled.
+        """
+        if self.metrics is None:
+            return ''
+        return self.metrics.to_prometheus(namespace=namespace)
+
+    def start_coalescing(self, window_seconds: float = None, max_batch_size: int = None) -> None:
+        """It collects the changes until the window elapses or the number of changed keys reaches max_batch_size.
+        Only the latest value of each key is kept, and the observers receive the changes as one batch
+        through Observer.update_batch.
+
+        :param window_seconds: The maximum time a change waits before being delivered. It defaults to
+                               COALESCER_MAX_WAIT_SECONDS when only max_batch_size is given.
+        :param max_batch_size: The number of changed keys that triggers an immediate delivery.
+        :return:
+        """
+        self.stop_coalescing()
+        self.coalescer = ChangeCoalescer(deliver=self._deliver_changes, window_seconds=window_seconds,
+                                         max_batch_size=max_batch_size)
+        self.coalescer.start()
+
+    def stop_coalescing(self) -> None:
+        """It delivers the pending changes and stops collecting them.
+
+        :return:
+        """
+        if self.coalescer:
+            coalescer = self.coalescer
+            self.coalescer = None
+            coalescer.stop()
+
+    def start_dispatcher(self, number_of_workers: int = DISPATCHER_NUMBER_OF_WORKERS,
+                         queue_size: int = DISPATCHER_QUEUE_SIZE,
+                         overflow_policy: str = DISPATCHER_OVERFLOW_POLICY) -> None:
+        """It starts notifying the observers on a pool of worker threads, so slow observers do not block
+        the etcd callback thread. The changes on a key are always delivered in order.
+
+        :param number_of_workers:
+        :param queue_size: The maximum number of pending batches per worker.
+        :param overflow_policy: What to do when a worker queue is full: 'BLOCK', 'DROP-OLDEST' or 'COALESCE',
+                                see OverflowPolicyEnum.
+        :return:
+        """
+        self.stop_dispatcher()
+        self.dispatcher = ObserverDispatcher(subject=self, number_of_workers=number_of_workers, queue_size=queue_size,
+                                             overflow_policy=OverflowPolicyEnum(overflow_policy),
+                                             metrics=self.metrics)
+        self.dispatcher.start()
+
+    def stop_dispatcher(self) -> None:
+        """It delivers the pending changes and notifies the observers on the etcd callback thread again.
+
+        :return:
+        """
+        if self.dispatcher:
+            dispatcher = self.dispatcher
+            self.dispatcher = None
+            dispatcher.stop()
+
     def on_failure_connect_with_etcd_and_continue_watch_for_changes(self) -> None:
-        """It attempts to connect with the etcd server, clears the watch_id_map,
-        and then starts watching the keys again.
+        """It blocks until it connects with the etcd server, clears the watch_id_map,
+        and then resumes watching the keys from the last applied revision of each watch, like the supervisor.
+        The watches reported as compacted are loaded again as well.
 
         :return:
         """
         logger.debug(f'Auto reconnecting with etcd.')
+        started = time.perf_counter()
         self.etcd_connection_obj.establish_connection_with_etcd()
-        logger.debug('On reconnecting start watching on keys.')
+        self.resume_after_reconnect()
+        self.resync_compacted_watch_keys()
+        if self.metrics is not None:
+            self.metrics.record_reconnect(time.perf_counter() - started)
+
+    def resume_after_reconnect(self) -> bool:
+        """It drops the watches of the failed connection and resumes all of them.
+
+        :return: False when some watches could not be resumed, so the reconnection must be retried.
+        """
+        logger.debug('On reconnecting resume watching on keys.')
+        # The watch ids belong to the client of the failed connection, which may be shared with other watchers.
+        watch_client = self._watch_client or self.etcd_connection_obj.etcd_client
+        for watch_id in self.watch_id_map.values():
+            try:
+                watch_client.cancel_watch(watch_id)
+            except Exception as e:
+                logger.debug("The watch %s of the failed connection could not be cancelled: %s", watch_id, e)
         self.watch_id_map = {}
-        self.start_watch_keys(keys=self.watch_keys)
+        self.resume_watch_keys()
+        if all(watch_key in self.watch_id_map for watch_key in self.watch_plan):
+            return True
+        # The connection is reported as failed until every watch is resumed.
+        self.etcd_connection_obj.is_connection_failed_with_etcd = True
+        return False
+
+    def start_supervisor(self, check_interval: float = RECONNECT_CHECK_INTERVAL, on_state_change=None) -> None:
+        """It starts reconnecting in the background whenever the connection fails, with a capped exponential
+        backoff and jitter, so the calling thread is never blocked. The snapshots keep serving the last known
+        config while reconnecting. The watches whose revision has been compacted are loaded again as well.
+        With several cluster endpoints, they are probed in the background, and the connection fails over as soon as
+        the endpoint in use is found unhealthy.
+
+        :param check_interval: How often the connection state is checked, in seconds.
+        :param on_state_change: It is called with (ConnectionStateEnum, health dict) when the state changes.
+        :return:
+        """
+        self.stop_supervisor()
+        self.supervisor = ConnectionSupervisor(watcher=self, check_interval=check_interval,
+                                               on_state_change=on_state_change)
+        self.etcd_connection_obj.on_failure = self.supervisor.notify_failure
+        if len(self.etcd_connection_obj.endpoints) > 1:
+            self.etcd_connection_obj.start_health_checks()
+        self.supervisor.start()
+        if self.etcd_connection_obj.is_connection_failed_with_etcd:
+            # Such as when etcd was unreachable at start_watch_keys(), the first connection is made right away.
+            self.supervisor.notify_failure()
 
-    def start_watch_keys(self, keys) -> None:
-        """It iterates through all the keys one by one based on the call_back_type.
-        It binds a callback function to each key and stores the returned key into the watch_id_map.
+    def stop_supervisor(self) -> None:
+        """
+
+        :return:
+        """
+        self.etcd_connection_obj.stop_health_checks()
+        self.etcd_connection_obj.on_failure = None
+        if self.supervisor:
+            supervisor = self.supervisor
+            self.supervisor = None
+            supervisor.stop()
+
+    def resume_watch_keys(self) -> None:
+        """It binds a callback to each key again, starting right after the last revision applied by its watch,
+        so the changes made while the connection was down are replayed instead of being lost.
+        A watch whose revision has been compacted is loaded again from a snapshot of its own key or prefix.
+        The watches whose snapshot has not been loaded yet, such as after a failed start, are loaded first.
+
+        :return:
+        """
+        unloaded_watch_roots = {watch_key: self.watch_keys.get(watch_key) for watch_key in self.watch_plan
+                                if watch_key not in self.watch_revision_map} if self._bootstrap else {}
+        if unloaded_watch_roots:
+            try:
+                self.load_snapshot(keys=unloaded_watch_roots)
+            except Exception as e:
+                logger.error(f'Exception while loading the snapshot in resume_watch_keys() {e}')
+                return
+        for watch_key in self.watch_plan:
+            try:
+                self._resume_watch(watch_key=watch_key, key_object=self.watch_keys.get(watch_key))
+            except Exception as e:
+                logger.error(f'Exception in resume_watch_keys() {e}')
+
+    def _resume_watch(self, watch_key: str, key_object) -> None:
+        """
+
+        :param watch_key:
+        :param key_object:
+        :return:
+        """
+        revision = self.watch_revision_map.get(watch_key)
+        try:
+            self._add_watch(watch_key=watch_key, key_object=key_object,
+                            start_revision=None if revision is None else revision + 1)
+        except etcd3.exceptions.RevisionCompactedError as e:
+            logger.error(f"The revision of the watch on key '{watch_key}' has been compacted. "
+                         f"Compacted revision: {e.compacted_revision}.")
+            self._resync_watch_key(watch_key=watch_key)
+
+    def resync_compacted_watch_keys(self) -> None:
+        """It loads the watches reported as compacted by etcd again from a fresh snapshot of their key or prefix.
+        Only the affected watches are loaded, the other ones keep running.
+
+        :return:
+        """
+        while self.compacted_watch_keys:
+            watch_key = self.compacted_watch_keys.pop()
+            try:
+                self._resync_watch_key(watch_key=watch_key)
+            except Exception as e:
+                logger.error(f'Exception in resync_compacted_watch_keys() {e}')
+
+    def _resync_watch_key(self, watch_key: str) -> None:
+        """
+
+        :param watch_key:
+        :return:
+        """
+        logger.info(f"Loading the key '{watch_key}' again from a snapshot.")
+        if watch_key in self.watch_id_map:
+            self.etcd_connection_obj.etcd_client.cancel_watch(self.watch_id_map.get(watch_key))
+        key_object = self.watch_keys.get(watch_key)
+        revision = self.load_snapshot(keys={watch_key: key_object})
+        self._add_watch(watch_key=watch_key, key_object=key_object, start_revision=revision + 1)
+
+    @staticmethod
+    def _get_call_back_type(watch_key: str, key_object) -> str:
+        """
+
+        :param watch_key:
+        :param key_object:
+        :return:
+        """
+        call_back_type = CallBackTypeEnum.NON_PREFIX_TYPE.value
+        if key_object:
+            if isinstance(key_object, dict):
+                call_back_type = key_object.get('call_back_type', CallBackTypeEnum.NON_PREFIX_TYPE.value)
+            else:
+                logger.debug(
+                    f"Given key '{watch_key}' value is not dict type. Type of value is '{type(key_object)}'. "
+                    f"Using NON-PREFIX call back for this key.")
+        return call_back_type
+
+    def load_snapshot(self, keys) -> int:
+        """It loads the current value of every key and prefix. The keys are read with batched transactions, and the
+        prefixes page by page, BOOTSTRAP_RANGE_LIMIT keys at a time, so a large prefix never exceeds the gRPC
+        message size limit. The pages of all the prefixes are read at the revision read first.
+
+        :param keys:
+        :return: The revision from which the watches must continue.
+        """
+        etcd_client = self.etcd_connection_obj.etcd_client
+        prefix_keys = []
+        single_keys = []
+        for watch_key, key_object in keys.items():
+            if self._get_call_back_type(watch_key, key_object) == CallBackTypeEnum.PREFIX_TYPE.value:
+                prefix_keys.append(watch_key)
+            else:
+                single_keys.append(watch_key)
+
+        # An empty read does not report its revision, so the revision read before the others is used instead.
+        # Changes made after it are delivered again by the watch stream and skipped as stale.
+        revision = etcd_client.get_response(next(iter(keys))).header.revision if keys else 0
+        loaded_keys_count = 0
+        stored_keys_by_watch = self._group_stored_keys(keys=keys)
+        for start in range(0, len(single_keys), BOOTSTRAP_MAX_TXN_OPS):
+            batch_keys = single_keys[start:start + BOOTSTRAP_MAX_TXN_OPS]
+            _, responses = etcd_client.transaction(compare=[],
+                                                   success=[etcd_client.transactions.get(watch_key)
+                                                            for watch_key in batch_keys],
+                                                   failure=[])
+            # All the keys of a transaction are read at the same revision.
+            batch_revision = next((metadata.response_header.revision for range_kvs in responses
+                                   for _, metadata in range_kvs), revision)
+            for watch_key, range_kvs in zip(batch_keys, responses):
+                loaded_keys_count += self._load_range(watch_key=watch_key, range_kvs=range_kvs,
+                                                      stored_keys=stored_keys_by_watch.get(watch_key, ()),
+                                                      revision=batch_revision)
+        for watch_key in prefix_keys:
+            range_kvs = self._read_prefix(etcd_client=etcd_client, prefix=watch_key, revision=revision)
+            loaded_keys_count += self._load_range(watch_key=watch_key, range_kvs=range_kvs,
+                                                  stored_keys=stored_keys_by_watch.get(watch_key, ()),
+                                                  revision=revision)
+
+        self.snapshot_revision = revision
+        for watch_key in keys:
+            self.watch_revision_map[watch_key] = self.snapshot_revision
+        self._persist(updates={}, watch_revisions={watch_key: self.snapshot_revision for watch_key in keys})
+        logger.info(f"Snapshot loaded. Keys: {loaded_keys_count} - revision: {self.snapshot_revision}.")
+        return self.snapshot_revision
+
+    @staticmethod
+    def _read_prefix(etcd_client, prefix: str, revision: int) -> list:
+        """It reads a prefix page by page, each page starting right after the last key of the previous one.
+
+        :param etcd_client:
+        :param prefix:
+        :param revision: The revision all the pages are read at.
+        :return: The (value, KVMetadata) tuples of the keys under the prefix.
+        """
+        range_end = etcd3.utils.increment_last_byte(etcd3.utils.to_bytes(prefix))
+        page_key = etcd3.utils.to_bytes(prefix)
+        range_kvs = []
+        while True:
+            range_response = get_range_page(etcd_client, key=page_key, range_end=range_end,
+                                            limit=BOOTSTRAP_RANGE_LIMIT, revision=revision)
+            range_kvs.extend((kv.value, KVMetadata(kv, range_response.header)) for kv in range_response.kvs)
+            if not range_response.more or not range_response.kvs:
+                return range_kvs
+            page_key = range_response.kvs[-1].key + b'\0'
+
+    def _load_range(self, watch_key: str, range_kvs: list, stored_keys, revision: int) -> int:
+        """It applies the keys read for a watch and delivers them as one batch.
+
+        :param watch_key:
+        :param range_kvs: The (value, KVMetadata) tuples read for the watch.
+        :param stored_keys: The keys already stored under the watch.
+        :param revision: The revision the keys have been read at.
+        :return: The number of loaded keys.
+        """
+        changes = ChangeBatch(revision=revision)
+        updates = {}
+        if self.metrics is not None:
+            changes.received_at = time.perf_counter()
+            self.metrics.record_events(watch_key=watch_key, events_count=len(range_kvs),
+                                       bytes_count=sum(len(metadata.key) + len(value)
+                                                       for value, metadata in range_kvs))
+        with self._apply_lock:
+            loaded_keys = set()
+            for value, metadata in range_kvs:
+                key = metadata.key.decode('utf-8')
+                loaded_keys.add(key)
+                value = self._to_value(value)
+                if self._apply_put(key=key, value=value, mod_revision=metadata.mod_revision,
+                                   updates=updates, changes=changes, lease=metadata.lease_id):
+                    changes.pop(key, None)
+                    changes[key] = value
+            # The stored keys missing from the range have been deleted since they were applied, such as
+            # during the outage preceding a reload of a compacted watch.
+            for key in stored_keys:
+                if key not in loaded_keys and self._apply_delete(key=key, mod_revision=revision, updates=updates):
+                    changes[key] = DELETED
+            self._publish_snapshot(updates=updates, revision=revision)
+            self._persist(updates=updates)
+            self._publish_changes(changes=changes, partition_key=watch_key)
+        return len(range_kvs)
+
+    def _group_stored_keys(self, keys) -> dict:
+        """It walks the key store once, so it is meant for the rare full reloads of the watches.
+
+        :param keys: The watch keys, which are disjoint.
+        :return: A dict mapping each watch key to the stored keys it covers.
+        """
+        if not len(self.key_store):
+            return {}
+        watch_index = KeyIndex()
+        for watch_key, key_object in keys.items():
+            watch_index.add(watch_key, is_prefix=self._get_call_back_type(watch_key, key_object) ==
+                            CallBackTypeEnum.PREFIX_TYPE.value)
+        stored_keys_by_watch = {}
+        with self._apply_lock:
+            for key in self.key_store.keys():
+                rule = watch_index.longest_match(key)
+                if rule is not None:
+                    stored_keys_by_watch.setdefault(rule[0], []).append(key)
+        return stored_keys_by_watch
+
+    def plan_watches(self, keys) -> dict:
+        """It reduces the keys to the smallest set of watches covering all of them.
+        A key covered by a prefix key does not get a watch of its own, so etcd delivers each change only once.
+
+        :param keys:
+        :return: A dict mapping each watch key to the defined keys covered by that watch.
+        """
+        key_index = KeyIndex()
+        for watch_key, key_object in keys.items():
+            key_index.add(watch_key, key_object,
+                          is_prefix=self._get_call_back_type(watch_key, key_object) ==
+                          CallBackTypeEnum.PREFIX_TYPE.value)
+
+        watch_plan = {}
+        for watch_key in keys:
+            covering_rule = key_index.shortest_prefix_match(watch_key)
+            covering_key = watch_key if covering_rule is None else covering_rule[0]
+            watch_plan.setdefault(covering_key, []).append(watch_key)
+        return watch_plan
+
+    def start_watch_keys(self, keys, bootstrap: bool = True) -> None:
+        """It reduces the keys to the watches covering all of them and binds a callback function to each watch
+        based on its call_back_type. The returned watch ids are stored into the watch_id_map.
+        When bootstrap is enabled, the current values are loaded first and the watches start right after
+        the snapshot revision, so no change is missed between the two.
+        The watches restored from the snapshot store resume from their stored revision without being loaded again.
 
         :param keys:
+        :param bootstrap:
         :return:
         """
         self.watch_keys = keys
-        watch_id = None
+        self._bootstrap = bootstrap
         try:
-            for watch_key, key_object in keys.items():
-                call_back_type = CallBackTypeEnum.NON_PREFIX_TYPE.value
-                if key_object:
-                    if isinstance(key_object, dict):
-                        call_back_type = key_object.get('call_back_type', CallBackTypeEnum.NON_PREFIX_TYPE.value)
-                    else:
-                        logger.debug(
-                            f"Given key '{watch_key}' value is not dict type. Type of value is '{type(key_object)}'. "
-                            f"Using NON-PREFIX call back for this key.")
-
-                if call_back_type == CallBackTypeEnum.PREFIX_TYPE.value:
-                    watch_id = self.etcd_connection_obj.etcd_client.add_watch_prefix_callback(watch_key, self.callback)
-                    logger.debug(f"PREFIX base callback has been added. Key: '{watch_key}' - call_back_type: "
-                                 f"'{call_back_type}'")
-                elif call_back_type == CallBackTypeEnum.NON_PREFIX_TYPE.value:
-                    watch_id = self.etcd_connection_obj.etcd_client.add_watch_callback(watch_key, self.callback)
-                    logger.debug(f"NON-PREFIX base callback has been added. Key: '{watch_key}' - call_back_type: "
-                                 f"'{call_back_type}'")
+            self.watch_plan = self.plan_watches(keys=keys)
+            self.warm_start(keys=keys)
+            watch_roots = {watch_key: keys.get(watch_key) for watch_key in self.watch_plan}
+            logger.info(f"The {len(keys)} defined keys are covered by {len(watch_roots)} watches.")
+
+            new_watch_roots = {watch_key: key_object for watch_key, key_object in watch_roots.items()
+                               if watch_key not in self.watch_revision_map}
+            start_revision = None
+            if bootstrap and new_watch_roots:
+                start_revision = self.load_snapshot(keys=new_watch_roots) + 1
+
+            for watch_key, key_object in watch_roots.items():
+                if watch_key in new_watch_roots:
+                    self._add_watch(watch_key=watch_key, key_object=key_object, start_revision=start_revision)
                 else:
-                    logger.error("The callback type is not valid.")
-                self.watch_id_map[watch_key] = watch_id
+                    self._resume_watch(watch_key=watch_key, key_object=key_object)
+        except etcd3.exceptions.ConnectionFailedError as e:
+            # The supervisor loads and resumes the watches once etcd is reachable, the warm started keys are served
+            # meanwhile.
+            logger.error(f'Connection failure in start_watch_keys() {e}')
+            self._on_connection_failure()
         except Exception as e:
-            logger.error(f'Exception in start_watch_keys() {e}')
+            # The watcher is never left without watches, such as when a read exceeds the gRPC message size limit.
+            logger.error(f'Exception in start_watch_keys() {e}. The watches are retried by the supervisor.')
+            self._on_connection_failure()
+
+    def warm_start(self, keys) -> int:
+        """It serves the keys stored by the snapshot store right away, without waiting for etcd, and restores the
+        revision of their watches, so start_watch_keys() resumes them instead of loading them again.
+        Only the stored watches that are still in the watch plan of the keys are restored. It runs once.
+
+        :param keys:
+        :return: The number of restored keys.
+        """
+        if self.snapshot_store is None or self._is_warm_started:
+            return 0
+        self._is_warm_started = True
+        self.watch_keys = keys
+        stored_items, stored_watch_revisions = self.snapshot_store.load()
+        restored_watch_revisions = {watch_key: stored_watch_revisions[watch_key]
+                                    for watch_key in self.plan_watches(keys=keys)
+                                    if watch_key in stored_watch_revisions}
+        if not restored_watch_revisions:
+            return 0
+        restored_watches = KeyIndex()
+        for watch_key, watch_revision in restored_watch_revisions.items():
+            restored_watches.add(watch_key, watch_revision,
+                                 is_prefix=self._get_call_back_type(watch_key, keys.get(watch_key)) ==
+                                 CallBackTypeEnum.PREFIX_TYPE.value)
+
+        changes_by_watch = {}
+        updates = {}
+        with self._apply_lock:
+            for key, raw, mod_revision in stored_items:
+                # The watch roots are disjoint, so a key matches the single watch covering it.
+                rule = restored_watches.longest_match(key)
+                if rule is None:
+                    continue
+                watch_key, watch_revision = rule
+                changes = changes_by_watch.get(watch_key)
+                if changes is None:
+                    changes = changes_by_watch[watch_key] = ChangeBatch(revision=watch_revision)
+                value = self._to_value(raw)
+                if self._apply_put(key=key, value=value, mod_revision=mod_revision, updates=updates,
+                                   changes=changes):
+                    changes.pop(key, None)
+                    changes[key] = value
+            self.watch_revision_map.update(restored_watch_revisions)
+            self._publish_snapshot(updates=updates, revision=min(restored_watch_revisions.values()))
+            restored_keys, evicted_keys = split_deletes(updates)
+            if evicted_keys:
+                # The keys evicted by a lower bound than the one they were stored with are removed from the store too.
+                self._persist(updates={key: DELETED for key in evicted_keys})
+            for watch_key, changes in changes_by_watch.items():
+                self._publish_changes(changes=changes, partition_key=watch_key)
+        logger.info(f"Warm started from the snapshot store. Keys: {len(restored_keys)} - "
+                    f"watches: {len(restored_watch_revisions)}.")
+        return len(restored_keys)
+
+    def _add_watch(self, watch_key: str, key_object, start_revision: int = None) -> None:
+        """It binds a callback to the key based on its call_back_type and stores the watch id into the watch_id_map.
+
+        :param watch_key:
+        :param key_object:
+        :param start_revision: The revision to start watching from. None watches from the current revision.
+        :return:
+        """
+        watch_id = None
+        call_back_type = self._get_call_back_type(watch_key, key_object)
+        callback = partial(self.callback, watch_key=watch_key)
+        self._watch_client = self.etcd_connection_obj.etcd_client
+        # Progress notifications keep the revision of quiet watches recent, so resuming them rarely hits compaction.
+
+        if call_back_type == CallBackTypeEnum.PREFIX_TYPE.value:
+            watch_id = self.etcd_connection_obj.etcd_client.add_watch_prefix_callback(watch_key, callback,
+                                                                                      start_revision=start_revision,
+                                                                                      progress_notify=True)
+            logger.debug(f"PREFIX base callback has been added. Key: '{watch_key}' - call_back_type: "
+                         f"'{call_back_type}' - start_revision: {start_revision}")
+        elif call_back_type == CallBackTypeEnum.NON_PREFIX_TYPE.value:
+            watch_id = self.etcd_connection_obj.etcd_client.add_watch_callback(watch_key, callback,
+                                                                               start_revision=start_revision,
+                                                                               progress_notify=True)
+            logger.debug(f"NON-PREFIX base callback has been added. Key: '{watch_key}' - call_back_type: "
+                         f"'{call_back_type}' - start_revision: {start_revision}")
+        else:
+            logger.error("The callback type is not valid.")
+        self.watch_id_map[watch_key] = watch_id
 
     def stop_watch_keys(self) -> None:
-        """It iterates through all the keys and stops watching for changes on each key.
+        """It iterates through all the watches and stops watching for changes on each of them.
         :return:
         """
         for key_name, watch_id in self.watch_id_map.items():
             logger.info(f"Stop watch changes on key: '{key_name}' - watch_id: {watch_id} .")
             self.etcd_connection_obj.etcd_client.cancel_watch(watch_id)
-            if key_name in self.watch_keys:
-                self.watch_keys.pop(key_name)
+            for covered_key in self.watch_plan.get(key_name, [key_name]):
+                if covered_key in self.watch_keys:
+                    self.watch_keys.pop(covered_key)
+        if self.snapshot_writer:
+            # The batches applied so far are saved, so a watcher started next resumes from them.
+            self.snapshot_writer.flush()
 
     def stop_watch_key(self, key_name: str) -> None:
         """It stops watching for changes on a specific key name.
+        The keys covered by its watch get watches of their own, continuing from the revision of the stopped watch.
 
         :param key_name:
         :return:
         """
+        if key_name in self.watch_keys:
+            self.watch_keys.pop(key_name)
         if key_name in self.watch_id_map:
-            watch_id = self.watch_id_map.get(key_name)
+            watch_id = self.watch_id_map.pop(key_name)
             logger.info(f"Stop watch changes on key '{key_name}.")
             self.etcd_connection_obj.etcd_client.cancel_watch(watch_id)
-            if key_name in self.watch_keys:
-                self.watch_keys.pop(key_name)
+
+            revision = self.watch_revision_map.pop(key_name, None)
+            covered_keys = {covered_key: self.watch_keys.get(covered_key)
+                            for covered_key in self.watch_plan.pop(key_name, []) if covered_key != key_name}
+            for watch_key, watch_covered_keys in self.plan_watches(keys=covered_keys).items():
+                self.watch_plan[watch_key] = watch_covered_keys
+                if revision is not None:
+                    self.watch_revision_map[watch_key] = revision
+                self._add_watch(watch_key=watch_key, key_object=covered_keys.get(watch_key),
+                                start_revision=None if revision is None else revision + 1)
+        else:
+            for covered_keys in self.watch_plan.values():
+                if key_name in covered_keys:
+                    covered_keys.remove(key_name)
 
     def close_connection(self) -> None:
         """Before closing the connection with etcd, it stops watching for changes on all keys.
 
         :return:
         """
+        self.stop_supervisor()
         self.stop_watch_keys()
+        self.stop_coalescing()
+        self.stop_dispatcher()
+        if self.snapshot_writer:
+            # The pending batches are saved before closing.
+            self.snapshot_writer.stop()
         # Etcd3 lib development in progress
         # self.etcd_connection_obj.close_connection()